@@ -2,38 +2,113 @@ import logging
 import requests
 import os
 import json
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from config import server_url, server_port
+from config import server_url, server_port, api_timeouts, api_max_retries, api_retry_backoff, api_pool_size
+from helper import SharedLatencyHistogram
+from Modules.SessionJournal import SessionJournal
 
 
 class APIServer:
     def __init__(self):
         self.url = f"http://{server_url}:{server_port}"
-    
+        # Shared by the forked workers, latency_report covers the requests of every process
+        self.histograms = { endpoint: SharedLatencyHistogram() for endpoint in api_timeouts }
+        self._session = None
+        self._session_pid = None
+        self.journal = SessionJournal()
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Keep-alive session with a bounded retry policy, created once per process so that
+        forked workers never share a pooled socket with their parent
+        Every request is retried when the connection cannot be made, as the server has not seen it yet, but only
+        the idempotent GETs are retried after a read timeout or a 5xx, a POST may already have been processed
+        /stitch is a GET that reruns the whole stitch on the server, it goes through its own adapter without read
+        and status retries
+        """
+        if self._session is None or self._session_pid != os.getpid():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=api_pool_size,
+                                  max_retries=self._retry(api_max_retries))
+            stitch_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=self._retry(0))
+            self._session = requests.Session()
+            self._session.mount("http://", adapter)
+            # The longest matching prefix wins, so only /stitch takes this adapter
+            self._session.mount(f"{self.url}/stitch", stitch_adapter)
+            self._session_pid = os.getpid()
+        return self._session
+
+    @staticmethod
+    def _retry(read_retries:int) -> Retry:
+        return Retry(
+            total=api_max_retries,
+            connect=api_max_retries,
+            read=read_retries,
+            status=read_retries,
+            backoff_factor=api_retry_backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+        )
+
+    def _request(self, method:str, endpoint:str, **kwargs):
+        start = time.perf_counter()
+        sent_at = time.monotonic()
+        res = None
+        try:
+            res = self.session.request(method, f"{self.url}{endpoint}", timeout=api_timeouts[endpoint], **kwargs)
+            return res
+        finally:
+            self.histograms[endpoint].record((time.perf_counter() - start) * 1000)
+            self.journal.record_http(method, endpoint, sent_at, res)
+
+    def latency_report(self) -> str:
+        return "\n".join(f"[APIServer]{endpoint:<10} {histogram.report()}"
+                         for endpoint, histogram in self.histograms.items() if histogram.count > 0)
+
     def server_status(self):
-        res = requests.get(self.url, timeout=1)
+        res = self._request("GET", "/")
         return res.status_code
 
-    def predict_image(self, img_path:str, strict=False):
-        if not os.path.exists(img_path):
+    def _load_image(self, image):
+        """
+        Returns the file name and JPEG bytes of a CapturedImage, or of an image path on disk
+        """
+        if not isinstance(image, str):
+            return image.filename, image.data
+
+        if not os.path.exists(image):
             # Image does not exist in path
-            logging.warn(f"[APIServer]{img_path} does not exist!")
+            logging.warn(f"[APIServer]{image} does not exist!")
+            return None, None
+
+        with open(image, 'rb') as f:
+            return os.path.basename(image), f.read()
+
+    def predict_image(self, image, strict=False):
+        img_name, img = self._load_image(image)
+        if img is None:
             return None
 
-        img = open(img_path, 'rb')
-        img_name = os.path.basename(img_path)
-
-        res = requests.post(
-            f"{self.url}/predict", 
-            files={
-                "file": (img_name, img),
-                "json_data": (
-                    'j', 
-                    json.dumps({ "strict": strict }), 
-                    'application/json'
-                ) 
-            }, 
-        )
+        try:
+            res = self._request(
+                "POST",
+                "/predict", 
+                files={
+                    "file": (img_name, img, 'image/jpeg'),
+                    "json_data": (
+                        'j', 
+                        json.dumps({ "strict": strict }), 
+                        'application/json'
+                    ) 
+                }, 
+            )
+        except requests.RequestException as e:
+            logging.warning(f"[APIServer]Error when requesting prediction: {e}")
+            return None
         
         try:
             img_data = res.json()
@@ -45,7 +120,11 @@ class APIServer:
 
 
     def query_path(self, data:dict):
-        res = requests.post(f"{self.url}/algo", json=data)
+        try:
+            res = self._request("POST", "/algo", json=data)
+        except requests.RequestException as e:
+            logging.warning(f"[APIServer]Error when requesting path: {e}")
+            return None
 
         if res.status_code != 200:
             logging.warning(f"[APIServer]There was an error when requesting to server. Status Code: {res.status_code}")
@@ -63,16 +142,17 @@ class APIServer:
 
 
     # For task 2
-    def calibrate_robot(self, img_path:str):
-        if not os.path.exists(img_path):
-            # Image does not exist in path
-            logging.warn(f"[APIServer]{img_path} does not exist!")
+    def calibrate_robot(self, image):
+        img_name, img = self._load_image(image)
+        if img is None:
             return None
 
-        img = open(img_path, 'rb')
-        img_name = os.path.basename(img_path)
+        try:
+            res = self._request("POST", "/calibrate", files={"file": (img_name, img, 'image/jpeg')})
+        except requests.RequestException as e:
+            logging.warning(f"[APIServer]Error when requesting calibration: {e}")
+            return None
 
-        res = requests.post(f"{self.url}/calibrate", files={"file": (img_name, img)})
         try:
             command_data = res.json()
             logging.debug(f"[APIServer]Calibration Commands are: {command_data['Command']}")
@@ -83,15 +163,20 @@ class APIServer:
     
 
     def stitch_images(self):
-        res = requests.get(f"{self.url}/stitch")
+        try:
+            res = self._request("GET", "/stitch")
+        except requests.RequestException as e:
+            logging.warning(f"[APIServer]Error when requesting stitching: {e}")
+            return False
 
         if res.status_code != 200:
             logging.warning(f"[APIServer]There was an error when requesting to server. Status Code: {res.status_code}")
-            return
+            return False
         
         content = res.content
 
         logging.info(f"[APIServer]{content}")
+        return True
     
 
 if __name__ == "__main__":
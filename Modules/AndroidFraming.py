@@ -0,0 +1,114 @@
+import json
+import random
+import time
+
+"""
+> Splits the byte stream received from android into complete JSON messages
+> Messages are newline terminated, but a burst may also carry several messages back to back in one line,
+> one recv may hold many messages and a large obstacle payload may span several recvs, so bytes are
+> buffered until a complete JSON object has arrived
+> A complete line that is not valid JSON is still returned so the caller can report it as invalid
+"""
+class MessageFramer:
+    def __init__(self, max_buffer:int = 65536):
+        self._buffer = bytearray()
+        self._decoder = json.JSONDecoder()
+        self._max_buffer = max_buffer
+        self.reset_stats()
+
+    def reset(self):
+        self._buffer.clear()
+
+    def reset_stats(self):
+        self.bytes_received = 0
+        self.frames = 0
+        self.recv_calls = 0
+        self.dropped_bytes = 0
+        self._start = time.monotonic()
+
+    def _split(self, text:str) -> list:
+        """
+        Splits text holding one or more JSON objects written back to back,
+        returns the objects as strings and the incomplete remainder
+        """
+        frames = []
+        index = 0
+        while True:
+            while index < len(text) and text[index].isspace():
+                index += 1
+            if index == len(text):
+                return frames, ""
+            if text[index] not in "{[":
+                return frames, text[index:]
+            try:
+                _, end = self._decoder.raw_decode(text, index)
+            except json.JSONDecodeError:
+                return frames, text[index:]
+            frames.append(text[index:end])
+            index = end
+
+    def feed(self, data:bytes) -> list:
+        self.recv_calls += 1
+        self.bytes_received += len(data)
+        self._buffer += data
+
+        frames = []
+        # Complete lines first
+        newline = self._buffer.rfind(b"\n")
+        if newline != -1:
+            lines = bytes(self._buffer[:newline]).decode("utf-8", errors="replace").split("\n")
+            del self._buffer[:newline + 1]
+            for line in lines:
+                line_frames, rest = self._split(line)
+                frames.extend(line_frames)
+                if rest.strip():
+                    frames.append(rest.strip())
+
+        # Objects already complete in the unterminated tail
+        if len(self._buffer) > 0:
+            try:
+                tail = bytes(self._buffer).decode("utf-8")
+            except UnicodeDecodeError:
+                # A multi byte character is split across recvs
+                tail = None
+            if tail is not None:
+                tail_frames, rest = self._split(tail)
+                if len(tail_frames) > 0:
+                    frames.extend(tail_frames)
+                    self._buffer = bytearray(rest.encode("utf-8"))
+
+        if len(self._buffer) > self._max_buffer:
+            self.dropped_bytes += len(self._buffer)
+            self._buffer.clear()
+
+        self.frames += len(frames)
+        return frames
+
+    def stats(self) -> str:
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        per_call = self.frames / self.recv_calls if self.recv_calls > 0 else 0
+        return f"{self.frames} frames in {self.recv_calls} recvs ({per_call:.2f} frames/recv), " + \
+            f"{self.bytes_received / elapsed / 1024:.1f} KiB/s, {self.dropped_bytes} bytes dropped"
+
+
+if __name__ == "__main__":
+    obstacles = [{ "x": random.randint(0, 19), "y": random.randint(0, 19), "d": 0, "id": i } for i in range(1, 9)]
+    messages = [
+        json.dumps({ "header": "ITEM_LOCATION", "data": json.dumps(obstacles) }),
+        json.dumps({ "header": "ROBOT_CONTROL", "data": "FW10" }),
+        json.dumps({ "header": "START_MOVEMENT", "data": "" }),
+    ]
+    stream = "".join(random.choice(messages) + random.choice(["\n", ""]) for _ in range(20000)).encode("utf-8")
+
+    framer = MessageFramer()
+    start = time.perf_counter()
+    index = 0
+    frames = 0
+    while index < len(stream):
+        size = random.randint(1, 1024)
+        frames += len(framer.feed(stream[index:index + size]))
+        index += size
+    elapsed = time.perf_counter() - start
+    print(f"Decoded {frames} frames from {len(stream) / 1024:.0f} KiB in {elapsed * 1000:.0f}ms " +
+          f"({len(stream) / elapsed / 1024 / 1024:.1f} MiB/s)")
+    print(framer.stats())
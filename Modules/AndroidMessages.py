@@ -1,4 +1,6 @@
+import ast
 import json
+import time
 from enum import Enum
 from helper import RobotStatus
 
@@ -14,10 +16,55 @@ class BluetoothHeader(str, Enum):
     def __int__(self):
         return self.value
 
+# Prebuilt '{"header": "...", "data": ' fragments, identical to what json.dumps produces for the full message
+_HEADER_PREFIXES = { header.value: '{"header": ' + json.dumps(header.value) + ', "data": ' for header in BluetoothHeader }
+_HEADERS = frozenset(_HEADER_PREFIXES)
+_encode_value = json.JSONEncoder().encode
+_decode = json.JSONDecoder().decode
+
+def parse_obstacles(value) -> list:
+    """
+    Validates an ITEM_LOCATION payload (a list or single obstacle, or its JSON text) into a list of obstacle dicts
+    """
+    if isinstance(value, str):
+        try:
+            value = _decode(value)
+        except ValueError:
+            # Older tablet builds send the python repr of the list
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError) as e:
+                raise ValueError(f"invalid obstacles: {e}")
+    if isinstance(value, dict):
+        value = [value]
+    if not isinstance(value, list):
+        raise ValueError(f"obstacles must be a list, got {type(value).__name__}")
+    try:
+        return [{ "x": int(o['x']), "y": int(o['y']), "d": int(o['d']), "id": o['id'] } for o in value]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"invalid obstacle: {e}")
+
+def parse_robot_location(value) -> dict:
+    if isinstance(value, str):
+        value = _decode(value)
+    try:
+        return { "x": int(value['x']), "y": int(value['y']), "d": int(value['d']) }
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"invalid robot location: {e}")
+
 class AndroidMessage:
-    def __init__(self, category:str, value:str):
+    __slots__ = ("_category", "_value", "_created", "_payload", "_json", "_encoded", "trace_id")
+
+    def __init__(self, category:str, value:str, payload=None, trace_id:int = None):
         self._category = category
         self._value = value
+        # Monotonic creation time, shared by all processes, used to measure how long a message waited
+        self._created = time.monotonic()
+        self._payload = payload
+        self._json = None
+        self._encoded = None
+        # Trace of the command this message reports on, see Modules/Tracer.py
+        self.trace_id = trace_id
 
     @property
     def category(self) -> str:
@@ -27,9 +74,44 @@ class AndroidMessage:
     def value(self) -> str:
         return self._value
 
+    @property
+    def payload(self):
+        """
+        Validated data of a decoded message, obstacle list for ITEM_LOCATION and pose dict for ROBOT_LOCATION
+        """
+        return self._payload
+
+    @property
+    def created(self) -> float:
+        return self._created
+
     @property
     def json(self) -> str:
-        return json.dumps({ "header": self._category, "data": self._value })
+        if self._json is None:
+            prefix = _HEADER_PREFIXES.get(self._category)
+            if prefix is None:
+                self._json = json.dumps({ "header": self._category, "data": self._value })
+            else:
+                self._json = prefix + _encode_value(self._value) + "}"
+        return self._json
+
+    @property
+    def encoded(self) -> bytes:
+        """
+        Newline terminated utf-8 frame as written to the socket
+        """
+        if self._encoded is None:
+            self._encoded = (self.json + "\n").encode("utf-8")
+        return self._encoded
+
+    def __getstate__(self):
+        # The cached encodings are cheaper to rebuild than to pickle across processes
+        return (self._category, self._value, self._created, self._payload, self.trace_id)
+
+    def __setstate__(self, state):
+        self._category, self._value, self._created, self._payload, self.trace_id = state
+        self._json = None
+        self._encoded = None
     
     @staticmethod
     def from_json(json_dct):
@@ -37,53 +119,98 @@ class AndroidMessage:
                    json_dct['data'])
       return msg
 
+    @staticmethod
+    def decode(raw):
+        """
+        Parses and validates a message received from android, raises ValueError for anything malformed
+        """
+        message = _decode(raw) if isinstance(raw, str) else _decode(raw.decode("utf-8"))
+        if not isinstance(message, dict):
+            raise ValueError("message is not an object")
+        category = message.get('header')
+        if not isinstance(category, str) or category not in _HEADERS:
+            raise ValueError(f"unknown header {category}")
+        if 'data' not in message:
+            raise ValueError(f"{category} message without data")
+        value = message['data']
+
+        payload = value
+        if category == BluetoothHeader.ITEM_LOCATION.value:
+            payload = parse_obstacles(value)
+        elif category == BluetoothHeader.ROBOT_LOCATION.value:
+            payload = parse_robot_location(value)
+        elif category == BluetoothHeader.ROBOT_CONTROL.value and not isinstance(value, str):
+            raise ValueError("ROBOT_CONTROL data must be a command string")
+        return AndroidMessage(category, value, payload)
+
 class InfoMessage(AndroidMessage):
+    __slots__ = ()
+
     def __init__(self, value: str):
         super().__init__(BluetoothHeader.ROBOT_STATUS.value, value)
 
 class StatusMessage(AndroidMessage):
+    __slots__ = ()
+
+    _texts = {
+        RobotStatus.READY: "Robot is ready",
+        RobotStatus.NAVIGATING: "Robot navigating",
+        RobotStatus.DETECTING_IMAGE: "RPI starting to capture image",
+        RobotStatus.UNRESPONSIVE: "Robot is unresponsive",
+        RobotStatus.CALCULATING_PATH: "Querying path finding server",
+        RobotStatus.FINISH: "Robot finished path queue",
+    }
+
     def __init__(self, status: RobotStatus):
-        if status == RobotStatus.READY:
-            super().__init__(BluetoothHeader.ROBOT_STATUS.value, "Robot is ready")
-        elif status == RobotStatus.NAVIGATING:
-            super().__init__(BluetoothHeader.ROBOT_STATUS.value, "Robot navigating")
-        elif status == RobotStatus.DETECTING_IMAGE:
-            super().__init__(BluetoothHeader.ROBOT_STATUS.value, "RPI starting to capture image")
-        elif status == RobotStatus.UNRESPONSIVE:
-            super().__init__(BluetoothHeader.ROBOT_STATUS.value, "Robot is unresponsive")
-        elif status == RobotStatus.CALCULATING_PATH:
-            super().__init__(BluetoothHeader.ROBOT_STATUS.value, "Querying path finding server")
-        elif status == RobotStatus.FINISH:
-            super().__init__(BluetoothHeader.ROBOT_STATUS.value, "Robot finished path queue")
+        super().__init__(BluetoothHeader.ROBOT_STATUS.value, self._texts[status])
 
 class RobotLocMessage(AndroidMessage):
-    def __init__(self, value : dict):
-        super().__init__(BluetoothHeader.ROBOT_LOCATION.value, str(value))
+    __slots__ = ()
+
+    def __init__(self, value : dict, trace_id:int = None):
+        super().__init__(BluetoothHeader.ROBOT_LOCATION.value, str(value), trace_id=trace_id)
 
 class ImageMessage(AndroidMessage):
+    __slots__ = ()
+
     def __init__(self, value: str):
         super().__init__(BluetoothHeader.IMAGE_INFO.value, value)
 
 class ObstacleMessage(AndroidMessage):
+    __slots__ = ()
+
     def __init__(self, v : AndroidMessage):
-        super().__init__(v.category, v.value)
-        temp_obstacle = json.loads(self.value)
-        self._obstacles = []
-        if isinstance(temp_obstacle, dict):
-            self._obstacles.append({
-                "x": temp_obstacle['x'],
-                "y": temp_obstacle['y'],
-                "d": temp_obstacle['d'],
-                "id": temp_obstacle['id'],
-            })
-        elif isinstance(temp_obstacle, list):
-            for o in temp_obstacle:
-                self._obstacles.append({
-                    "x": o['x'],
-                    "y": o['y'],
-                    "d": o['d'],
-                    "id": o['id'],
-                })
+        super().__init__(v.category, v.value, parse_obstacles(v.value))
+
     @property
     def obstacles(self) -> list:
-        return self._obstacles
\ No newline at end of file
+        return self._payload
+
+
+if __name__ == "__main__":
+    import timeit
+
+    obstacles = [{ "x": 2 * i, "y": 19 - 2 * i, "d": 2 * (i % 4), "id": i } for i in range(1, 9)]
+    samples = {
+        "status": json.dumps({ "header": "ROBOT_CONTROL", "data": "FW10" }),
+        "8 obstacles": json.dumps({ "header": "ITEM_LOCATION", "data": json.dumps(obstacles) }),
+    }
+    iterations = 20000
+
+    def old_encode(category, value):
+        return json.dumps({ "header": category, "data": value })
+
+    def old_decode(raw):
+        msg = json.loads(raw, object_hook=AndroidMessage.from_json)
+        if msg.category == BluetoothHeader.ITEM_LOCATION.value:
+            ast.literal_eval(msg.value)
+        return msg
+
+    for name, raw in samples.items():
+        decoded = AndroidMessage.decode(raw)
+        t_old_dec = timeit.timeit(lambda: old_decode(raw), number=iterations) / iterations * 1e6
+        t_new_dec = timeit.timeit(lambda: AndroidMessage.decode(raw), number=iterations) / iterations * 1e6
+        t_old_enc = timeit.timeit(lambda: old_encode(decoded.category, decoded.value), number=iterations) / iterations * 1e6
+        t_new_enc = timeit.timeit(lambda: AndroidMessage(decoded.category, decoded.value).encoded,
+                                  number=iterations) / iterations * 1e6
+        print(f"{name:<12} decode {t_old_dec:6.2f}us -> {t_new_dec:6.2f}us   encode {t_old_enc:6.2f}us -> {t_new_enc:6.2f}us")
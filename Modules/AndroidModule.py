@@ -1,43 +1,57 @@
-import bluetooth as bt
 import logging
+import multiprocessing as mp
 import os
 import socket
+import time
+from collections import deque
+from multiprocessing import reduction
 
-from config import uuid,service_name
+from config import android_recv_size, android_transport
 from Modules.AndroidMessages import AndroidMessage
+from Modules.AndroidFraming import MessageFramer
+from Modules.AndroidTransport import make_transport
+from Modules.SessionJournal import SessionJournal, ANDROID, IN, OUT
 from utils import CreateColouredLogging
 
 class AndroidModule:
-    def __init__(self):
+    def __init__(self, transport=None, workers:tuple = ()):
         self.client_sock = None
-        self.server_sock = None
+        # RFCOMM on the robot, a TCP or unix socket for Modules/FakeTablet.py
+        self.transport = transport if transport is not None else make_transport(android_transport)
+        self._listening = False
+        self._address = None
+        # One pipe per worker process to pass it the socket of a new connection, created before they are forked
+        self._handoff = { worker: mp.Pipe() for worker in workers }
+        # Connections are numbered as they are accepted, a drop is only acted on when it was reported for the
+        # latest one, a worker still on an older socket reports a drop that was already handled
+        self._accepted = mp.RawValue("Q", 0)
+        self._dropped = mp.Value("Q", 0)
+        self.connection = 0
+        self._framer = MessageFramer()
+        self._pending = deque()
+        self.journal = SessionJournal()
         #self.logger = CreateColouredLogging(__name__)
 
     def connect(self):
         logging.info("[AndroidModule]Bluetooth connection started")
         try:
-            os.system("sudo hciconfig hci0 piscan")
+            if not self._listening:
+                self._address = self.transport.open()
+                self._listening = True
 
-            self.server_sock = bt.BluetoothSocket(bt.RFCOMM)
-            self.server_sock.bind(("", bt.PORT_ANY))
-            self.server_sock.listen(1)
-
-            port = self.server_sock.getsockname()[1]
-
-            bt.advertise_service(self.server_sock, service_name, 
-                                service_id=uuid,
-                                service_classes=[uuid, bt.SERIAL_PORT_CLASS],
-                                profiles=[bt.SERIAL_PORT_PROFILE])
-           
-            logging.info(f"[AndroidModule]Awaiting bluetooth connection on RFCOMM CHANNEL {port}")
-            self.client_sock, client_info = self.server_sock.accept()
+            logging.info(f"[AndroidModule]Awaiting bluetooth connection on {self._address}")
+            self.client_sock, client_info = self.transport.accept()
             logging.info(f"[AndroidModule]Accepted connection from {client_info}")
+            self._accepted.value += 1
+            self.connection = self._accepted.value
+            # Bytes of the previous connection must not be glued to the new stream
+            self._framer.reset()
+            self._pending.clear()
 
         except Exception as e:
             logging.warning(f"Error in establishing bluetooth connection: {e}")
-            if self.server_sock is not None:
-                self.server_sock.close()
-                self.server_sock = None
+            self.transport.close()
+            self._listening = False
             if self.client_sock is not None:
                 self.client_sock.close()
                 self.client_sock = None
@@ -45,38 +59,130 @@ class AndroidModule:
     def disconnect(self):
         try:
             logging.info("[AndroidModule]Disconnecting bluetooth link")
-            if self.server_sock is not None:
-                self.server_sock.shutdown(socket.SHUT_RDWR)
-                self.server_sock.close()
-                self.server_sock = None
-            if self.client_sock is not None:
-                self.client_sock.shutdown(socket.SHUT_RDWR)
-                self.client_sock.close()
-                self.server_sock = None
+            logging.info(f"[AndroidModule]Receive stats: {self._framer.stats()}")
+            self.transport.close()
+            self._listening = False
+            self._close_client()
             logging.info("[AndroidModule]Disconnected bluetooth link")
 
         except Exception as e:
             logging.warning(f"[AndroidModule]Error when disconnecting bluetooth link: {e}")
 
+    def _close_client(self):
+        if self.client_sock is not None:
+            try:
+                # Shuts the connection down for the worker processes holding it as well
+                self.client_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Already closed by android
+                pass
+            self.client_sock.close()
+            self.client_sock = None
+
+    def reconnect(self):
+        """
+        Replaces a dropped connection with the next one, the listening socket and its SDP record stay up so the
+        tablet can connect again as soon as it notices the drop
+        The new socket is handed to the worker processes, each takes it over with adopt
+        """
+        logging.info("[AndroidModule]Replacing bluetooth connection")
+        self._close_client()
+        self.connect()
+        while self.client_sock is None:
+            # The listening socket failed and was closed, connect opens it again
+            time.sleep(0.05)
+            self.connect()
+        for parent_end, _ in self._handoff.values():
+            reduction.send_handle(parent_end, self.client_sock.fileno(), None)
+            parent_end.send(self.connection)
+
+    def report_drop(self):
+        """
+        Marks the connection this process is on as dropped
+        """
+        with self._dropped.get_lock():
+            self._dropped.value = max(self._dropped.value, self.connection)
+
+    def dropped(self) -> bool:
+        """
+        Whether the latest connection was reported dropped, reports about replaced connections are stale
+        """
+        return self._dropped.value >= self._accepted.value
+
+    def adopt(self, worker:str, block:bool = True) -> bool:
+        """
+        Takes over the socket handed over by reconnect in a worker process, waiting for it when block is set,
+        returns False when there is none
+        """
+        _, child_end = self._handoff[worker]
+        if not block and not child_end.poll():
+            return False
+        fd = reduction.recv_handle(child_end)
+        connection = child_end.recv()
+        # Only the latest connection is still up when several were accepted since the last adopt
+        while child_end.poll():
+            os.close(fd)
+            fd = reduction.recv_handle(child_end)
+            connection = child_end.recv()
+        if self.client_sock is not None:
+            self.client_sock.close()
+        self.client_sock = socket.socket(fileno=fd)
+        self.connection = connection
+        self._framer.reset()
+        self._pending.clear()
+        return True
+
+    def _client(self) -> socket.socket:
+        # Between the drop and the next accept there is no socket, which is a dropped link for the callers
+        client_sock = self.client_sock
+        if client_sock is None:
+            raise ConnectionResetError("no connection to android")
+        return client_sock
+
     def send(self, message:AndroidMessage):
         try:
             #if len(msg) < 512:
             #for x in range(stm_message_len - len(msg)):
                 #msg += ' '
             #raw_byte = (msg).encode("utf-8")
-            self.client_sock.send(f"{message.json}\n".encode("utf-8"))
-            logging.debug(f"[AndroidModule]Sent message to android: {message.json}")
+            self._client().sendall(message.encoded)
+            self.journal.record(ANDROID, OUT, message.encoded)
+            logging.debug("[AndroidModule]Sent message to android: %s", message.json)
         
         except Exception as e:
             logging.warning(f"[AndroidModule]Error when sending message to android: {e} : {type(e)}")
             raise e
 
+    def send_batch(self, messages:list):
+        """
+        Sends several messages with a single socket write
+        """
+        try:
+            data = b"".join(message.encoded for message in messages)
+            self._client().sendall(data)
+            self.journal.record(ANDROID, OUT, data)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                for message in messages:
+                    logging.debug("[AndroidModule]Sent message to android: %s", message.json)
+
+        except Exception as e:
+            logging.warning(f"[AndroidModule]Error when sending messages to android: {e} : {type(e)}")
+            raise e
+
     def receive(self):
+        """
+        Returns the next complete message from android, reading from the socket only when none are buffered
+        """
         try:
-            encoded_msg = self.client_sock.recv(1024)
-            msg = encoded_msg.decode("utf-8")
+            while len(self._pending) == 0:
+                encoded_msg = self._client().recv(android_recv_size)
+                if len(encoded_msg) == 0:
+                    raise ConnectionResetError("connection closed by android")
+                self.journal.record(ANDROID, IN, encoded_msg)
+                self._pending.extend(self._framer.feed(encoded_msg))
+            msg = self._pending.popleft()
             #msg = msg.replace("\"", "'")
-            logging.debug(f"[AndroidModule]Received message from android: {msg}")
+            logging.debug("[AndroidModule]Received message from android: %s", msg)
             return msg
 
         except Exception as e:
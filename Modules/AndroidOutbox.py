@@ -0,0 +1,168 @@
+import logging
+import queue
+import time
+from collections import deque
+
+from config import android_batch_bytes, cpu_report_interval
+from helper import LatencyHistogram, CpuUsage
+from Modules.AndroidMessages import AndroidMessage, BluetoothHeader, StatusMessage
+
+"""
+> Orders the messages waiting to be sent to android, used by the sender on everything it drained from android_msgs
+> Image results go first, then robot status changes, then the robot location and finally info chatter
+> Robot location updates collapse to the latest pose as older ones are stale by the time they could be sent
+> Messages are handed out in batches of up to android_batch_bytes to be written with a single socket call
+"""
+class OutboundScheduler:
+    IMAGE_RESULT = 0
+    STATUS = 1
+    LOCATION = 2
+    INFO = 3
+    CLASS_NAMES = ("image_result", "status", "location", "info")
+
+    def __init__(self, max_batch_bytes:int = android_batch_bytes):
+        self._max_batch_bytes = max_batch_bytes
+        self._queues = [deque() for _ in self.CLASS_NAMES]
+        self.latency = [LatencyHistogram() for _ in self.CLASS_NAMES]
+        self.max_depth = 0
+        self.coalesced = 0
+
+    @classmethod
+    def classify(cls, msg:AndroidMessage) -> int:
+        if msg.category == BluetoothHeader.IMAGE_RESULT.value:
+            return cls.IMAGE_RESULT
+        elif msg.category == BluetoothHeader.ROBOT_LOCATION.value:
+            return cls.LOCATION
+        elif isinstance(msg, StatusMessage):
+            return cls.STATUS
+        return cls.INFO
+
+    def push(self, msg:AndroidMessage):
+        msg_class = self.classify(msg)
+        if msg_class == self.LOCATION and len(self._queues[msg_class]) > 0:
+            self._queues[msg_class].clear()
+            self.coalesced += 1
+        self._queues[msg_class].append(msg)
+        self.max_depth = max(self.max_depth, self.pending())
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self._queues)
+
+    def pop_batch(self) -> list:
+        """
+        Returns the highest priority messages that fit in one write, always at least one
+        """
+        batch = []
+        size = 0
+        for q in self._queues:
+            while len(q) > 0:
+                msg_size = len(q[0].encoded)
+                if len(batch) > 0 and size + msg_size > self._max_batch_bytes:
+                    return batch
+                batch.append(q.popleft())
+                size += msg_size
+        return batch
+
+    def record_sent(self, batch:list):
+        now = time.monotonic()
+        for msg in batch:
+            self.latency[self.classify(msg)].record((now - msg.created) * 1000)
+
+    def stats(self) -> str:
+        per_class = ", ".join(f"{name} {histogram.report()}"
+                              for name, histogram in zip(self.CLASS_NAMES, self.latency) if histogram.count > 0)
+        return f"max depth {self.max_depth}, {self.coalesced} locations coalesced, send latency: {per_class}"
+
+
+"""
+> The android sender worker shared by the week programs, drains android_msgs through an OutboundScheduler
+> A None in android_msgs stops the sender only while stop() has set stop_requested, a sender killed by stop()
+> leaves its None behind and the next sender skips it instead of exiting on it
+> on_drop is called when a write fails and returns whether the batch should be sent again, on_sent gets every
+> batch that was written
+"""
+class AndroidSender:
+    def __init__(self, android_msgs, stop_requested, on_drop, on_sent=None):
+        self._android_msgs = android_msgs
+        self._stop_requested = stop_requested
+        self._on_drop = on_drop
+        self._on_sent = on_sent
+
+    def _stops(self, msg) -> bool:
+        if msg is not None:
+            return False
+        if self._stop_requested.is_set():
+            return True
+        logging.debug("[AndroidSender.run]Skipped the stop sentinel of a killed sender")
+        return False
+
+    def run(self, android):
+        cpu_usage = CpuUsage()
+        scheduler = OutboundScheduler()
+        stopping = False
+        while not stopping or scheduler.pending() > 0:
+            try:
+                if scheduler.pending() == 0:
+                    # Blocks until there is a message
+                    msg:AndroidMessage = self._android_msgs.get()
+                    if self._stops(msg):
+                        break
+                    if msg is not None:
+                        scheduler.push(msg)
+
+                # Take everything else already queued so it can be prioritised and coalesced
+                while not stopping:
+                    msg = self._android_msgs.get_nowait()
+                    if self._stops(msg):
+                        stopping = True
+                    elif msg is not None:
+                        scheduler.push(msg)
+            except queue.Empty:
+                pass
+            except (EOFError, BrokenPipeError):
+                break
+
+            if scheduler.pending() == 0:
+                continue
+            batch = scheduler.pop_batch()
+            while True:
+                try:
+                    logging.debug("[AndroidSender.run]Sending %s messages", len(batch))
+                    android.send_batch(batch)
+                except OSError:
+                    logging.warning("[AndroidSender.run]Android connection dropped")
+                    if self._on_drop():
+                        continue
+                    batch = None
+                break
+            if batch is not None:
+                scheduler.record_sent(batch)
+                if self._on_sent is not None:
+                    self._on_sent(batch)
+
+            if cpu_usage.elapsed() >= cpu_report_interval:
+                logging.info(f"[AndroidSender.run]CPU usage: {cpu_usage.percent():.1f}%")
+                logging.info(f"[AndroidSender.run]Outbound: {scheduler.stats()}")
+                cpu_usage.reset()
+
+        logging.info(f"[AndroidSender.run]Stopped, CPU usage: {cpu_usage.percent():.1f}%")
+        logging.info(f"[AndroidSender.run]Outbound: {scheduler.stats()}")
+
+    def stop(self, process=None):
+        """
+        Stops the sender, a sender process that does not exit in time is killed
+        Without a process the sender is a thread of the single process runtime and is not waited for
+        """
+        self._stop_requested.set()
+        self._android_msgs.put(None)
+        if process is None:
+            return
+        process.join(1)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        self._stop_requested.clear()
+
+
+if __name__ == "__main__":
+    pass
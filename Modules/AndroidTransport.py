@@ -0,0 +1,107 @@
+import os
+import socket
+
+from config import uuid, service_name, android_tcp_address, android_unix_path
+
+class RfcommTransport:
+    """
+    Bluetooth RFCOMM server advertised to the tablet, the link used on the robot
+    """
+    def __init__(self):
+        self._server_sock = None
+
+    def open(self):
+        # PyBluez is only needed on the robot
+        import bluetooth as bt
+
+        os.system("sudo hciconfig hci0 piscan")
+
+        self._server_sock = bt.BluetoothSocket(bt.RFCOMM)
+        self._server_sock.bind(("", bt.PORT_ANY))
+        self._server_sock.listen(1)
+
+        bt.advertise_service(self._server_sock, service_name,
+                            service_id=uuid,
+                            service_classes=[uuid, bt.SERIAL_PORT_CLASS],
+                            profiles=[bt.SERIAL_PORT_PROFILE])
+        return f"RFCOMM CHANNEL {self._server_sock.getsockname()[1]}"
+
+    def accept(self):
+        return self._server_sock.accept()
+
+    def close(self):
+        if self._server_sock is not None:
+            try:
+                self._server_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._server_sock.close()
+            self._server_sock = None
+
+
+class TcpTransport:
+    """
+    TCP server for a tablet emulator or Modules/FakeTablet.py on the network
+    """
+    def __init__(self, address:tuple = android_tcp_address):
+        self._address = address
+        self._server_sock = None
+
+    def open(self):
+        self._server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server_sock.bind(self._address)
+        self._server_sock.listen(1)
+        return f"TCP {self._server_sock.getsockname()}"
+
+    def accept(self):
+        client_sock, client_info = self._server_sock.accept()
+        # Messages are small and latency bound
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client_sock, client_info
+
+    def close(self):
+        if self._server_sock is not None:
+            self._server_sock.close()
+            self._server_sock = None
+
+
+class UnixTransport:
+    """
+    Unix domain socket server for Modules/FakeTablet.py on the same machine
+    """
+    def __init__(self, path:str = android_unix_path):
+        self._path = path
+        self._server_sock = None
+
+    def open(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server_sock.bind(self._path)
+        self._server_sock.listen(1)
+        return f"unix socket {self._path}"
+
+    def accept(self):
+        return self._server_sock.accept()
+
+    def close(self):
+        if self._server_sock is not None:
+            self._server_sock.close()
+            self._server_sock = None
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+
+def make_transport(kind:str):
+    if kind == "rfcomm":
+        return RfcommTransport()
+    elif kind == "tcp":
+        return TcpTransport()
+    elif kind == "unix":
+        return UnixTransport()
+    raise ValueError(f"Unknown android transport: {kind}")
+
+
+if __name__ == "__main__":
+    pass
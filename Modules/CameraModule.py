@@ -1,41 +1,268 @@
+import io
 import logging
+import multiprocessing as mp
 import os
-from time import sleep
-from picamera import PiCamera
+import queue
+import threading
+import time
+
+from config import resolution, warmup_time, camera_backend, camera_image_folder, camera_framerate, \
+    camera_capture_timeout, camera_still_port, camera_save_folder
+
+# Placeholder frame served by the file backend when no image folder is given, only the JPEG markers are valid
+FAKE_JPEG = b"\xff\xd8\xff\xe0" + bytes(1024) + b"\xff\xd9"
+
+class PiCameraBackend:
+    """
+    Keeps a PiCamera open, stills for recognition come from the still port at full JPEG quality and JPEG frames
+    are grabbed continuously from the video port when video port captures are used
+    """
+    def __init__(self):
+        self._camera = None
+
+    def open(self, resolution):
+        from picamera import PiCamera
+
+        self._camera = PiCamera()
+        self._camera.resolution = resolution
+        self._camera.framerate = camera_framerate
+        # Let auto exposure settle once instead of on every capture
+        time.sleep(warmup_time)
+
+    def frames(self):
+        stream = io.BytesIO()
+        for _ in self._camera.capture_continuous(stream, format="jpeg", use_video_port=True):
+            yield stream.getvalue()
+            stream.seek(0)
+            stream.truncate()
+
+    def still(self) -> bytes:
+        stream = io.BytesIO()
+        self._camera.capture(stream, format="jpeg", use_video_port=False)
+        return stream.getvalue()
+
+    def close(self):
+        if self._camera is not None:
+            self._camera.close()
+            self._camera = None
+
+
+class FileCameraBackend:
+    """
+    Serves the JPEG files of a folder in a loop at the camera framerate, for machines without a PiCamera
+    """
+    def __init__(self, folder:str = None):
+        self._folder = folder
+        self._images = []
+        self._stills = 0
+
+    def open(self, resolution):
+        if self._folder is not None and os.path.isdir(self._folder):
+            for name in sorted(os.listdir(self._folder)):
+                if name.lower().endswith((".jpg", ".jpeg")):
+                    with open(os.path.join(self._folder, name), "rb") as f:
+                        self._images.append(f.read())
+        if len(self._images) == 0:
+            self._images.append(FAKE_JPEG)
+
+    def frames(self):
+        index = 0
+        while True:
+            time.sleep(1 / camera_framerate)
+            yield self._images[index % len(self._images)]
+            index += 1
+
+    def still(self) -> bytes:
+        self._stills += 1
+        return self._images[(self._stills - 1) % len(self._images)]
+
+    def close(self):
+        self._images = []
+
+
+class CapturedImage:
+    """
+    JPEG bytes of a captured frame, uploaded straight from memory while the copy at path is written in the background
+    """
+    def __init__(self, name:str, data:bytes, path:str):
+        self.name = name
+        self.data = data
+        self.path = path
+
+    @property
+    def filename(self) -> str:
+        return os.path.basename(self.path)
+
+
+def make_backend(kind:str):
+    if kind == "picamera":
+        return PiCameraBackend()
+    elif kind == "file":
+        return FileCameraBackend(camera_image_folder)
+    raise ValueError(f"Unknown camera backend: {kind}")
 
-from config import resolution, warmup_time
 
 """
-> .Capture method creates a PiCamera object, this object belongs to the caller thread
-> If any other thread happens to call capture, there will be a deadlock as PiCamera object creation
-> will try to get ownership from the other thread
+> The camera is owned by a long lived service process started with .start(), which keeps the sensor open so
+> no sensor initialisation is on the critical path
+> .capture can be called from any thread or process forked after .start(), requests are serialized through a lock
+> With still set, the default from camera_still_port, the frame is taken from the still port at the full JPEG
+> quality wanted for recognition
+> Otherwise the request is answered with the first video port frame grabbed after it arrived, so the image is never
+> older than the call and comes without the sensor mode switch of a still, at the lower quality of the video port
+> encoder. Frames are only grabbed and encoded continuously once the video port is used, from the start when
+> camera_still_port is off and from the first video port capture otherwise, so stills alone cost no grabbing
+> Every request carries a sequence number echoed in its response, so a frame answered after its caller timed
+> out is dropped instead of being handed to the next caller
+> The frame is returned in memory as a CapturedImage, saving it to disk is left to a writer thread of the service
 """
 class CameraModule:
-    def __init__(self):
-        self._save_folder = "./images/"
+    def __init__(self, backend=None):
+        self._save_folder = camera_save_folder
         self._warmup_time = warmup_time
         self.resolution = resolution
-        
-        logging.info(f"[CameraModule]Camera Module initialized with {resolution} resolution and " + 
+        self._backend = backend if backend is not None else make_backend(camera_backend)
+
+        self._requests = mp.Queue()
+        self._responses = mp.Queue()
+        self._request_lock = mp.Lock()
+        # Shared by every process calling capture, only changed under _request_lock
+        self._request_seq = mp.RawValue("Q", 0)
+        self._process = None
+
+        logging.info(f"[CameraModule]Camera Module initialized with {resolution} resolution and " +
                 f"{self._warmup_time}s warm up time")
 
-    def capture(self, name:str):
-        camera = PiCamera()
-        camera.resolution = self.resolution
-        # sleep(self._warmup_time)
+    def start(self):
+        if self._process is not None and self._process.is_alive():
+            return
+        self._process = mp.Process(target=self._serve, daemon=True)
+        self._process.start()
+        logging.info("[CameraModule]Camera service started")
+
+    def stop(self):
+        if self._process is None:
+            return
+        self._requests.put(None)
+        self._process.join(2)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._process = None
+        logging.info("[CameraModule]Camera service stopped")
+
+    def _serve(self):
+        latest = { "frame": None, "seq": 0 }
+        frame_ready = threading.Condition()
+        stopped = threading.Event()
+
+        def grab():
+            try:
+                for frame in self._backend.frames():
+                    with frame_ready:
+                        latest["frame"] = frame
+                        latest["seq"] += 1
+                        frame_ready.notify_all()
+                    if stopped.is_set():
+                        break
+            except Exception as e:
+                logging.warning(f"[CameraModule]Frame grabber stopped: {e}")
 
+        def write():
+            while True:
+                image = pending_writes.get()
+                if image is None:
+                    break
+                try:
+                    self._save(image)
+                except Exception as e:
+                    logging.warning(f"[CameraModule]Error when saving {image.path}: {e}")
+
+        pending_writes = queue.Queue()
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+
+        self._backend.open(self.resolution)
+        grabber = None
+        if not camera_still_port:
+            grabber = threading.Thread(target=grab, daemon=True)
+            grabber.start()
+
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            request_seq, name, persist, still = request
+            try:
+                if still:
+                    frame = self._backend.still()
+                else:
+                    if grabber is None:
+                        grabber = threading.Thread(target=grab, daemon=True)
+                        grabber.start()
+                    with frame_ready:
+                        seq = latest["seq"]
+                        if not frame_ready.wait_for(lambda: latest["seq"] > seq, camera_capture_timeout):
+                            raise TimeoutError("no frame from camera")
+                        frame = latest["frame"]
+                image = CapturedImage(name, frame, os.path.join(self._save_folder, name+".jpg"))
+                self._responses.put((request_seq, image))
+                if persist:
+                    pending_writes.put(image)
+            except Exception as e:
+                self._responses.put((request_seq, e))
+
+        stopped.set()
+        self._backend.close()
+        # Let the queued images reach the disk before exiting
+        pending_writes.put(None)
+        writer.join()
+
+    def _save(self, image:CapturedImage):
         if not os.path.exists(self._save_folder):
             os.makedirs(self._save_folder)
 
-        save_path = os.path.join(self._save_folder, name+".jpg")
-        camera.capture(save_path)
-        camera.close()
+        with open(image.path, "wb") as f:
+            f.write(image.data)
+        logging.debug(f"[CameraModule]Saved image to {image.path}")
+
+    def capture(self, name:str, persist:bool = True, still:bool = camera_still_port) -> CapturedImage:
+        with self._request_lock:
+            self._request_seq.value += 1
+            request_seq = self._request_seq.value
+            self._requests.put((request_seq, name, persist, still))
+            deadline = time.monotonic() + camera_capture_timeout + 1
+            while True:
+                try:
+                    response_seq, result = self._responses.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    raise TimeoutError("[CameraModule]Camera service did not answer")
+                if response_seq == request_seq:
+                    break
+                # Answer to a capture that timed out, its image must not be used under this name
+                logging.warning(f"[CameraModule]Dropped the late frame of capture request {response_seq}")
 
-        logging.info(f"[CameraModule]Saved image to {save_path}")
+        if isinstance(result, Exception):
+            raise result
 
-        return save_path
+        logging.info(f"[CameraModule]Captured image {result.filename} ({len(result.data)} bytes)")
+
+        return result
 
 
 if __name__ == "__main__":
-    pass
+    logging.basicConfig(level=logging.INFO)
+    iterations = 20
+    camera = CameraModule(FileCameraBackend(camera_image_folder))
+    camera.start()
+    camera.capture("warmup", persist=False)
+
+    for still in (False, True):
+        start = time.perf_counter()
+        for i in range(iterations):
+            camera.capture(f"bench_{i}", persist=False, still=still)
+        elapsed = time.perf_counter() - start
+        print(f"Capture latency from the {'still' if still else 'video'} port: {elapsed / iterations * 1000:.1f}ms " +
+              f"at {camera_framerate} fps")
 
+    camera.stop()
@@ -0,0 +1,117 @@
+import logging
+
+from config import stm_command_prefixes, stm_max_straight, stm_command_overhead, stm_straight_speed
+from helper import TranslateCommand
+
+# Straight moves that can be summed into one signed distance, slow moves are only fused with slow moves
+_STRAIGHT = { "FW": ("FW", "BW", 1), "BW": ("FW", "BW", -1), "FS": ("FS", "BS", 1), "BS": ("FS", "BS", -1) }
+
+"""
+> Simplifies the command list returned by /algo before it is queued for the STM
+> A run of consecutive straight moves of the same speed (FW/BW or FS/BS) is replaced by its net displacement,
+> split into as few moves of at most stm_max_straight as possible, so FW10 FW10 FW10 becomes FW30 and
+> FW20 BW20 disappears
+> Every STM command has a matching pose in path[1:], the poses of the merged moves are rebuilt from the pose
+> before the run so the robot location reported on each ACK stays correct
+> SNAP, FIN and every other command end a run, nothing is moved across them
+"""
+class CommandOptimizer:
+    def __init__(self, max_straight:int = stm_max_straight):
+        self._max_straight = max_straight
+
+    @staticmethod
+    def _distance(command:str):
+        try:
+            return int(command[2:])
+        except ValueError:
+            return None
+
+    def _emit(self, run:list, start:dict, end:dict, commands:list, poses:list):
+        forward, backward, _ = _STRAIGHT[run[0][0][:2]]
+        net = sum(_STRAIGHT[command[:2]][2] * distance for command, distance in run)
+        prefix = forward if net > 0 else backward
+        remaining = abs(net)
+        pose = start
+        while remaining > 0:
+            step = min(remaining, self._max_straight)
+            remaining -= step
+            command = f"{prefix}{step:02d}"
+            commands.append(command)
+            if remaining == 0:
+                # The last move ends where the original run ended
+                pose = end
+            else:
+                dx, dy, d = TranslateCommand(command, pose["d"])
+                pose = dict(pose, x=pose["x"] + dx, y=pose["y"] + dy, d=d)
+            poses.append(pose)
+
+    def optimize(self, commands:list, path:list):
+        """
+        Returns the optimized commands, the matching path (start pose included) and the number of cm not driven,
+        the input is returned unchanged if the path does not have one pose per STM command
+        """
+        moves = sum(1 for command in commands if command.startswith(stm_command_prefixes))
+        if len(path) != moves + 1:
+            logging.warning(f"[CommandOptimizer]{moves} moves for {len(path) - 1} poses, not optimizing")
+            return list(commands), list(path), 0
+
+        new_commands = []
+        new_poses = []
+        run = []
+        run_start = path[0]
+        pose_index = 0
+        cancelled = 0
+
+        for command in commands + [None]:
+            distance = self._distance(command) if command is not None and command[:2] in _STRAIGHT else None
+            if len(run) > 0 and (distance is None or _STRAIGHT[command[:2]][:2] != _STRAIGHT[run[0][0][:2]][:2]):
+                before = len(new_commands)
+                self._emit(run, run_start, path[pose_index], new_commands, new_poses)
+                driven = sum(int(c[2:]) for c in new_commands[before:])
+                cancelled += sum(d for _, d in run) - driven
+                run = []
+
+            if command is None:
+                break
+            if distance is not None:
+                if len(run) == 0:
+                    run_start = path[pose_index]
+                run.append((command, distance))
+                pose_index += 1
+                continue
+
+            new_commands.append(command)
+            if command.startswith(stm_command_prefixes):
+                pose_index += 1
+                new_poses.append(path[pose_index])
+
+        return new_commands, [path[0]] + new_poses, cancelled
+
+    def report(self, before:list, after:list, cancelled:int) -> str:
+        saved = (len(before) - len(after)) * stm_command_overhead + cancelled / stm_straight_speed
+        return f"{len(before)} -> {len(after)} commands, {cancelled}cm not driven, ~{saved:.1f}s saved"
+
+
+if __name__ == "__main__":
+    optimizer = CommandOptimizer()
+    start = { "x": 1, "y": 1, "d": 0 }
+    commands = ["FW10", "FW10", "FW10", "FR00", "FW20", "BW20", "SNAP1_C", "BW10", "BW10", "FIN"]
+    path = [start]
+    for command in commands:
+        if command.startswith(stm_command_prefixes):
+            dx, dy, d = TranslateCommand(command, path[-1]["d"])
+            path.append({ "x": path[-1]["x"] + dx, "y": path[-1]["y"] + dy, "d": d })
+
+    new_commands, new_path, cancelled = optimizer.optimize(commands, path)
+    print(commands, "->", new_commands)
+    print(optimizer.report(commands, new_commands, cancelled))
+
+    # Replaying the optimized moves must end on the same pose as the original plan
+    pose = dict(start)
+    for command, expected in zip([c for c in new_commands if c.startswith(stm_command_prefixes)], new_path[1:]):
+        dx, dy, pose["d"] = TranslateCommand(command, pose["d"])
+        pose["x"] += dx
+        pose["y"] += dy
+        assert pose == expected, (command, pose, expected)
+    assert new_path[-1] == path[-1]
+    print("Poses consistent")
@@ -0,0 +1,191 @@
+import json
+import logging
+import socket
+import threading
+import time
+
+from config import android_tcp_address, android_unix_path
+from Modules.AndroidFraming import MessageFramer
+
+"""
+> Scripted stand-in for the android tablet, connects to the TCP or unix socket transport of AndroidModule
+> Sends the same newline terminated JSON messages as the tablet, at a configurable rate, and records every
+> message received from the RPi with its arrival time
+"""
+class FakeTablet:
+    def __init__(self, kind:str = "unix", address = None):
+        self._kind = kind
+        if address is None:
+            address = android_unix_path if kind == "unix" else ("127.0.0.1", android_tcp_address[1])
+        self._address = address
+        self._sock = None
+        self._reader = None
+        self._received_event = threading.Condition()
+        self.received = []
+
+    def connect(self, timeout:float = 10.0) -> float:
+        """
+        Connects as soon as the RPi listens, returns the seconds spent waiting for it
+        """
+        start = time.monotonic()
+        while True:
+            family = socket.AF_UNIX if self._kind == "unix" else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(self._address)
+                break
+            except OSError:
+                sock.close()
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError(f"[FakeTablet]RPi not listening on {self._address}")
+                time.sleep(0.005)
+        if self._kind != "unix":
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+        self._reader = threading.Thread(target=self._read, args=(sock,), daemon=True)
+        self._reader.start()
+        return time.monotonic() - start
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+
+    def _read(self, sock):
+        framer = MessageFramer()
+        while True:
+            try:
+                data = sock.recv(4096)
+            except OSError:
+                break
+            if len(data) == 0:
+                break
+            frames = framer.feed(data)
+            with self._received_event:
+                now = time.monotonic()
+                self.received.extend((now, frame) for frame in frames)
+                self._received_event.notify_all()
+
+    def wait_for(self, text:str, after:int = 0, timeout:float = 5.0):
+        """
+        Waits for a received message containing text, starting at received[after], returns its arrival time
+        """
+        deadline = time.monotonic() + timeout
+        index = after
+        with self._received_event:
+            while True:
+                for arrived, frame in self.received[index:]:
+                    if text in frame:
+                        return arrived
+                index = len(self.received)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._received_event.wait(remaining):
+                    return None
+
+    def wait_for_count(self, count:int, timeout:float = 5.0):
+        """
+        Waits until count messages have been received, returns the arrival time of the last of them
+        """
+        deadline = time.monotonic() + timeout
+        with self._received_event:
+            while len(self.received) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._received_event.wait(remaining):
+                    return None
+            return self.received[count - 1][0] if count > 0 else time.monotonic()
+
+    def send_raw(self, data:bytes):
+        """
+        Writes bytes as they are, a recorded chunk may hold several or partial messages
+        """
+        self._sock.sendall(data)
+
+    def send(self, header:str, data):
+        self._sock.sendall((json.dumps({ "header": header, "data": data }) + "\n").encode("utf-8"))
+
+    def send_obstacles(self, obstacles:list):
+        self.send("ITEM_LOCATION", json.dumps(obstacles))
+
+    def start_movement(self):
+        self.send("START_MOVEMENT", "")
+
+    def control_burst(self, command:str, count:int, rate:float = 0):
+        """
+        Sends count manual ROBOT_CONTROL commands at rate messages per second, 0 sends them back to back
+        """
+        self.replay([{ "header": "ROBOT_CONTROL", "data": command }] * count, rate)
+
+    def replay(self, script:list, rate:float = 0):
+        """
+        Sends a list of {'header', 'data'} messages at rate messages per second, 0 sends them back to back
+        """
+        interval = 1 / rate if rate > 0 else 0
+        next_send = time.monotonic()
+        for message in script:
+            if interval > 0:
+                time.sleep(max(0.0, next_send - time.monotonic()))
+                next_send += interval
+            self.send(message["header"], message["data"])
+
+
+if __name__ == "__main__":
+    from Modules.AndroidModule import AndroidModule
+    from Modules.AndroidMessages import AndroidMessage, InfoMessage
+    from Modules.AndroidTransport import make_transport
+
+    logging.basicConfig(level=logging.WARNING)
+    count = 20000
+
+    for kind in ("unix", "tcp"):
+        android = AndroidModule(make_transport(kind))
+        decoded = []
+        done = threading.Event()
+
+        def serve(android:AndroidModule, decoded:list, done:threading.Event):
+            # Bound per transport, the thread of the previous transport is still waiting for a connection
+            # Same receive and reconnect handling as the android workers, the listening socket stays open
+            android.connect()
+            android.send(InfoMessage("Ready to start"))
+            while True:
+                try:
+                    AndroidMessage.decode(android.receive())
+                    decoded.append(time.monotonic())
+                    if len(decoded) == count:
+                        done.set()
+                except OSError:
+                    android.reconnect()
+                    android.send(InfoMessage("Ready to start"))
+
+        threading.Thread(target=serve, args=(android, decoded, done), daemon=True).start()
+        tablet = FakeTablet(kind)
+        tablet.connect()
+        tablet.wait_for("Ready to start")
+
+        start = time.monotonic()
+        tablet.control_burst("FW10", count)
+        done.wait(30)
+        elapsed = decoded[-1] - start
+        print(f"{kind:<4} {len(decoded)} messages in {elapsed * 1000:.0f}ms ({len(decoded) / elapsed:.0f} msg/s)")
+
+        # Reconnect time: drop the link and wait until the RPi greets the new connection
+        samples = []
+        attempts = 0
+        for _ in range(10):
+            tablet.close()
+            start = time.monotonic()
+            greeted = None
+            while greeted is None:
+                # Retry like the tablet when the RPi does not greet the connection
+                attempts += 1
+                tablet.close()
+                tablet = FakeTablet(kind)
+                tablet.connect()
+                greeted = tablet.wait_for("Ready to start", timeout=0.5)
+            samples.append((greeted - start) * 1000)
+        print(f"{kind:<4} reconnect {sum(samples) / len(samples):.1f}ms mean, {max(samples):.1f}ms max, " +
+              f"{attempts} attempts for {len(samples)} reconnects")
+        tablet.close()
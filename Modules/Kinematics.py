@@ -0,0 +1,122 @@
+import logging
+from functools import lru_cache
+
+import numpy as np
+
+from config import stm_command_prefixes
+from helper import HEADINGS, HEADING_VECTORS, STRAIGHT_MOVES, TURN_MOVES, TranslateCommand
+
+# Rows indexed by heading index (NORTH, EAST, SOUTH, WEST)
+_FORWARD = np.array([HEADING_VECTORS[h][0] for h in HEADINGS], dtype=np.int64)
+_RIGHT = np.array([HEADING_VECTORS[h][1] for h in HEADINGS], dtype=np.int64)
+_HEADING_VALUES = np.array(HEADINGS, dtype=np.int64)
+
+"""
+> Integrates a whole command list into the poses the robot passes through, with the same tables as TranslateCommand
+> Each move is encoded once into (cells right, cells forward, quarter turns) in the robot frame, the heading before
+> every move is a cumulative sum of the turns and the grid displacements are rotated and summed in one go
+> Only STM moves produce a pose, matching path[1:] of the /algo response, SNAP and FIN are skipped
+"""
+@lru_cache(maxsize=1024)
+def encode_move(command:str):
+    """
+    (cells right, cells forward, quarter turns) of an STM move, None for commands that are not moves
+    """
+    if not command.startswith(stm_command_prefixes):
+        return None
+    prefix = command[:2]
+    if len(command) >= 4 and prefix in STRAIGHT_MOVES:
+        return (0, STRAIGHT_MOVES[prefix] * (int(command[2:]) // 10), 0)
+    elif len(command) >= 4 and prefix in TURN_MOVES:
+        return TURN_MOVES[prefix]
+    # Moves without a grid displacement, as in TranslateCommand
+    return (0, 0, 0)
+
+def encode_commands(commands:list) -> np.ndarray:
+    """
+    Returns an (n, 3) array of (cells right, cells forward, quarter turns) for the n STM moves in commands
+    """
+    moves = [move for move in map(encode_move, commands) if move is not None]
+    return np.array(moves, dtype=np.int64).reshape(-1, 3)
+
+def integrate(commands:list, x:int = 1, y:int = 1, d:int = 0) -> np.ndarray:
+    """
+    Returns an (n + 1, 3) array of (x, y, d) poses, the start pose followed by the pose after each STM move
+    """
+    moves = encode_commands(commands)
+    start = HEADINGS.index(d)
+    headings = (start + np.concatenate(([0], np.cumsum(moves[:, 2])))) % len(HEADINGS)
+
+    # Heading before each move decides how its robot frame displacement maps onto the grid
+    before = headings[:-1]
+    steps = moves[:, 0:1] * _RIGHT[before] + moves[:, 1:2] * _FORWARD[before]
+
+    poses = np.empty((len(moves) + 1, 3), dtype=np.int64)
+    poses[0] = (x, y, d)
+    poses[1:, 0:2] = np.cumsum(steps, axis=0) + (x, y)
+    poses[1:, 2] = _HEADING_VALUES[headings[1:]]
+    return poses
+
+def check_path(commands:list, path:list) -> list:
+    """
+    Indexes into path of the poses that differ from the locally integrated trajectory, path includes the start pose
+    """
+    start = path[0]
+    poses = integrate(commands, start["x"], start["y"], start["d"])
+    if len(poses) != len(path):
+        logging.warning(f"[Kinematics]{len(poses) - 1} moves for {len(path) - 1} poses")
+        return list(range(min(len(poses), len(path)), max(len(poses), len(path))))
+    expected = np.array([(p["x"], p["y"], p["d"]) for p in path], dtype=np.int64)
+    return np.nonzero((poses != expected).any(axis=1))[0].tolist()
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    rng = random.Random(0)
+    command_pool = ["FW10", "FW30", "BW20", "FS10", "BS10", "FR00", "FL00", "BR00", "BL00", "SNAP1_C", "DT20"]
+
+    def translate(commands, x, y, d):
+        poses = [(x, y, d)]
+        for command in commands:
+            if not command.startswith(stm_command_prefixes):
+                continue
+            dx, dy, d = TranslateCommand(command, d)
+            x += dx
+            y += dy
+            poses.append((x, y, d))
+        return poses
+
+    # Every single move from every heading matches the scalar lookup
+    for heading in HEADINGS:
+        for command in command_pool:
+            assert integrate([command], 5, 5, heading).tolist() == [list(p) for p in translate([command], 5, 5, heading)], \
+                (command, heading)
+
+    # Turn tables are rotations of each other: four identical turns come back to the start pose
+    for heading in HEADINGS:
+        for prefix in TURN_MOVES:
+            assert integrate([prefix + "00"] * 4, 5, 5, heading)[-1].tolist() == [5, 5, heading], (prefix, heading)
+        for prefix, sign in STRAIGHT_MOVES.items():
+            opposite = next(p for p, s in STRAIGHT_MOVES.items() if s == -sign)
+            assert integrate([prefix + "40", opposite + "40"], 5, 5, heading)[-1].tolist() == [5, 5, heading]
+
+    # Random command lists match step by step integration from every heading
+    for _ in range(500):
+        commands = [rng.choice(command_pool) for _ in range(rng.randint(0, 40))]
+        heading = rng.choice(HEADINGS)
+        assert integrate(commands, 1, 1, heading).tolist() == [list(p) for p in translate(commands, 1, 1, heading)]
+    print("Kinematics consistent with TranslateCommand")
+
+    commands = [rng.choice(command_pool) for _ in range(200)]
+    iterations = 200
+    start = time.perf_counter()
+    for _ in range(iterations):
+        translate(commands, 1, 1, 0)
+    scalar = (time.perf_counter() - start) / iterations * 1e6
+    start = time.perf_counter()
+    for _ in range(iterations):
+        integrate(commands)
+    vectorized = (time.perf_counter() - start) / iterations * 1e6
+    print(f"{len(commands)} commands: TranslateCommand loop {scalar:.0f}us, integrate {vectorized:.0f}us")
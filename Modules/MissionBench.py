@@ -0,0 +1,200 @@
+import importlib
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import config
+from Modules.FakeTablet import FakeTablet
+from Modules.MockServer import MockServer
+from Modules.StmSimulator import StmSimulator
+
+MISSION_OBSTACLES = [
+    { "x": 5, "y": 10, "d": 2, "id": 1 },
+    { "x": 14, "y": 6, "d": 6, "id": 2 },
+    { "x": 10, "y": 16, "d": 4, "id": 3 },
+    { "x": 16, "y": 15, "d": 4, "id": 4 },
+]
+
+"""
+> Runs a complete week8 (task 1) or week9_singlethread (task 2) mission on a dev box and reports the wall time of every phase
+> The RPi program runs unchanged against the local stand-ins: StmSimulator on a pty, MockServer for the server,
+> FakeTablet on a unix socket and the file camera backend saving to a temporary folder, all wired in through the
+> config before the week module is imported
+> The RPi modules copy config values when imported, they are imported again for every launch so that each bench
+> in a process runs with its own overrides
+> Phase times are measured from the tablet, from the message that starts a phase to the message that ends it
+> python -m Modules.MissionBench week8 --compare runs the mission with worker processes and with the SingleProcess
+> thread runtime and prints both
+"""
+def override_config(**values):
+    """
+    Replaces config values, must run before the modules reading them are imported
+    """
+    for name, value in values.items():
+        if not hasattr(config, name):
+            raise AttributeError(f"config has no {name}")
+        setattr(config, name, value)
+
+def forget_config_readers():
+    """
+    Drops the imported RPi modules so that the next import reads the current config, the bench and the stand-ins
+    keep the modules they were imported with
+    """
+    root = os.path.dirname(os.path.abspath(config.__file__))
+    keep = { "config", __name__, "Modules.SessionReplay", "Modules.FakeTablet", "Modules.MockServer",
+             "Modules.StmSimulator" }
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if name not in keep and path is not None and os.path.abspath(path).startswith(root + os.sep):
+            del sys.modules[name]
+
+def launch(week:str, simulator:StmSimulator, mock:MockServer, single_process:bool = False, **config_values):
+    """
+    Starts the week program against the simulator, the mock server and a unix socket for the tablet,
+    returns its RpiModule
+    single_process runs the workers as threads of this process with the SingleProcess runtime of the week program
+    """
+    host, port = mock.start()
+    override_config(
+        serial_port=simulator.start(),
+        server_url=host,
+        server_port=str(port),
+        android_transport="unix",
+        camera_backend="file",
+        camera_save_folder=tempfile.mkdtemp(prefix="mission_images_"),
+        path_cache_file=None,
+        **config_values,
+    )
+    forget_config_readers()
+    week_module = importlib.import_module(week)
+    if single_process:
+        if not hasattr(week_module, "SingleProcess"):
+            raise ValueError(f"[MissionBench]{week} has no single process mode")
+        week_module.SingleProcess = True
+
+    rpi = week_module.RpiModule()
+    # The RPi program logs at DEBUG, only problems matter here
+    logging.getLogger().setLevel(logging.WARNING)
+
+    def start():
+        # The mission never drops the link, the android drop handling of EventLoop is not needed, only the thread
+        # runtime of the single process mode has to be run
+        if rpi.initialize() and single_process:
+            rpi.runtime.run()
+
+    threading.Thread(target=start, daemon=True).start()
+    return rpi
+
+def teardown(rpi):
+    """
+    Stops the workers of a launched week program
+    """
+    # The workers never exit on their own, the Manager goes last as they hold proxies to it and the log writer
+    # after them so that it sees every record
+    manager = getattr(rpi, "_manager", None)
+    log_pipeline = getattr(rpi, "log_pipeline", None)
+    keep = [manager._process if manager is not None else None, log_pipeline.process if log_pipeline is not None else None]
+    for process in mp.active_children():
+        if process not in keep:
+            process.kill()
+            process.join()
+    # A listening socket left open would take the tablet connection of the next launch
+    if hasattr(rpi, "android"):
+        rpi.android.disconnect()
+    # The Transport imported along with the week module made the pose
+    importlib.import_module("Modules.Transport").close_pose(rpi.robot_location)
+    if manager is not None:
+        manager.shutdown()
+    rpi.stop_logging()
+    shutil.rmtree(config.camera_save_folder, ignore_errors=True)
+
+def run_mission(week:str = "week8", speedup:float = 10, server_options:dict = None, timeout:float = 120,
+                single_process:bool = False, **config_values):
+    if week == "week9":
+        # week9 counts an ACK for the gyroscope reset it no longer sends and waits forever for its fifth ACK
+        raise ValueError("[MissionBench]week9 cannot finish a mission, bench week9_singlethread for task 2")
+    simulator = StmSimulator(speedup=speedup, seed=0)
+    mock = MockServer(seed=0, **(server_options or {}))
+    rpi = launch(week, simulator, mock, single_process, **config_values)
+
+    tablet = FakeTablet("unix")
+    phases = []
+
+    def phase(name:str, send, until:str):
+        index = len(tablet.received)
+        start = time.monotonic()
+        if send is not None:
+            send()
+        arrived = tablet.wait_for(until, after=index, timeout=timeout)
+        if arrived is None:
+            raise TimeoutError(f"[MissionBench]No '{until}' within {timeout}s in phase {name}")
+        phases.append((name, arrived - start))
+
+    mission_start = time.monotonic()
+    phase("connect", tablet.connect, "Ready to start")
+    if week == "week8":
+        phase("plan", lambda: tablet.send_obstacles(MISSION_OBSTACLES), "Robot is ready to move")
+        phase("start", tablet.start_movement, "Robot is ready")
+        phase("run", None, "Robot finished path queue")
+        phase("stitch", None, "Images stitched")
+    else:
+        phase("start", tablet.start_movement, "Processed Start Command")
+        phase("run", None, "Robot finished path queue")
+    total = time.monotonic() - mission_start
+
+    mode = "single process threads" if single_process else "worker processes"
+    print(f"{week} mission with {mode}, STM at {speedup}x speed")
+    for name, seconds in phases:
+        print(f"  {name:<12} {seconds * 1000:8.0f}ms")
+    print(f"  {'total':<12} {total * 1000:8.0f}ms")
+    print(f"  {len(simulator.received)} STM commands, server requests {mock.requests}")
+
+    teardown(rpi)
+    tablet.close()
+    simulator.stop()
+    mock.stop()
+    return phases
+
+def _mission_phases(results, week:str, single_process:bool, kwargs:dict):
+    phases = None
+    try:
+        phases = run_mission(week, single_process=single_process, **kwargs)
+    finally:
+        results.put(phases)
+
+def compare_runtimes(week:str = "week8", **kwargs):
+    """
+    Runs the mission with worker processes and with the single process thread runtime and prints the phase times
+    side by side, each mission runs in a process of its own as the worker threads cannot be stopped
+    """
+    results = mp.Queue()
+    runs = []
+    for single_process in (False, True):
+        process = mp.Process(target=_mission_phases, args=(results, week, single_process, kwargs))
+        process.start()
+        runs.append(results.get())
+        process.join()
+    if None in runs:
+        raise RuntimeError(f"[MissionBench]{week} mission failed, see the output above")
+
+    processes, threads = runs
+    print(f"{week} mission, worker processes against single process threads")
+    print(f"  {'phase':<20} {'processes':>10}   {'threads':>10}")
+    for (name, process_seconds), (_, thread_seconds) in zip(processes, threads):
+        print(f"  {name:<20} {process_seconds * 1000:8.0f}ms   {thread_seconds * 1000:8.0f}ms")
+    print(f"  {'total':<20} {sum(t for _, t in processes) * 1000:8.0f}ms   {sum(t for _, t in threads) * 1000:8.0f}ms")
+    return processes, threads
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != "--compare"]
+    week = args[0] if len(args) > 0 else "week8"
+    if "--compare" in sys.argv:
+        compare_runtimes(week)
+    else:
+        run_mission(week)
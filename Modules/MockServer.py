@@ -0,0 +1,161 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Modules.PathPlanner import PathPlanner
+
+# Median seconds and lognormal spread of the response time per endpoint
+DEFAULT_LATENCY = {
+    "/": (0.005, 0.2),
+    "/predict": (0.15, 0.3),
+    "/algo": (0.5, 0.3),
+    "/calibrate": (0.1, 0.3),
+    "/stitch": (0.8, 0.2),
+}
+
+"""
+> Local stand-in for the image recognition and path finding server, APIServer reaches it by setting server_url
+> and server_port to .address
+> Implements /, /predict, /algo, /calibrate and /stitch with the response fields the RPi reads, paths come from
+> the on-device PathPlanner so the plans can actually be driven
+> Every endpoint answers after a delay drawn from a lognormal distribution and fails with error_rates[endpoint],
+> /algo responses can be padded to test large payloads
+"""
+class MockServer:
+    def __init__(self, host:str = "127.0.0.1", port:int = 0, latency:dict = None, error_rates:dict = None,
+                 labels:tuple = ("Left", "Right"), algo_padding:int = 0, seed:int = None):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.error_rates = error_rates or {}
+        self.labels = labels
+        self.algo_padding = algo_padding
+        self.requests = { endpoint: 0 for endpoint in DEFAULT_LATENCY }
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._planner = PathPlanner()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> tuple:
+        return self._httpd.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logging.info(f"[MockServer]Serving on {self.address}")
+        return self.address
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _delay_and_fail(self, endpoint:str) -> bool:
+        """
+        Sleeps for the simulated processing time, returns True if the request should fail
+        """
+        median, spread = self.latency[endpoint]
+        with self._random_lock:
+            delay = median * self._random.lognormvariate(0, spread)
+            failed = self._random.random() < self.error_rates.get(endpoint, 0)
+        self.requests[endpoint] += 1
+        time.sleep(delay)
+        return failed
+
+    def _predict(self, body:bytes) -> dict:
+        # Captured images are named {time}_{obstacle id}_{position}.jpg
+        match = re.search(rb'filename="([^"]*)"', body)
+        name = match.group(1).decode("utf-8", errors="replace") if match is not None else ""
+        parts = name.split("_")
+        obstacle_id = parts[1] if len(parts) > 2 else "0"
+        with self._random_lock:
+            label = self._random.choice(self.labels)
+            image_id = self._random.randint(11, 40)
+        return { "image_label": label, "image_id": str(image_id), "obstacle_id": obstacle_id }
+
+    def _algo(self, body:bytes) -> dict:
+        data = json.loads(body)
+        path_data = self._planner.plan(data["obstacles"], data.get("robot_pos_x", 1), data.get("robot_pos_y", 1),
+                                       data.get("robot_dir", 0))
+        if path_data is None:
+            return { "data": None, "error": "No path found" }
+        if self.algo_padding > 0:
+            path_data["padding"] = "x" * self.algo_padding
+        return { "data": path_data, "error": None }
+
+    def _respond(self, endpoint:str, body:bytes) -> tuple:
+        """
+        Returns the status and the JSON payload or raw bytes answering a request to a known endpoint
+        """
+        if self._delay_and_fail(endpoint):
+            if endpoint == "/algo":
+                return 200, { "data": None, "error": "Simulated planning failure" }
+            return 503, { "error": "Simulated server failure" }
+
+        if endpoint == "/":
+            return 200, { "status": "ok" }
+        elif endpoint == "/predict":
+            return 200, self._predict(body)
+        elif endpoint == "/algo":
+            return 200, self._algo(body)
+        elif endpoint == "/calibrate":
+            return 200, { "Command": "FW10" }
+        return 200, b"stitched"
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logging.debug(f"[MockServer]{format % args}")
+
+            def _reply(self, status:int, payload):
+                body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/octet-stream" if isinstance(payload, bytes)
+                                 else "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                endpoint = self.path.split("?")[0]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if endpoint not in server.latency:
+                    self._reply(404, { "error": f"unknown endpoint {endpoint}" })
+                    return
+                self._reply(*server._respond(endpoint, body))
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import config
+
+    logging.basicConfig(level=logging.INFO)
+    mock = MockServer(seed=0)
+    host, port = mock.start()
+    config.server_url, config.server_port = host, str(port)
+    # APIServer reads the server address from config when imported
+    from Modules.APIServer import APIServer
+    from Modules.CameraModule import CapturedImage, FAKE_JPEG
+
+    server = APIServer()
+    obstacles = [{ "x": 5, "y": 10, "d": 2, "id": 1 }, { "x": 14, "y": 6, "d": 6, "id": 2 }]
+    print("status", server.server_status())
+    print("algo", server.query_path({ "obstacles": obstacles, "robot_pos_x": 1, "robot_pos_y": 1, "robot_dir": 0,
+                                      "retrying": False, "bull": False }))
+    print("predict", server.predict_image(CapturedImage("1_2_C", FAKE_JPEG, "./images/1_2_C.jpg")))
+    print("calibrate", server.calibrate_robot(CapturedImage("calibrate", FAKE_JPEG, "./images/calibrate.jpg")))
+    print("stitch", server.stitch_images())
+    print(server.latency_report())
+    mock.stop()
@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+
+from config import path_cache_file, path_cache_size, path_cache_version
+
+"""
+> LRU cache of the path data returned by /algo
+> Keyed by the canonicalized obstacle set (order independent), the robot start pose and the retrying/bull
+> flags, so a layout resent by android after a reconnect is planned instantly without the server
+> Entries are persisted to a json file on every insert, least recently used entries are evicted first
+> The planner version is part of the key and of the file, a file written for another version (or in the old headerless
+> format) is discarded on load so that a changed server planner is never bypassed by its old plans
+"""
+class PathCache:
+    def __init__(self, path:str = path_cache_file, max_entries:int = path_cache_size, version:int = path_cache_version):
+        self._path = path
+        self._max_entries = max_entries
+        self.version = version
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def key(self, obstacles:list, robot_pos_x, robot_pos_y, robot_dir, retrying, bull) -> str:
+        canonical = sorted((int(o["x"]), int(o["y"]), int(o["d"]), str(o["id"])) for o in obstacles)
+        return json.dumps([self.version, canonical, int(robot_pos_x), int(robot_pos_y), int(robot_dir), bool(retrying),
+                           bool(bull)], separators=(",", ":"))
+
+    def get(self, key:str):
+        path_data = self._entries.get(key)
+        if path_data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return path_data
+
+    def put(self, key:str, path_data:dict):
+        self._entries[key] = path_data
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        self.save()
+
+    def load(self):
+        """
+        Reloads the entries from disk, called by every worker process that plans paths
+        """
+        self._entries.clear()
+        if self._path is None or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r") as f:
+                saved = json.load(f)
+            if not isinstance(saved, dict) or saved.get("version") != self.version:
+                logging.info(f"[PathCache]Discarded {self._path}, it was not written for planner version {self.version}")
+                return
+            for key, path_data in saved["entries"][-self._max_entries:]:
+                self._entries[key] = path_data
+            logging.info(f"[PathCache]Loaded {len(self._entries)} cached paths from {self._path}")
+        except Exception as e:
+            logging.warning(f"[PathCache]Error when loading {self._path}: {e}")
+
+    def save(self):
+        if self._path is None:
+            return
+        try:
+            # Write to a temporary file first so that a crash never leaves a truncated cache behind
+            tmp_path = f"{self._path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({ "version": self.version, "entries": list(self._entries.items()) }, f)
+            os.replace(tmp_path, self._path)
+        except Exception as e:
+            logging.warning(f"[PathCache]Error when saving {self._path}: {e}")
+
+
+if __name__ == "__main__":
+    pass
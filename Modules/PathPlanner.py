@@ -0,0 +1,270 @@
+import heapq
+import logging
+import time
+
+from config import planner_grid_size, planner_clearance, planner_view_distance, planner_time_budget
+from helper import Direction, HEADINGS, HEADING_VECTORS, TranslateCommand
+
+# Moves the planner may use, with their cost in grid cells driven
+PLANNER_MOVES = { "FW10": 1, "BW10": 1, "FR00": 5, "FL00": 5, "BR00": 5, "BL00": 5 }
+# Extra cost of viewing an image from off its centre line
+OFF_CENTRE_PENALTY = 1
+
+def _build_moves():
+    """
+    Per heading, every move as (command, dx, dy, new heading, cost, cells swept relative to the start)
+    """
+    moves = {}
+    for heading in HEADINGS:
+        moves[heading] = []
+        for command, cost in PLANNER_MOVES.items():
+            dx, dy, new_heading = TranslateCommand(command, heading)
+            # A turning arc stays inside the box spanned by its start and end cells
+            swept = [(sx, sy) for sx in range(min(0, dx), max(0, dx) + 1)
+                     for sy in range(min(0, dy), max(0, dy) + 1) if (sx, sy) != (0, 0)]
+            moves[heading].append((command, dx, dy, new_heading, cost, swept))
+    return moves
+
+_MOVES = _build_moves()
+
+"""
+> Plans a task 1 route on the RPi in the same {'path', 'commands'} format as /algo, used when the server is slow
+> or unreachable
+> Every obstacle with an image gets candidate viewing poses planner_view_distance (or one more) cells in front
+> of its image facing it, shortest paths between poses come from a Dijkstra search over (x, y, heading) with the robot
+> move set and the visit order from a bitmask DP over the obstacles
+> The search tables and the visit order DP run until planner_time_budget runs out, after that the route is
+> completed greedily by always driving to the nearest obstacle left
+"""
+class PathPlanner:
+    def __init__(self, grid_size:int = planner_grid_size, time_budget:float = planner_time_budget):
+        self._size = grid_size
+        self._time_budget = time_budget
+
+    def _free_cells(self, obstacles:list) -> set:
+        """
+        Cells the robot centre can occupy, inside the arena and clear of every obstacle
+        """
+        free = set()
+        for x in range(1, self._size - 1):
+            for y in range(1, self._size - 1):
+                if all(max(abs(x - o["x"]), abs(y - o["y"])) >= planner_clearance for o in obstacles):
+                    free.add((x, y))
+        return free
+
+    def _view_poses(self, obstacle:dict, free:set) -> list:
+        """
+        (x, y, heading, penalty) poses from which the image of obstacle can be captured
+        """
+        if obstacle["d"] not in HEADING_VECTORS:
+            return []
+        facing, side = HEADING_VECTORS[obstacle["d"]]
+        # The robot looks back at the image
+        heading = HEADINGS[(HEADINGS.index(obstacle["d"]) + 2) % len(HEADINGS)]
+        poses = []
+        for distance in (planner_view_distance, planner_view_distance + 1):
+            for offset in (0, -1, 1):
+                x = obstacle["x"] + facing[0] * distance + side[0] * offset
+                y = obstacle["y"] + facing[1] * distance + side[1] * offset
+                if (x, y) in free:
+                    penalty = (distance - planner_view_distance) + (0 if offset == 0 else OFF_CENTRE_PENALTY)
+                    poses.append((x, y, heading, penalty))
+        return poses
+
+    def _search(self, source:tuple, free:set):
+        """
+        Dijkstra from source over every reachable (x, y, heading) state, returns the costs and the parent links
+        """
+        costs = { source: 0 }
+        parents = { source: None }
+        frontier = [(0, source)]
+        while len(frontier) > 0:
+            cost, state = heapq.heappop(frontier)
+            if cost > costs[state]:
+                continue
+            x, y, heading = state
+            for command, dx, dy, new_heading, move_cost, swept in _MOVES[heading]:
+                if not all((x + sx, y + sy) in free for sx, sy in swept):
+                    continue
+                next_state = (x + dx, y + dy, new_heading)
+                next_cost = cost + move_cost
+                if next_cost < costs.get(next_state, next_cost + 1):
+                    costs[next_state] = next_cost
+                    parents[next_state] = (state, command)
+                    heapq.heappush(frontier, (next_cost, next_state))
+        return costs, parents
+
+    @staticmethod
+    def _route(parents:dict, target:tuple) -> list:
+        """
+        Commands and end states from the search source to target
+        """
+        steps = []
+        state = target
+        while parents[state] is not None:
+            previous, command = parents[state]
+            steps.append((command, state))
+            state = previous
+        steps.reverse()
+        return steps
+
+    def plan(self, obstacles:list, robot_pos_x:int = 1, robot_pos_y:int = 1, robot_dir:int = Direction.NORTH.value):
+        """
+        Returns {'path', 'commands', 'skipped'} visiting as many obstacles as reachable, or None if none can be reached
+        skipped lists the ids of the obstacles left out of the route
+        """
+        deadline = time.monotonic() + self._time_budget
+        free = self._free_cells(obstacles)
+        start = (robot_pos_x, robot_pos_y, robot_dir)
+
+        targets = {}
+        for obstacle in obstacles:
+            poses = self._view_poses(obstacle, free)
+            if len(poses) > 0:
+                targets[obstacle["id"]] = poses
+        ids = list(targets)
+
+        # Search tables from the start and from every viewing pose, as far as the time budget allows
+        tables = { start: self._search(start, free) }
+        for poses in targets.values():
+            for x, y, heading, _ in poses:
+                if time.monotonic() > deadline:
+                    break
+                tables[(x, y, heading)] = self._search((x, y, heading), free)
+        exact = all((x, y, h) in tables for poses in targets.values() for x, y, h, _ in poses)
+
+        order = self._best_order(start, ids, targets, tables, deadline) if exact else None
+        if order is None:
+            exact = False
+            order = self._greedy_order(start, ids, targets, tables, free)
+        if len(order) == 0:
+            logging.warning("[PathPlanner]No obstacle can be reached")
+            return None
+
+        path = [{ "x": robot_pos_x, "y": robot_pos_y, "d": robot_dir }]
+        commands = []
+        state = start
+        for obstacle_id, pose in order:
+            for command, (x, y, heading) in self._route(tables[state][1], pose):
+                commands.append(command)
+                path.append({ "x": x, "y": y, "d": heading })
+            commands.append(f"SNAP{obstacle_id}_C")
+            state = pose
+        commands.append("FIN")
+
+        visited = set(obstacle_id for obstacle_id, _ in order)
+        skipped = [obstacle["id"] for obstacle in obstacles if obstacle["id"] not in visited]
+        if len(skipped) > 0:
+            logging.warning(f"[PathPlanner]Cannot reach obstacles {skipped}, planning without them")
+        logging.info(f"[PathPlanner]Planned {len(order)}/{len(obstacles)} obstacles in {len(commands)} commands " +
+                     f"({'exact' if exact else 'greedy'} order)")
+        return { "path": path, "commands": commands, "skipped": skipped }
+
+    @staticmethod
+    def _best_order(start:tuple, ids:list, targets:dict, tables:dict, deadline:float):
+        """
+        Bitmask DP over the obstacles, visits the most obstacles possible at the lowest cost, None if it does not
+        finish before deadline
+        """
+        # (mask, pose) -> (cost, previous (mask, pose), obstacle id)
+        best = { (0, start): (0, None, None) }
+        layer = [(0, start)]
+        final = (0, start)
+        for _ in range(len(ids)):
+            next_layer = {}
+            for mask, pose in layer:
+                if time.monotonic() > deadline:
+                    return None
+                cost = best[(mask, pose)][0]
+                pose_costs = tables[pose][0]
+                for index, obstacle_id in enumerate(ids):
+                    if mask & (1 << index):
+                        continue
+                    for x, y, heading, penalty in targets[obstacle_id]:
+                        target = (x, y, heading)
+                        if target not in pose_costs:
+                            continue
+                        key = (mask | (1 << index), target)
+                        total = cost + pose_costs[target] + penalty
+                        if key not in best or total < best[key][0]:
+                            best[key] = (total, (mask, pose), obstacle_id)
+                            next_layer[key] = True
+            if len(next_layer) == 0:
+                break
+            layer = list(next_layer)
+            final = min(layer, key=lambda key: best[key][0])
+
+        order = []
+        key = final
+        while best[key][1] is not None:
+            order.append((best[key][2], key[1]))
+            key = best[key][1]
+        order.reverse()
+        return order
+
+    def _greedy_order(self, start:tuple, ids:list, targets:dict, tables:dict, free:set) -> list:
+        """
+        Nearest obstacle first, used when the time budget ran out before every search table was built
+        """
+        order = []
+        remaining = set(ids)
+        pose = start
+        while len(remaining) > 0:
+            if pose not in tables:
+                tables[pose] = self._search(pose, free)
+            pose_costs = tables[pose][0]
+            reachable = [(pose_costs[(x, y, h)] + penalty, obstacle_id, (x, y, h))
+                         for obstacle_id in remaining for x, y, h, penalty in targets[obstacle_id]
+                         if (x, y, h) in pose_costs]
+            if len(reachable) == 0:
+                break
+            reachable.sort(key=lambda r: r[0])
+            for _, obstacle_id, target in reachable:
+                # Skip poses the robot cannot drive out of towards another obstacle, unless it is the last one
+                if len(remaining) == 1:
+                    break
+                if target not in tables:
+                    tables[target] = self._search(target, free)
+                if any((x, y, h) in tables[target][0] for other in remaining if other != obstacle_id
+                       for x, y, h, _ in targets[other]):
+                    break
+            order.append((obstacle_id, target))
+            remaining.discard(obstacle_id)
+            pose = target
+        return order
+
+
+if __name__ == "__main__":
+    from Modules.Kinematics import check_path
+
+    logging.basicConfig(level=logging.INFO)
+    planner = PathPlanner()
+
+    # (x, y, image direction) layouts with every image reachable from the start corner
+    layouts = [
+        [(6, 8, 6), (14, 3, 0), (15, 11, 2), (9, 13, 0), (10, 9, 6)],
+        [(6, 16, 2), (11, 7, 6), (14, 14, 4), (7, 9, 0), (16, 4, 0), (3, 10, 2), (10, 15, 2), (10, 3, 0)],
+    ]
+    for layout in layouts:
+        obstacles = [{ "x": x, "y": y, "d": d, "id": i + 1 } for i, (x, y, d) in enumerate(layout)]
+
+        start = time.perf_counter()
+        path_data = planner.plan(obstacles)
+        elapsed = time.perf_counter() - start
+        print(f"{len(obstacles)} obstacles: {len(path_data['commands'])} commands in {elapsed * 1000:.0f}ms")
+        assert check_path(path_data["commands"], path_data["path"]) == []
+        assert path_data["skipped"] == []
+        assert sorted(c for c in path_data["commands"] if c.startswith("SNAP")) == \
+            sorted(f"SNAP{o['id']}_C" for o in obstacles)
+
+    # A tiny budget falls back to the greedy order and still yields a complete, consistent plan
+    start = time.perf_counter()
+    path_data = PathPlanner(time_budget=0).plan(obstacles)
+    print(f"greedy: {len(path_data['commands'])} commands in {(time.perf_counter() - start) * 1000:.0f}ms")
+    assert check_path(path_data["commands"], path_data["path"]) == []
+    assert path_data["skipped"] == []
+
+    # An image facing the arena wall cannot be captured, the plan goes on without it
+    obstacles = [{ "x": x, "y": y, "d": d, "id": i + 1 } for i, (x, y, d) in enumerate(layouts[0] + [(18, 18, 0)])]
+    path_data = planner.plan(obstacles)
+    assert path_data["skipped"] == [len(obstacles)]
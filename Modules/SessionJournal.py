@@ -0,0 +1,116 @@
+import os
+import struct
+import time
+
+import config
+
+# Links recorded by the journal
+ANDROID = 1 # android socket, raw chunks read and frames written
+STM = 2     # STM serial port, frames written and lines read
+HTTP = 3    # APIServer requests, one record per request and per response
+CHANNEL_NAMES = { ANDROID: "android", STM: "stm", HTTP: "http" }
+
+# Direction of the bytes as seen by the RPi
+IN = 0
+OUT = 1
+
+# monotonic seconds, channel, direction, payload length, followed by the payload
+RECORD = struct.Struct("<dBBI")
+
+"""
+> Append-only journal of every byte crossing the android socket, the STM serial port and the server link
+> during a run, replayed against the fakes by Modules/SessionReplay.py
+> Each record is a 14 byte header and its payload appended with a single write to session_journal_file, so the
+> worker processes can share the file without locking, recording is off when session_journal_file is None
+> HTTP requests are recorded as '{method} {endpoint}\n' followed by the request body and responses as
+> '{endpoint} {status} {seconds}\n' followed by the response body, status 0 when the request failed
+"""
+class SessionJournal:
+    def __init__(self, path:str = None):
+        # Read when created rather than imported, a replay turns recording off after importing this module
+        self._path = path if path is not None else config.session_journal_file
+        self._fd = None
+        self._fd_pid = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._path is not None
+
+    def _open(self):
+        # One descriptor per process, a forked worker must not share the parent's file offset
+        if self._fd is None or self._fd_pid != os.getpid():
+            self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._fd_pid = os.getpid()
+        return self._fd
+
+    def record(self, channel:int, direction:int, data:bytes, timestamp:float = None):
+        if not self.enabled:
+            return
+        if timestamp is None:
+            timestamp = time.monotonic()
+        try:
+            os.write(self._open(), RECORD.pack(timestamp, channel, direction, len(data)) + data)
+        except OSError:
+            pass
+
+    def record_http(self, method:str, endpoint:str, sent_at:float, response):
+        """
+        Records a request made at sent_at and its requests.Response, None when the request failed
+        """
+        if not self.enabled:
+            return
+        body = response.request.body if response is not None else None
+        if body is None:
+            body = b""
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+        self.record(HTTP, OUT, f"{method} {endpoint}\n".encode("utf-8") + body, sent_at)
+        received_at = time.monotonic()
+        status, content = (response.status_code, response.content) if response is not None else (0, b"")
+        self.record(HTTP, IN, f"{endpoint} {status} {received_at - sent_at:.6f}\n".encode("utf-8") + content,
+                    received_at)
+
+
+def read_journal(path:str) -> list:
+    """
+    Returns the records of a journal as (monotonic seconds, channel, direction, payload) in time order,
+    a record cut short by a crash is dropped
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    records = []
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        timestamp, channel, direction, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break
+        records.append((timestamp, channel, direction, data[offset:offset + length]))
+        offset += length
+    # Records of different processes may be appended slightly out of order
+    records.sort(key=lambda record: record[0])
+    return records
+
+def summarize(path:str) -> str:
+    """
+    Duration, record count and bytes per channel and direction
+    """
+    records = read_journal(path)
+    if len(records) == 0:
+        return "empty journal"
+    lines = [f"{len(records)} records over {records[-1][0] - records[0][0]:.1f}s"]
+    for channel, name in CHANNEL_NAMES.items():
+        for direction, direction_name in ((IN, "in"), (OUT, "out")):
+            selected = [payload for _, c, d, payload in records if c == channel and d == direction]
+            if len(selected) > 0:
+                lines.append(f"  {name:<8} {direction_name:<4} {len(selected):>6} records {sum(map(len, selected)):>10} bytes")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2 and config.session_journal_file is None:
+        print("usage: python -m Modules.SessionJournal <journal file>")
+        sys.exit(1)
+    print(summarize(sys.argv[1] if len(sys.argv) > 1 else config.session_journal_file))
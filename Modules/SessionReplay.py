@@ -0,0 +1,203 @@
+import logging
+import os
+import sys
+import time
+from collections import deque
+
+from Modules.FakeTablet import FakeTablet
+from Modules.MissionBench import launch, teardown, run_mission
+from Modules.MockServer import MockServer
+from Modules.SessionJournal import read_journal, ANDROID, STM, HTTP, IN, OUT
+from Modules.StmSimulator import StmSimulator, DEFAULT_SECONDS
+from Modules.Tracer import percentile
+
+class Session:
+    """
+    Recorded session split per link into what the RPi received, each keyed to what it had sent before
+    """
+    def __init__(self, records:list):
+        # (android frames sent before the chunk, seconds since the last of them, chunk)
+        self.android_in = []
+        self.android_out_frames = 0
+        # seconds from a chunk received from android to the next frame sent to it
+        self.reactions = []
+        # (command, [(seconds after the command, line read), ...])
+        self.stm_commands = []
+        # endpoint: deque of (seconds, status, body) in the order the responses arrived
+        self.http_responses = {}
+        self.http_requests = 0
+        self.duration = 0.0
+        self.longest_out_gap = 0.0
+
+        start = None
+        last_out = records[0][0] if len(records) > 0 else 0.0
+        unanswered = []
+        command_sent = 0.0
+        for timestamp, channel, direction, payload in records:
+            if channel == ANDROID and direction == OUT:
+                self.android_out_frames += payload.count(b"\n")
+                self.longest_out_gap = max(self.longest_out_gap, timestamp - last_out)
+                last_out = timestamp
+                self.reactions.extend(timestamp - received for received in unanswered)
+                unanswered = []
+                if start is not None:
+                    self.duration = timestamp - start
+            elif channel == ANDROID and direction == IN:
+                self.android_in.append((self.android_out_frames, timestamp - last_out, payload))
+                unanswered.append(timestamp)
+                if start is None:
+                    start = timestamp
+            elif channel == STM and direction == OUT:
+                self.stm_commands.append((payload.decode("utf-8", errors="replace").strip(), []))
+                command_sent = timestamp
+            elif channel == STM and direction == IN and len(self.stm_commands) > 0:
+                # Lines read before the first command are noise from the STM booting
+                self.stm_commands[-1][1].append((timestamp - command_sent, payload))
+            elif channel == HTTP and direction == IN:
+                header, _, body = payload.partition(b"\n")
+                endpoint, status, seconds = header.decode("utf-8").split(" ")
+                self.http_responses.setdefault(endpoint, deque()).append((float(seconds), int(status), body))
+                self.http_requests += 1
+
+
+class ReplayStm(StmSimulator):
+    """
+    Answers every command with the lines the STM sent after the same command in the recording
+    """
+    def __init__(self, commands:list, speed:float):
+        super().__init__()
+        self._commands = commands
+        self._speed = speed
+        self.divergences = 0
+
+    def _execute(self, command:str):
+        arrived = time.monotonic()
+        index = len(self.received) - 1
+        if index < len(self._commands):
+            recorded, lines = self._commands[index]
+        else:
+            recorded, lines = None, [(DEFAULT_SECONDS, b"ACK\n")]
+        if recorded != command:
+            self.divergences += 1
+            logging.warning(f"[ReplayStm]Command {index} is {command}, {recorded} in the recording")
+
+        for seconds, line in lines:
+            if self._speed > 0:
+                time.sleep(max(0.0, arrived + seconds / self._speed - time.monotonic()))
+            try:
+                os.write(self._master, line)
+            except (OSError, TypeError):
+                # Closed by stop
+                return
+            self.acks_sent += 1
+
+
+class ReplayServer(MockServer):
+    """
+    Answers every request with the next recorded response of its endpoint, after the recorded latency
+    """
+    def __init__(self, responses:dict, speed:float):
+        super().__init__(seed=0)
+        self._responses = responses
+        self._speed = speed
+        self.divergences = 0
+
+    def _respond(self, endpoint:str, body:bytes) -> tuple:
+        try:
+            seconds, status, payload = self._responses[endpoint].popleft()
+        except (KeyError, IndexError):
+            # More requests than recorded, the control flow under test changed
+            self.divergences += 1
+            logging.warning(f"[ReplayServer]No recorded response left for {endpoint}")
+            return super()._respond(endpoint, body)
+        self.requests[endpoint] += 1
+        if self._speed > 0:
+            time.sleep(seconds / self._speed)
+        # A request that failed in the recording fails again
+        return (status if status != 0 else 503), payload
+
+
+"""
+> Replays a session journal recorded with session_journal_file through the RPi program, to benchmark a change
+> of the week8/week9 control flow against a real mission
+> FakeTablet sends the recorded android chunks, each once the RPi has sent as many frames as it had before the chunk
+> in the recording and after the same think time, ReplayStm and ReplayServer answer the STM commands and server
+> requests with the recorded replies and latencies
+> speed scales every recorded delay, 0 replays as fast as possible
+> Divergences count commands and requests that differ from the recording, they should be 0 for a change that only
+> affects timing
+"""
+def replay(path:str, week:str = "week8", speed:float = 1.0, timeout:float = 60, **config_values):
+    session = Session(read_journal(path))
+    simulator = ReplayStm(session.stm_commands, speed)
+    server = ReplayServer(session.http_responses, speed)
+    # Recording the replay into the journal being replayed would corrupt it
+    config_values.setdefault("session_journal_file", None)
+    rpi = launch(week, simulator, server, **config_values)
+
+    tablet = FakeTablet("unix")
+    tablet.connect()
+    sent = []
+    for frames_before, think_time, chunk in session.android_in:
+        ready = tablet.wait_for_count(frames_before, timeout)
+        if ready is None:
+            logging.warning(f"[SessionReplay]RPi sent {len(tablet.received)} of the {frames_before} frames " +
+                            "sent before the next chunk in the recording")
+            ready = time.monotonic()
+        if speed > 0:
+            time.sleep(max(0.0, ready + think_time / speed - time.monotonic()))
+        sent.append((time.monotonic(), len(tablet.received)))
+        tablet.send_raw(chunk)
+    # Done once the RPi sent as many frames as recorded, or went quiet for longer than any gap of the recording as
+    # location updates may be coalesced differently
+    quiet = (session.longest_out_gap / speed if speed > 0 else 0) + 1.0
+    deadline = time.monotonic() + timeout
+    finished = None
+    while len(tablet.received) < session.android_out_frames and time.monotonic() < deadline:
+        if tablet.wait_for_count(len(tablet.received) + 1, quiet) is None:
+            break
+    if len(tablet.received) > 0 and time.monotonic() < deadline:
+        finished = tablet.received[-1][0]
+
+    reactions = []
+    for sent_at, index in sent:
+        for arrived, _ in tablet.received[index:]:
+            if arrived >= sent_at:
+                reactions.append(arrived - sent_at)
+                break
+    duration = (finished if finished is not None else time.monotonic()) - sent[0][0] if len(sent) > 0 else 0.0
+
+    def reaction_report(samples:list) -> str:
+        if len(samples) == 0:
+            return "-"
+        samples = sorted(samples)
+        return f"p50 {percentile(samples, 0.5) * 1000:.0f}ms p95 {percentile(samples, 0.95) * 1000:.0f}ms " + \
+               f"max {samples[-1] * 1000:.0f}ms"
+
+    print(f"{week} replay of {path} at " + (f"{speed}x" if speed > 0 else "full speed"))
+    print(f"  {'':<10} {'duration':>9} {'frames':>7} {'stm':>5} {'http':>5}  android reaction")
+    print(f"  {'recorded':<10} {session.duration:>8.2f}s {session.android_out_frames:>7} " +
+          f"{len(session.stm_commands):>5} {session.http_requests:>5}  " +
+          reaction_report(session.reactions))
+    print(f"  {'replayed':<10} {duration:>8.2f}s {len(tablet.received):>7} {len(simulator.received):>5} " +
+          f"{sum(server.requests.values()):>5}  {reaction_report(reactions)}")
+    print(f"  divergences: {simulator.divergences} STM, {server.divergences} server" +
+          ("" if finished is not None else f", replay did not finish within {timeout}s"))
+
+    teardown(rpi)
+    tablet.close()
+    simulator.stop()
+    server.stop()
+    return duration
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m Modules.SessionReplay <journal file> [week] [speed, 0 for full speed]\n" +
+              "       python -m Modules.SessionReplay record <journal file> [week]")
+        sys.exit(1)
+    if sys.argv[1] == "record":
+        # A simulated mission recorded like a real run, to try the replay on a dev box
+        run_mission(sys.argv[3] if len(sys.argv) > 3 else "week8", session_journal_file=sys.argv[2])
+    else:
+        replay(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "week8", float(sys.argv[3]) if len(sys.argv) > 3 else 1.0)
@@ -1,15 +1,25 @@
 import logging
+import multiprocessing as mp
 import serial
+import threading
+import time
+from collections import deque
 
-from config import serial_port, baud_rate, stm_message_len
+from config import serial_port, baud_rate, stm_message_len, stm_ack_timeout, stm_ack_timeouts, stm_ack_margin, \
+    stm_command_overhead, stm_straight_speed, stm_slow_straight_speed, stm_max_straight
+from helper import LatencyHistogram, SharedLatencyHistogram
+from Modules.SessionJournal import SessionJournal, STM, IN, OUT
 
 class StmModule:
-    def __init__(self):
+    def __init__(self, port:str = serial_port):
         self.serial = None
+        # Overridden with the pty of Modules/StmSimulator.py off the robot
+        self.port = port
+        self.journal = SessionJournal()
 
     def connect(self):
         try:
-            self.serial = serial.Serial(serial_port, baud_rate, timeout=2.0)
+            self.serial = serial.Serial(self.port, baud_rate, timeout=2.0)
             logging.info("[StmModule]Connected to STM")
             return True
         except Exception as e:
@@ -32,13 +42,310 @@ class StmModule:
                 msg += ' '
         raw_byte = (msg).encode("utf-8")
         self.serial.write(raw_byte)
-        logging.debug(f"[StmModule]Sent message to STM: {msg} : {raw_byte}")
+        self.journal.record(STM, OUT, raw_byte)
+        logging.debug("[StmModule]Sent message to STM: %s : %s", msg, raw_byte)
 
     def receive(self):
-        msg = self.serial.readline().decode("utf-8")
+        # Line noise must not break the read loop, undecodable bytes are replaced
+        line = self.serial.readline()
+        msg = line.decode("utf-8", errors="replace")
         if len(msg) > 0:
-            logging.debug(f"[StmModule]Received message from STM: {msg}")
+            self.journal.record(STM, IN, line)
+            logging.debug("[StmModule]Received message from STM: %s", msg)
         return msg
 
+
+# Estimated speed in cm/s of the straight moves, their ACK deadline follows from the distance
+_STRAIGHT_SPEEDS = { "FW": stm_straight_speed, "BW": stm_straight_speed,
+                     "FS": stm_slow_straight_speed, "BS": stm_slow_straight_speed }
+
+def ack_timeout(command:str) -> float:
+    """
+    Seconds to wait for the ACK of a command, stm_ack_margin times the estimated duration of a straight move and
+    per command prefix otherwise
+    """
+    prefix = command[:2]
+    speed = _STRAIGHT_SPEEDS.get(prefix)
+    if speed is None:
+        return stm_ack_timeouts.get(prefix, stm_ack_timeout)
+    try:
+        distance = int(command[2:])
+    except ValueError:
+        distance = stm_max_straight
+    return stm_ack_margin * (stm_command_overhead + distance / speed)
+
+
+class AckWaiter:
+    def __init__(self, command:str):
+        self.command = command
+        self.event = threading.Event()
+        self.received_at = None
+
+
+"""
+> Reads the STM serial line on a dedicated thread, every line is parsed once and an ACK completes the waiter
+> of the oldest command in flight, so a waiting worker wakes as soon as the line arrives instead of after the
+> next serial timeout
+> A command whose waiter runs past its deadline is treated as lost, the STM ACKs carry no sequence so a late ACK
+> cannot be told apart from the ACK of the next command, a late ACK arriving with no command in flight is dropped
+"""
+class StmReader:
+    def __init__(self, stm:StmModule):
+        self._stm = stm
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+        self.dispatch_latency = LatencyHistogram()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops reading once the current serial read returns, call before disconnecting the STM
+        """
+        self._stopped.set()
+
+    def _read(self):
+        while not self._stopped.is_set():
+            try:
+                msg = self._stm.receive()
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                logging.warning(f"[StmReader]Error when reading from STM: {e}")
+                time.sleep(0.1)
+                continue
+
+            if not "ACK" in msg:
+                continue
+
+            with self._lock:
+                waiter = self._pending.popleft() if len(self._pending) > 0 else None
+            if waiter is None:
+                logging.warning("[StmReader]ACK received with no command in flight")
+                continue
+            waiter.received_at = time.perf_counter()
+            waiter.event.set()
+
+    def send(self, command:str) -> AckWaiter:
+        waiter = AckWaiter(command)
+        with self._lock:
+            self._pending.append(waiter)
+        self._stm.send(command)
+        return waiter
+
+    def wait(self, waiter:AckWaiter, timeout:float = None) -> bool:
+        if timeout is None:
+            timeout = ack_timeout(waiter.command)
+        if waiter.event.wait(timeout):
+            self.dispatch_latency.record((time.perf_counter() - waiter.received_at) * 1000)
+            return True
+
+        with self._lock:
+            expired = waiter in self._pending
+            if expired:
+                self._pending.remove(waiter)
+        if not expired:
+            # ACKed between the timeout and taking the lock
+            waiter.event.wait()
+            self.dispatch_latency.record((time.perf_counter() - waiter.received_at) * 1000)
+            return True
+        logging.warning(f"[StmReader]No ACK for {waiter.command} within {timeout}s, assuming it was lost")
+        return False
+
+
+"""
+> Bounds the number of STM commands in flight for the pipelined command mode
+> The STM executes the commands it has buffered in order and ACKs each one, so the next move can already be on the
+> wire while the current one runs and ACKs are matched to commands by their sequence in the window
+> sync is the module creating the semaphore, threading or a multiprocessing Manager, so the window can be shared
+> between the command worker sending and the STM worker receiving the ACKs
+"""
+class CommandWindow:
+    def __init__(self, sync, size:int):
+        self.size = size
+        self._slots = sync.BoundedSemaphore(size)
+
+    def acquire(self, timeout:float) -> bool:
+        """
+        Takes a slot for a new command, False when no command in flight was ACKed within timeout, the STM is then
+        not keeping up and nothing more must be sent to it
+        """
+        if self._slots.acquire(timeout=timeout):
+            return True
+        logging.warning(f"[CommandWindow]No ACK within {timeout}s")
+        return False
+
+    def release(self):
+        try:
+            self._slots.release()
+        except ValueError:
+            # Late ACK of a command whose slot was already reclaimed
+            logging.warning("[CommandWindow]ACK received with no command in flight")
+
+    def drain(self, timeout:float) -> bool:
+        """
+        Waits up to timeout until every command in flight has been ACKed, the robot is stationary afterwards
+        """
+        deadline = time.monotonic() + timeout
+        acquired = 0
+        while acquired < self.size and self.acquire(max(0.0, deadline - time.monotonic())):
+            acquired += 1
+        for _ in range(acquired):
+            self.release()
+        return acquired == self.size
+
+    def reset(self):
+        """
+        Frees the slots of the commands in flight once their ACKs are given up on
+        """
+        while True:
+            try:
+                self._slots.release()
+            except ValueError:
+                return
+
+
+"""
+> Send to ACK latency of the STM commands, kept in shared memory so that the command worker stamping the sends
+> and the STM worker receiving the ACKs measure it without a Manager round trip per command
+> ACKs close the commands in the order they were sent, the send times are a ring of the commands in flight and the
+> latencies go to a fixed bucket histogram so nothing grows over a run
+> The ring also holds the ACK deadline of every command in flight, a buffered command only starts once the one
+> before it is done so its deadline runs from the deadline of that command at the latest
+> The rings and both counters share one lock, reset() from the command worker can run while an ACK is handled
+> Created before the workers are forked
+"""
+class CommandTimer:
+    def __init__(self, in_flight:int):
+        self._sent_at = mp.Array("d", in_flight)
+        self._lock = self._sent_at.get_lock()
+        self._deadline = mp.Array("d", in_flight, lock=self._lock)
+        self._sent = mp.Value("Q", 0, lock=self._lock)
+        self._acked = mp.Value("Q", 0, lock=self._lock)
+        self.latency = SharedLatencyHistogram()
+
+    def sent(self, command:str):
+        now = time.monotonic()
+        with self._lock:
+            sent, size = self._sent.value, len(self._sent_at)
+            start = now
+            if sent > self._acked.value:
+                start = max(now, self._deadline[(sent - 1) % size])
+            self._sent_at[sent % size] = now
+            self._deadline[sent % size] = start + ack_timeout(command)
+            self._sent.value = sent + 1
+
+    def ack_wait(self, newest:bool = False) -> float:
+        """
+        Seconds left until the ACK of the oldest command in flight is overdue, of the newest one with newest set
+        None when no command is in flight
+        """
+        with self._lock:
+            sent, acked = self._sent.value, self._acked.value
+            if acked >= sent:
+                return None
+            index = sent - 1 if newest else max(acked, sent - len(self._sent_at))
+            deadline = self._deadline[index % len(self._sent_at)]
+        return max(0.0, deadline - time.monotonic())
+
+    def acked(self):
+        now = time.monotonic()
+        with self._lock:
+            sent, acked = self._sent.value, self._acked.value
+            if acked >= sent:
+                return
+            # Commands pushed out of the ring had their ACK lost
+            acked = max(acked, sent - len(self._sent_at))
+            latency = now - self._sent_at[acked % len(self._sent_at)]
+            self._acked.value = acked + 1
+        self.latency.record(latency * 1000)
+
+    def reset(self):
+        """
+        Forgets the commands in flight, their ACKs are not coming
+        """
+        with self._lock:
+            self._acked.value = self._sent.value
+
+
 if __name__ == "__main__":
-    pass
+    import queue
+    from helper import summarize_latencies
+
+    # Serial transit time each way and STM execution time of a move
+    transit = 0.002
+    move_time = 0.02
+    commands = 100
+
+    class FakeStm:
+        """
+        Executes the received commands one after the other and ACKs each, like the STM firmware
+        """
+        def __init__(self, drop_acks:int = 0):
+            self._commands = queue.Queue()
+            self._acks = queue.Queue()
+            # ACKs of the first drop_acks commands are lost on the line
+            self._drop_acks = drop_acks
+            threading.Thread(target=self._run, daemon=True).start()
+
+        def _run(self):
+            while True:
+                self._commands.get()
+                time.sleep(move_time)
+                if self._drop_acks > 0:
+                    self._drop_acks -= 1
+                    continue
+                threading.Timer(transit, self._acks.put, args=("ACK\n",)).start()
+
+        def send(self, msg:str):
+            threading.Timer(transit, self._commands.put, args=(msg,)).start()
+
+        def receive(self):
+            return self._acks.get()
+
+    def run(window_size:int):
+        stm = FakeStm()
+        window = CommandWindow(threading, window_size)
+        sent_times = deque()
+        latencies = []
+
+        def receive_acks():
+            for _ in range(commands):
+                stm.receive()
+                latencies.append(time.perf_counter() - sent_times.popleft())
+                window.release()
+
+        acks = threading.Thread(target=receive_acks)
+        start = time.perf_counter()
+        acks.start()
+        for i in range(commands):
+            window.acquire(stm_ack_timeout)
+            sent_times.append(time.perf_counter())
+            stm.send("FW10")
+        acks.join()
+        elapsed = time.perf_counter() - start
+        print(f"window {window_size}: {commands / elapsed:5.1f} commands/s, {elapsed / commands * 1000:5.1f}ms per command, " +
+              f"send to ACK {summarize_latencies(latencies)}")
+
+    def check_lost_ack():
+        """
+        A lost ACK only fails its own command, the commands after it are ACKed as usual
+        """
+        reader = StmReader(FakeStm(drop_acks=1))
+        reader.start()
+        results = [reader.wait(reader.send("FW10"), timeout=0.5) for _ in range(6)]
+        reader.stop()
+        assert results == [False] + [True] * 5, results
+        print(f"lost ACK: {results.count(True)}/{len(results)} commands ACKed, only the lost one failed")
+
+    print(f"{commands} moves of {move_time * 1000:.0f}ms, {transit * 1000:.0f}ms serial transit each way")
+    for window_size in (1, 2, 4):
+        run(window_size)
+    check_lost_ack()
@@ -0,0 +1,182 @@
+import logging
+import os
+import random
+import threading
+import time
+import tty
+
+from config import stm_message_len
+
+# Seconds the simulated robot needs for a command
+STRAIGHT_SECONDS_PER_CM = 0.005
+TURN_SECONDS = { "FR": 0.3, "FL": 0.3, "BR": 0.3, "BL": 0.3, "TL": 0.2, "TR": 0.2 }
+# DT drives until the obstacle is the given distance away, the distance left is unknown so a fixed approach is assumed
+DT_APPROACH_CM = 60
+DEFAULT_SECONDS = 0.05
+GARBAGE_LINES = (b"\x00\xff\x13\n", b"ACX\n", b"DBG gyro=0.12\n")
+
+"""
+> Stands in for the STM on a dev box, StmModule connects to .port like to the real serial adapter
+> A pseudo terminal pair is created, commands arrive as the stm_message_len byte frames written by StmModule.send
+> and are executed one after the other like on the robot, each is answered with an ACK line once its simulated
+> duration has passed
+> Durations depend on the command (straight distance, turn type, DT approach) and can be disturbed with jitter,
+> dropped ACKs and garbage lines to exercise the ACK handling of the command workers
+"""
+class StmSimulator:
+    def __init__(self, speedup:float = 1.0, jitter:float = 0.0, drop_rate:float = 0.0, garbage_rate:float = 0.0,
+                 seed:int = None):
+        self.speedup = speedup
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.garbage_rate = garbage_rate
+        self._random = random.Random(seed)
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self.port = None
+        self.received = []
+        self.acks_sent = 0
+        self.acks_dropped = 0
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        # No echo or line editing, the STM side sees the raw frames
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logging.info(f"[StmSimulator]Simulated STM on {self.port}")
+        return self.port
+
+    def stop(self):
+        for fd in (self._slave, self._master):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._master = None
+        self._slave = None
+
+    def duration(self, command:str) -> float:
+        prefix = command[:2]
+        try:
+            value = int(command[2:])
+        except ValueError:
+            value = 0
+        if prefix in ("FW", "BW", "FS", "BS"):
+            seconds = value * STRAIGHT_SECONDS_PER_CM
+        elif prefix in TURN_SECONDS:
+            seconds = TURN_SECONDS[prefix]
+        elif prefix == "DT":
+            seconds = max(DT_APPROACH_CM - value, 0) * STRAIGHT_SECONDS_PER_CM
+        else:
+            seconds = DEFAULT_SECONDS
+        if self.jitter > 0:
+            seconds *= max(0.0, 1 + self._random.uniform(-self.jitter, self.jitter))
+        return seconds / self.speedup
+
+    def _run(self):
+        buffer = b""
+        while True:
+            try:
+                data = os.read(self._master, 64)
+            except OSError:
+                break
+            if len(data) == 0:
+                break
+            buffer += data
+            while len(buffer) >= stm_message_len:
+                frame, buffer = buffer[:stm_message_len], buffer[stm_message_len:]
+                command = frame.decode("utf-8", errors="replace").strip()
+                self.received.append(command)
+                self._execute(command)
+
+    def _execute(self, command:str):
+        time.sleep(self.duration(command))
+        try:
+            if self._random.random() < self.garbage_rate:
+                os.write(self._master, self._random.choice(GARBAGE_LINES))
+            if self._random.random() < self.drop_rate:
+                self.acks_dropped += 1
+                logging.debug(f"[StmSimulator]Dropped ACK for {command}")
+                return
+            os.write(self._master, b"ACK\n")
+            self.acks_sent += 1
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    from config import stm_ack_timeout
+    from helper import summarize_latencies
+    from Modules.StmModule import StmModule, StmReader, CommandWindow
+
+    commands = ["FW10", "FW20", "FR00", "BW10", "FL00", "FW30", "DT20", "BR00"] * 25
+
+    def stop_and_wait(stm):
+        """
+        One command in flight, as stm_handle_command_list does
+        """
+        reader = StmReader(stm)
+        reader.start()
+        latencies = []
+        for command in commands:
+            start = time.perf_counter()
+            if reader.wait(reader.send(command), timeout=1.0):
+                latencies.append(time.perf_counter() - start)
+        reader.stop()
+        return latencies
+
+    def pipelined(stm, window_size):
+        """
+        Up to window_size commands in flight, as handle_commands does with PipelineSTM
+        """
+        window = CommandWindow(threading, window_size)
+        sent_times = []
+        latencies = []
+
+        def receive_acks():
+            while len(latencies) < len(commands):
+                msg = stm.receive()
+                if "ACK" in msg:
+                    latencies.append(time.perf_counter() - sent_times[len(latencies)])
+                    window.release()
+
+        acks = threading.Thread(target=receive_acks, daemon=True)
+        acks.start()
+        for command in commands:
+            window.acquire(stm_ack_timeout)
+            sent_times.append(time.perf_counter())
+            stm.send(command)
+        acks.join(30)
+        return latencies
+
+    logging.basicConfig(level=logging.WARNING)
+    runs = [("stop and wait", stop_and_wait)] + \
+        [(f"window {size}", lambda stm, size=size: pipelined(stm, size)) for size in (2, 4)]
+    for name, run in runs:
+        simulator = StmSimulator(speedup=10, jitter=0.2, seed=0)
+        stm = StmModule(simulator.start())
+        stm.connect()
+        start = time.perf_counter()
+        latencies = run(stm)
+        elapsed = time.perf_counter() - start
+        stm.disconnect()
+        simulator.stop()
+        print(f"{name:<14} {len(commands) / elapsed:6.1f} commands/s, send to ACK {summarize_latencies(latencies)}")
+
+    # Lost ACKs and garbage lines must only cost their deadline, never wedge the reader
+    simulator = StmSimulator(speedup=10, drop_rate=0.05, garbage_rate=0.05, seed=1)
+    stm = StmModule(simulator.start())
+    stm.connect()
+    start = time.perf_counter()
+    latencies = stop_and_wait(stm)
+    elapsed = time.perf_counter() - start
+    timeouts = len(commands) - len(latencies)
+    print(f"faulty link    {len(commands) / elapsed:6.1f} commands/s, {len(latencies)}/{len(commands)} ACKed, " +
+          f"{simulator.acks_dropped} dropped, {timeouts} timed out, send to ACK {summarize_latencies(latencies)}")
+    assert timeouts == simulator.acks_dropped, "a timeout other than a dropped ACK"
+    stm.disconnect()
+    simulator.stop()
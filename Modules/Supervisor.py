@@ -0,0 +1,244 @@
+import logging
+import multiprocessing as mp
+import os
+import threading
+import time
+from multiprocessing.connection import wait
+
+from config import supervisor_restart_backoff, supervisor_max_backoff, supervisor_stable_seconds
+
+# Seconds between checks for the first heartbeat of a restarted worker
+RECOVERY_POLL = 0.005
+
+class SupervisedWorker:
+    """
+    Process of a supervised worker and its restart bookkeeping
+    """
+    def __init__(self, name:str, process, spawn, stall_timeout:float):
+        self.name = name
+        self.process = process
+        self.spawn = spawn
+        self.stall_timeout = stall_timeout
+        self.started_at = time.monotonic()
+        self.crashes_in_row = 0
+        self.cause = None
+        self.detected_at = None
+        self.restart_at = None
+
+
+"""
+> Keeps the worker processes of a week program running, replacing the once a second is_alive() polling
+> A worker exit is noticed as soon as it happens by waiting on the process sentinels with
+> multiprocessing.connection.wait, a worker that beats its heartbeat in its loop is also restarted when it stays
+> silent for longer than its stall timeout
+> A worker crashing again within supervisor_stable_seconds of its restart waits twice as long as the previous time
+> before the next restart, from supervisor_restart_backoff up to supervisor_max_backoff
+> Recovery time is measured from the detection to the first heartbeat of the new process
+> Created before the workers are forked, the heartbeats live in shared memory
+"""
+class Supervisor:
+    def __init__(self, names:tuple):
+        self._index = { name: i for i, name in enumerate(names) }
+        self._heartbeats = mp.RawArray("d", len(names))
+        self._first_beats = mp.RawArray("d", len(names))
+        self._beat_pid = None
+        self._workers = {}
+        self._lock = threading.Lock()
+        # Wakes the watch loop when the set of processes changes
+        self._wake_reader, self._wake_writer = mp.Pipe(duplex=False)
+        self._thread = None
+        self._stopped = False
+        self.recoveries = []
+
+    def heartbeat(self, name:str):
+        """
+        Called by a worker from its loop
+        """
+        now = time.monotonic()
+        index = self._index[name]
+        if self._beat_pid != os.getpid():
+            # First beat of this process, marks the end of a recovery
+            self._beat_pid = os.getpid()
+            self._first_beats[index] = now
+        self._heartbeats[index] = now
+
+    def add(self, name:str, process, spawn, stall_timeout:float = None):
+        """
+        Supervises a started worker, spawn starts a new one and returns its Process
+        """
+        with self._lock:
+            self._workers[name] = SupervisedWorker(name, process, spawn, stall_timeout)
+        self._wake()
+
+    def start(self):
+        """
+        Watches the workers from a daemon thread
+        """
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops restarting the workers, called before they are stopped on terminate
+        """
+        with self._lock:
+            self._stopped = True
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        while not self._stopped:
+            self.watch()
+
+    def _wake(self):
+        self._wake_writer.send_bytes(b"")
+
+    def watch(self):
+        """
+        Blocks until a worker exits, stalls, is due for a restart or the workers change, and handles it
+        """
+        with self._lock:
+            sentinels = { worker.process.sentinel: worker for worker in self._workers.values()
+                          if worker.restart_at is None }
+            timeout = self._next_timeout(time.monotonic())
+
+        ready = wait(list(sentinels) + [self._wake_reader], timeout)
+
+        with self._lock:
+            now = time.monotonic()
+            while self._wake_reader.poll():
+                self._wake_reader.recv_bytes()
+            if self._stopped:
+                return
+            for sentinel in ready:
+                worker = sentinels.get(sentinel)
+                if worker is not None and worker.process.sentinel == sentinel:
+                    worker.process.join()
+                    self._detected(worker, f"exit code {worker.process.exitcode}", now)
+
+            for worker in self._workers.values():
+                if worker.restart_at is None and self._stalled(worker, now):
+                    worker.process.kill()
+                    worker.process.join()
+                    self._detected(worker, f"no heartbeat for {worker.stall_timeout}s", now)
+                if worker.restart_at is not None and worker.restart_at <= now:
+                    self._restart(worker)
+                if worker.detected_at is not None and worker.restart_at is None:
+                    self._check_recovery(worker)
+
+    def _next_timeout(self, now:float):
+        deadlines = []
+        for worker in self._workers.values():
+            if worker.restart_at is not None:
+                deadlines.append(worker.restart_at)
+            elif worker.detected_at is not None:
+                deadlines.append(now + RECOVERY_POLL)
+            elif worker.stall_timeout is not None:
+                deadlines.append(self._last_beat(worker) + worker.stall_timeout)
+        return max(0.0, min(deadlines) - now) if len(deadlines) > 0 else None
+
+    def _last_beat(self, worker:SupervisedWorker) -> float:
+        # A new process is given the stall timeout to reach its loop
+        return max(self._heartbeats[self._index[worker.name]], worker.started_at)
+
+    def _stalled(self, worker:SupervisedWorker, now:float) -> bool:
+        return worker.stall_timeout is not None and worker.process.is_alive() and \
+               now - self._last_beat(worker) > worker.stall_timeout
+
+    def _detected(self, worker:SupervisedWorker, cause:str, now:float):
+        if now - worker.started_at < supervisor_stable_seconds:
+            worker.crashes_in_row += 1
+        else:
+            worker.crashes_in_row = 1
+        backoff = min(supervisor_restart_backoff * 2 ** (worker.crashes_in_row - 1), supervisor_max_backoff)
+        worker.cause = cause
+        worker.detected_at = now
+        worker.restart_at = now + backoff
+        logging.warning(f"[Supervisor]{worker.name} stopped ({cause}), restarting in {backoff:.2f}s")
+
+    def _restart(self, worker:SupervisedWorker):
+        worker.restart_at = None
+        worker.started_at = time.monotonic()
+        worker.process = worker.spawn()
+
+    def _check_recovery(self, worker:SupervisedWorker):
+        first_beat = self._first_beats[self._index[worker.name]]
+        if first_beat < worker.started_at:
+            return
+        recovery = first_beat - worker.detected_at
+        self.recoveries.append((worker.name, worker.cause, recovery))
+        logging.info(f"[Supervisor]{worker.name} recovered {recovery * 1000:.1f}ms after detection")
+        worker.detected_at = None
+
+
+def _worker(supervisor:Supervisor, name:str):
+    while True:
+        supervisor.heartbeat(name)
+        time.sleep(0.05)
+
+
+if __name__ == "__main__":
+    import signal
+
+    logging.basicConfig(level=logging.WARNING)
+    names = ("worker", "hung worker")
+    supervisor = Supervisor(names)
+    kills = 5
+
+    def spawn(name:str):
+        process = mp.Process(target=_worker, args=(supervisor, name), daemon=True)
+        process.start()
+        return process
+
+    def killed_at(process) -> float:
+        killed = time.monotonic()
+        process.kill()
+        return killed
+
+    # The previous check_processes_if_running: is_alive() polled once a second
+    process = spawn("worker")
+    detections = []
+    for _ in range(kills):
+        time.sleep(0.3)
+        killed = killed_at(process)
+        while process.is_alive():
+            time.sleep(1)
+        detections.append(time.monotonic() - killed)
+        process = spawn("worker")
+    process.kill()
+    print(f"is_alive() polling  detection {sum(detections) / kills * 1000:7.1f}ms mean, {max(detections) * 1000:7.1f}ms max")
+
+    supervisor.add("worker", spawn("worker"), lambda: spawn("worker"))
+    supervisor.add("hung worker", spawn("hung worker"), lambda: spawn("hung worker"), stall_timeout=0.5)
+    supervisor.start()
+    detections = []
+    for _ in range(kills):
+        # Killed again once recovered, well within supervisor_stable_seconds so the backoff doubles every time
+        while True:
+            with supervisor._lock:
+                worker = supervisor._workers["worker"]
+                if worker.detected_at is None and worker.restart_at is None:
+                    process = worker.process
+                    break
+            time.sleep(0.01)
+        time.sleep(0.1)
+        killed = killed_at(process)
+        while True:
+            with supervisor._lock:
+                detected = supervisor._workers["worker"].detected_at
+            if detected is not None and detected >= killed:
+                break
+            time.sleep(0.001)
+        detections.append(detected - killed)
+    time.sleep(0.5)
+    print(f"sentinel wait       detection {sum(detections) / kills * 1000:7.1f}ms mean, {max(detections) * 1000:7.1f}ms max")
+
+    # A stopped process keeps its sentinel open, only the heartbeat shows it is stuck
+    with supervisor._lock:
+        hung = supervisor._workers["hung worker"].process
+    os.kill(hung.pid, signal.SIGSTOP)
+    time.sleep(2.0)
+
+    for name, cause, recovery in supervisor.recoveries:
+        print(f"{name:<12} {cause:<24} detection to recovery {recovery * 1000:6.1f}ms")
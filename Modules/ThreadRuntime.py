@@ -0,0 +1,45 @@
+import logging
+import threading
+import time
+
+"""
+> Runs the RpiModule workers as threads of a single process instead of worker processes
+> The workers are the same blocking loops as in the multiprocess mode, the bluetooth, serial, camera and http
+> drivers only offer blocking calls so every worker gets its own daemon thread, restarted after a crash
+> All workers share the same RpiModule object, which means queues, events and counters are plain in-process
+> objects and a restarted worker keeps its state
+"""
+class ThreadRuntime:
+    def __init__(self, restart_delay:float = 1.0):
+        self._workers = {}
+        self._restart_delay = restart_delay
+
+    def add_worker(self, name:str, target):
+        self._workers[name] = target
+
+    def _supervise(self, name:str, target):
+        while True:
+            try:
+                target()
+                logging.info(f"[ThreadRuntime]{name} exited")
+                return
+            except Exception as e:
+                logging.warning(f"[ThreadRuntime]{name} crashed: {e}, restarting in {self._restart_delay}s")
+                time.sleep(self._restart_delay)
+
+    def run(self):
+        """
+        Starts every worker and blocks until they have all exited
+        """
+        # Daemon threads so that a worker blocked in a driver call does not hold up interpreter exit
+        threads = [threading.Thread(target=self._supervise, args=(name, target), name=name, daemon=True)
+                   for name, target in self._workers.items()]
+        for thread in threads:
+            thread.start()
+        logging.info(f"[ThreadRuntime]Started {len(threads)} workers: {', '.join(self._workers)}")
+        for thread in threads:
+            thread.join()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,146 @@
+import itertools
+import os
+import struct
+import time
+
+from config import trace_file
+
+# Hops of a command, recorded in this order for a move and a SNAP
+QUEUED = 1          # put on command_queue by find_shortest_path
+DEQUEUED = 2        # taken by handle_commands
+SENT = 3            # written to the STM
+ACKED = 4           # ACK handled by handle_stm_messages
+ANDROID_QUEUED = 5  # location or image result put on android_msgs
+ANDROID_SENT = 6    # written to the android socket by the sender
+CAPTURED = 7        # SNAP image captured
+PREDICTED = 8       # SNAP prediction returned by the server
+STAGE_NAMES = { QUEUED: "queued", DEQUEUED: "dequeued", SENT: "sent", ACKED: "acked",
+                ANDROID_QUEUED: "android_queued", ANDROID_SENT: "android_sent",
+                CAPTURED: "captured", PREDICTED: "predicted" }
+
+COMMAND_TYPES = ("other", "straight", "turn", "snap", "fin")
+_STRAIGHT = ("FW", "BW", "FS", "BS")
+_TURN = ("FR", "FL", "BR", "BL")
+
+# trace id, stage, command type, monotonic seconds
+RECORD = struct.Struct("<IBBd")
+
+def command_type(command:str) -> int:
+    if command.startswith(_STRAIGHT):
+        return 1
+    elif command.startswith(_TURN):
+        return 2
+    elif command.startswith("SNAP"):
+        return 3
+    elif command == "FIN":
+        return 4
+    return 0
+
+
+class TracedCommand(str):
+    """
+    Command string carrying the id of its trace through the command queue
+    """
+    def __new__(cls, command:str, trace_id:int):
+        traced = super().__new__(cls, command)
+        traced.trace_id = trace_id
+        return traced
+
+    def __reduce__(self):
+        return (TracedCommand, (str(self), self.trace_id))
+
+
+"""
+> Records the monotonic time at which each command passes every hop, from every worker process
+> Each record is a 14 byte struct appended with a single write to trace_file, so the processes can share the file
+> without locking, tracing is off when trace_file is None
+> Trace ids are unique across processes, they travel with the command as a TracedCommand, with the path pose
+> as 'trace_id' and with the android message sent for it
+"""
+class Tracer:
+    def __init__(self, path:str = trace_file):
+        self._path = path
+        self._fd = None
+        self._fd_pid = None
+        self._ids = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._path is not None
+
+    def _open(self):
+        # One descriptor per process, a forked worker must not share the parent's file offset
+        if self._fd is None or self._fd_pid != os.getpid():
+            self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._fd_pid = os.getpid()
+            self._ids = itertools.count(1)
+        return self._fd
+
+    def new_id(self) -> int:
+        self._open()
+        return ((os.getpid() & 0xFFFF) << 16) | (next(self._ids) & 0xFFFF)
+
+    def trace(self, command:str):
+        """
+        Starts the trace of a command about to be queued, returns the command to queue
+        """
+        if not self.enabled:
+            return command
+        traced = TracedCommand(command, self.new_id())
+        self.record(traced.trace_id, QUEUED, command)
+        return traced
+
+    def record(self, trace_id, stage:int, command:str = ""):
+        if not self.enabled or trace_id is None:
+            return
+        try:
+            os.write(self._open(), RECORD.pack(trace_id, stage, command_type(command), time.monotonic()))
+        except OSError:
+            pass
+
+
+def read_trace(path:str) -> dict:
+    """
+    Returns {trace id: (command type, [(monotonic seconds, stage), ...] in time order)}
+    """
+    traces = {}
+    with open(path, "rb") as f:
+        data = f.read()
+    for trace_id, stage, kind, timestamp in RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size]):
+        previous_kind, records = traces.get(trace_id, (0, []))
+        records.append((timestamp, stage))
+        traces[trace_id] = (max(kind, previous_kind), records)
+    for _, records in traces.values():
+        records.sort()
+    return traces
+
+def percentile(sorted_samples:list, fraction:float) -> float:
+    return sorted_samples[min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))]
+
+def summarize(path:str) -> str:
+    """
+    p50/p95/p99 in ms of every hop to the next one and end to end, per command type
+    """
+    stages = {}
+    for kind, records in read_trace(path).values():
+        for (start, from_stage), (end, to_stage) in zip(records, records[1:]):
+            stages.setdefault((COMMAND_TYPES[kind], f"{STAGE_NAMES[from_stage]} -> {STAGE_NAMES[to_stage]}"), []) \
+                .append((end - start) * 1000)
+        if len(records) > 1:
+            stages.setdefault((COMMAND_TYPES[kind], "end to end"), []).append((records[-1][0] - records[0][0]) * 1000)
+
+    lines = [f"{'type':<9} {'stage':<34} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9}"]
+    for (kind, stage), samples in sorted(stages.items()):
+        samples.sort()
+        lines.append(f"{kind:<9} {stage:<34} {len(samples):>6} {percentile(samples, 0.5):>7.1f}ms " +
+                     f"{percentile(samples, 0.95):>7.1f}ms {percentile(samples, 0.99):>7.1f}ms")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2 and trace_file is None:
+        print("usage: python -m Modules.Tracer <trace file>")
+        sys.exit(1)
+    print(summarize(sys.argv[1] if len(sys.argv) > 1 else trace_file))
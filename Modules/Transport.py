@@ -0,0 +1,192 @@
+import logging
+import multiprocessing as mp
+import queue
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+"""
+> Factory for the channels shared between the RpiModule worker processes
+> "manager" : multiprocessing.Manager proxies, every operation is a pickle + socket round trip to the manager process
+> "queue"   : native multiprocessing.Queue, pickled through a pipe without a server process, a put reaches the pipe
+>             from a feeder thread later so empty() can be True right after it
+> "pipe"    : multiprocessing.Pipe guarded by locks, lowest latency for a single producer/consumer pair
+> "local"   : in-process queue.Queue, only valid when every worker runs in the same process
+> Robot pose can be "manager", "shm" (multiprocessing.shared_memory record of whole grid cells) or "local" (plain dict)
+"""
+QUEUE_KINDS = ("manager", "queue", "pipe", "local")
+POSE_KINDS = ("manager", "shm", "local")
+
+
+class PipeQueue:
+    """
+    Queue-like wrapper around a multiprocessing.Pipe exposing the subset of the Queue api used by RpiModule
+    """
+    def __init__(self):
+        self._reader, self._writer = mp.Pipe(duplex=False)
+        self._read_lock = mp.Lock()
+        self._write_lock = mp.Lock()
+
+    def put(self, item, block=True, timeout=None):
+        with self._write_lock:
+            self._writer.send(item)
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def get(self, block=True, timeout=None):
+        if not block:
+            timeout = 0
+        with self._read_lock:
+            if timeout is not None and not self._reader.poll(timeout):
+                raise queue.Empty
+            return self._reader.recv()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def empty(self) -> bool:
+        return not self._reader.poll()
+
+
+def _cell(value) -> int:
+    """
+    Pose values are whole grid cells and degrees, anything else would be truncated by the int record
+    """
+    cell = int(value)
+    if cell != value:
+        raise ValueError(f"Robot pose value {value!r} is not a whole number")
+    return cell
+
+
+class SharedRobotPose:
+    """
+    Robot pose (x, y, d) stored in a shared memory block, readable and writable
+    like the Manager dict it replaces without a round trip to the manager process
+    """
+    _fields = ("x", "y", "d")
+    _layout = struct.Struct("<iii")
+
+    def __init__(self, x=1, y=1, d=0):
+        self._shm = shared_memory.SharedMemory(create=True, size=self._layout.size)
+        self._lock = mp.Lock()
+        self._layout.pack_into(self._shm.buf, 0, _cell(x), _cell(y), _cell(d))
+
+    def _read(self) -> tuple:
+        with self._lock:
+            return self._layout.unpack_from(self._shm.buf, 0)
+
+    def __getitem__(self, key):
+        return self._read()[self._fields.index(key)]
+
+    def __setitem__(self, key, value):
+        index = self._fields.index(key)
+        with self._lock:
+            struct.pack_into("<i", self._shm.buf, index * 4, _cell(value))
+
+    def update(self, x, y, d):
+        with self._lock:
+            self._layout.pack_into(self._shm.buf, 0, _cell(x), _cell(y), _cell(d))
+
+    def keys(self):
+        return list(self._fields)
+
+    def copy(self) -> dict:
+        return dict(zip(self._fields, self._read()))
+
+    def __str__(self):
+        return str(self.copy())
+
+    def __repr__(self):
+        return f"SharedRobotPose({self.copy()})"
+
+    def close(self, unlink=False):
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+def make_queue(kind:str, manager=None):
+    if kind == "manager":
+        return manager.Queue()
+    elif kind == "queue":
+        return mp.Queue()
+    elif kind == "pipe":
+        return PipeQueue()
+    elif kind == "local":
+        return queue.Queue()
+    raise ValueError(f"Unknown queue transport: {kind}")
+
+
+def make_pose(kind:str, manager=None, x=1, y=1, d=0):
+    if kind == "manager":
+        pose = manager.dict()
+        pose["x"] = x
+        pose["y"] = y
+        pose["d"] = d
+        return pose
+    elif kind == "shm":
+        return SharedRobotPose(x, y, d)
+    elif kind == "local":
+        return { "x": x, "y": y, "d": d }
+    raise ValueError(f"Unknown pose transport: {kind}")
+
+
+def close_pose(pose):
+    """
+    Releases the shared memory of a pose made by make_pose, no-op for the other transports
+    """
+    if isinstance(pose, SharedRobotPose):
+        pose.close(unlink=True)
+
+
+def _bench_queue(kind:str, manager, iterations:int) -> float:
+    """
+    Round trip latency in microseconds of a put answered by a get in another process, both ways over kind
+    """
+    q = make_queue(kind, manager)
+    reply = make_queue(kind, manager)
+
+    def echo():
+        for _ in range(iterations):
+            reply.put(q.get())
+
+    worker = threading.Thread(target=echo) if isinstance(q, queue.Queue) else mp.Process(target=echo)
+    worker.start()
+    start = time.perf_counter()
+    for i in range(iterations):
+        q.put({ "x": i, "y": i, "d": 0 })
+        reply.get()
+    elapsed = time.perf_counter() - start
+    worker.join()
+    return elapsed / iterations * 1e6
+
+
+def _bench_pose(pose, iterations:int) -> float:
+    """
+    Latency in microseconds of one write and one read of the pose
+    """
+    start = time.perf_counter()
+    for i in range(iterations):
+        pose["x"] = i
+        pose["x"]
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    iterations = 2000
+    manager = mp.Manager()
+
+    print(f"Queue round trip ({iterations} iterations)")
+    for kind in QUEUE_KINDS:
+        print(f"  {kind:<8} {_bench_queue(kind, manager, iterations):8.1f} us/op")
+
+    print(f"Robot pose write+read ({iterations} iterations)")
+    for kind in POSE_KINDS:
+        pose = make_pose(kind, manager)
+        print(f"  {kind:<8} {_bench_pose(pose, iterations):8.1f} us/op")
+        close_pose(pose)
+
+    manager.shutdown()
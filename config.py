@@ -1,15 +1,35 @@
 # Android Configs
 uuid = "94f39d29-7d6d-437d-973b-fba39e49d4ee"
 service_name = "MDP-Group19-RPi"
+android_recv_size = 4096 # bytes read per recv, the framer reassembles messages across reads
+android_batch_bytes = 512 # small outbound messages are batched into one write up to this size
+android_transport = "rfcomm" # "rfcomm", or "tcp"/"unix" for Modules/FakeTablet.py
+android_tcp_address = ("0.0.0.0", 5050)
+android_unix_path = "/tmp/mdp_android.sock"
 
 # Camera Configs
 resolution = (1024, 768)
 warmup_time = 0.5
+camera_backend = "picamera" # "picamera" or "file" for machines without a camera
+camera_image_folder = None # jpeg folder served by the file backend
+camera_save_folder = "./images/" # captured images are saved here
+camera_framerate = 30
+camera_capture_timeout = 2.0
+camera_still_port = True # recognition images from the still port at full JPEG quality, False grabs video port frames continuously and takes the next one, faster but lower quality
 
 # STM Configs
 serial_port = "/dev/serial/by-id/usb-Silicon_Labs_CP2102_USB_to_UART_Bridge_Controller_0002-if00-port0"
 baud_rate = 115200
 stm_message_len = 5
+stm_ack_timeout = 10.0 # seconds to wait for the ACK of a command without its own deadline
+stm_ack_timeouts = { "FL": 6.0, "FR": 6.0, "BL": 6.0, "BR": 6.0, "TL": 4.0, "TR": 4.0,
+                     "DT": 15.0, "TA": 15.0, "TB": 15.0, "AM": 15.0, "GH": 15.0 } # seconds, straight moves get a deadline from their distance instead
+stm_ack_margin = 3.0 # the ACK deadline of a straight move is its estimated duration times this
+stm_pipeline_window = 2 # STM commands in flight when week8 runs with PipelineSTM
+stm_max_straight = 90 # longest straight move in cm the STM accepts in one command
+stm_command_overhead = 0.5 # estimated seconds per command for the ACK round trip and acceleration
+stm_straight_speed = 20 # estimated straight line speed in cm/s
+stm_slow_straight_speed = 10 # estimated speed of the slow FS/BS moves in cm/s
 stm_command_prefixes = ("FS", "BS", "FW", "BW", "FL", "FR", "BL",
                         "BR", "TL", "TR", "DT", "BA", "BC", "FA", 
                         "FC", "TA", "TB", "IR", "TD", "IC", "GH", 
@@ -18,7 +38,51 @@ stm_command_prefixes = ("FS", "BS", "FW", "BW", "FL", "FR", "BL",
 # Image Recognition Configs
 server_url = "192.168.19.17" # to be changed
 server_port = "5000"
+# (connect, read) deadlines in seconds per endpoint
+api_timeouts = {
+    "/": (1.0, 1.0),
+    "/predict": (1.0, 5.0),
+    "/algo": (1.0, 10.0),
+    "/calibrate": (1.0, 5.0),
+    "/stitch": (1.0, 30.0),
+}
+api_max_retries = 2
+api_retry_backoff = 0.2 # seconds, doubled on every retry
+api_pool_size = 4
+snap_prediction_workers = 2 # background predictions when SNAP does not block the robot
+snap_prediction_timeout = 10.0 # seconds to wait for them at FIN
+path_cache_file = "./path_cache.json" # None keeps the path cache in memory only
+path_cache_size = 64 # cached obstacle layouts
+path_cache_version = 1 # planner version of the cached paths, bump it when the server planner changes to discard them
+planner_grid_size = 20 # arena cells per side for the on-device planner
+planner_clearance = 2 # minimum cells between the robot centre and an obstacle
+planner_view_distance = 3 # cells between an obstacle and the robot centre when capturing its image
+planner_time_budget = 2.0 # seconds the on-device planner spends on the exact visit order
+planner_server_wait = 3.0 # seconds to wait for /algo before using the on-device plan
+planner_local_wait = 5.0 # further seconds to wait for the on-device plan, above planner_time_budget
 
 # Task 2 Configs
 OBSTACLE_WIDTH = 10
 IS_OUTSIDE = True
+
+# Profiling Configs
+cpu_report_interval = 30 # seconds between worker CPU usage reports
+log_async = True # log through a queue to a writer process instead of writing from every worker
+log_ring_buffer_size = 0 # latest records kept by the writer and dumped to log_ring_buffer_file on exit, 0 disables
+log_ring_buffer_file = "./log_ring.txt"
+trace_file = None # per command hop timestamps are appended here when set, summarize with python -m Modules.Tracer
+session_journal_file = None # every byte on the android, STM and server links is appended here when set, replay with python -m Modules.SessionReplay
+
+# IPC Configs, see Modules/Transport.py for the available transports
+# "queue" and "shm" are faster, but multiprocessing.Queue.empty() is not reliable right after a put
+path_queue_transport = "manager"
+command_queue_transport = "manager"
+android_msgs_transport = "manager"
+robot_location_transport = "manager"
+
+# Supervisor Configs
+supervisor_restart_backoff = 0.1 # seconds before restarting a stopped worker, doubled for every crash in a row
+supervisor_max_backoff = 5.0
+supervisor_stable_seconds = 30.0 # a worker running this long before stopping restarts from the initial backoff
+supervisor_stall_timeout = 30.0 # seconds without a heartbeat before handle_stm_messages is restarted, above a /predict with its retries
+supervisor_heartbeat_interval = 1.0 # seconds between heartbeats of a worker blocked on another worker
@@ -1,5 +1,6 @@
 from enum import Enum
 import logging
+import multiprocessing as mp
 import time
 
 class RobotStatus(Enum):
@@ -20,72 +21,159 @@ class Direction(int, Enum):
     def __int__(self):
         return self.value
     
+# Unit vectors (forward, right) on the grid for each heading
+HEADING_VECTORS = {
+    Direction.NORTH.value: ((0, 1), (1, 0)),
+    Direction.EAST.value: ((1, 0), (0, -1)),
+    Direction.SOUTH.value: ((0, -1), (-1, 0)),
+    Direction.WEST.value: ((-1, 0), (0, 1)),
+}
+HEADINGS = tuple(HEADING_VECTORS)
+
+# Straight moves in cm, advanced by one grid cell every 10cm: prefix -> forward sign
+STRAIGHT_MOVES = { "FW": 1, "FS": 1, "BW": -1, "BS": -1 }
+# Turns, in the robot frame: prefix -> (cells right, cells forward, quarter turns clockwise)
+TURN_MOVES = {
+    "FR": (1, 3, 1),
+    "FL": (-1, 3, -1),
+    "BR": (1, -3, -1),
+    "BL": (-1, -3, 1),
+}
+
+def _build_translations():
+    straights = {}
+    turns = {}
+    for heading, (forward, right) in HEADING_VECTORS.items():
+        for prefix, sign in STRAIGHT_MOVES.items():
+            straights[(prefix, heading)] = (sign * forward[0], sign * forward[1])
+        for prefix, (cells_right, cells_forward, quarter_turns) in TURN_MOVES.items():
+            new_heading = HEADINGS[(HEADINGS.index(heading) + quarter_turns) % len(HEADINGS)]
+            turns[(prefix, heading)] = (cells_right * right[0] + cells_forward * forward[0],
+                                        cells_right * right[1] + cells_forward * forward[1], new_heading)
+    return straights, turns
+
+# (prefix, heading) -> grid step per 10cm, and (prefix, heading) -> (dx, dy, new heading)
+_STRAIGHT_STEPS, _TURN_TRANSLATIONS = _build_translations()
+
     #translate a command to appropriate dx, dy
 def TranslateCommand(command : str, current_direction : int):
+    """
+    Grid displacement (dx, dy) and the new heading after a command, looked up from the tables above
+    """
     if len(command) < 4:
         return 0, 0, current_direction
-    if command.startswith("FW") or command.startswith("FS"):
-        if current_direction == Direction.NORTH.value:
-            return 0, int(command[2:]) // 10, current_direction
-        elif current_direction == Direction.EAST.value:
-            return int(command[2:]) // 10, 0, current_direction
-        elif current_direction == Direction.SOUTH.value:
-            return 0, -(int(command[2:]) // 10), current_direction
-        elif current_direction == Direction.WEST.value:
-            return -(int(command[2:]) // 10), 0, current_direction
-
-    elif command.startswith("BW") or command.startswith("BS"):
-        if current_direction == Direction.NORTH.value:
-            return 0, -(int(command[2:]) // 10), current_direction
-        elif current_direction == Direction.EAST.value:
-            return -(int(command[2:]) // 10), 0, current_direction
-        elif current_direction == Direction.SOUTH.value:
-            return 0, (int(command[2:]) // 10), current_direction
-        elif current_direction == Direction.WEST.value:
-            return int(command[2:]) // 10, 0, current_direction
-
-    elif command.startswith("BR"):
-        if current_direction == Direction.NORTH.value:
-            return 1, -3, Direction.WEST.value
-        elif current_direction == Direction.EAST.value:
-            return -3, -1, Direction.NORTH.value
-        elif current_direction == Direction.SOUTH.value:
-            return -1, 3, Direction.EAST.value
-        elif current_direction == Direction.WEST.value:
-            return 3, 1, Direction.SOUTH.value
-
-    elif command.startswith("BL"):
-        if current_direction == Direction.NORTH.value:
-            return -1, -3, Direction.EAST.value
-        elif current_direction == Direction.EAST.value:
-            return -3, 1, Direction.SOUTH.value
-        elif current_direction == Direction.SOUTH.value:
-            return 1, 3, Direction.WEST.value
-        elif current_direction == Direction.WEST.value:
-            return 3, -1, Direction.NORTH.value
-
-    elif command.startswith("FL"):
-        if current_direction == Direction.NORTH.value:
-            return -1, 3, Direction.WEST.value
-        elif current_direction == Direction.EAST.value:
-            return -3, -1, Direction.SOUTH.value
-        elif current_direction == Direction.SOUTH.value:
-            return 1, -3, Direction.EAST.value
-        elif current_direction == Direction.WEST.value:
-            return -3, -1, Direction.SOUTH.value
-
-    elif command.startswith("FR"):
-        if current_direction == Direction.NORTH.value:
-            return 1, 3, Direction.EAST.value
-        elif current_direction == Direction.EAST.value:
-            return -3, 1, Direction.NORTH.value
-        elif current_direction == Direction.SOUTH.value:
-            return -1, -3, Direction.WEST.value
-        elif current_direction == Direction.WEST.value:
-            return -3, 1, Direction.NORTH.value
-    else:
+    prefix = command[:2]
+    step = _STRAIGHT_STEPS.get((prefix, current_direction))
+    if step is not None:
+        cells = int(command[2:]) // 10
+        return step[0] * cells, step[1] * cells, current_direction
+    translation = _TURN_TRANSLATIONS.get((prefix, current_direction))
+    if translation is not None:
+        return translation
+    if prefix not in STRAIGHT_MOVES and prefix not in TURN_MOVES:
         logging.debug(f"[TranslateCommand]Unhandled command:{command}")
     return 0, 0, current_direction
 
 def current_milli_time():
-    return round(time.time() * 1000)
\ No newline at end of file
+    return round(time.time() * 1000)
+
+class CpuUsage:
+    """
+    Measures the share of one core used by the calling process since the last reset,
+    used to check that idle worker loops are not spinning
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._wall_start = time.monotonic()
+        self._cpu_start = time.process_time()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._wall_start
+
+    def percent(self) -> float:
+        wall = self.elapsed()
+        if wall <= 0:
+            return 0.0
+        return 100.0 * (time.process_time() - self._cpu_start) / wall
+
+def summarize_latencies(samples) -> str:
+    """
+    Formats latency samples given in seconds as count, mean and percentiles in milliseconds
+    """
+    samples = sorted(samples)
+    if len(samples) == 0:
+        return "no samples"
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+
+    mean = sum(samples) / len(samples) * 1000
+    return f"n={len(samples)} mean={mean:.1f}ms p50={percentile(50):.1f}ms " + \
+        f"p95={percentile(95):.1f}ms max={samples[-1] * 1000:.1f}ms"
+
+class LatencyHistogram:
+    """
+    Fixed bucket histogram of latencies in milliseconds
+    """
+    buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _bucket(self, ms:float) -> int:
+        index = 0
+        while index < len(self.buckets) and ms > self.buckets[index]:
+            index += 1
+        return index
+
+    def record(self, ms:float):
+        index = self._bucket(ms)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def report(self) -> str:
+        if self.count == 0:
+            return "no samples"
+        labels = [f"<={b}" for b in self.buckets] + [f">{self.buckets[-1]}"]
+        spread = " ".join(f"{label}:{count}" for label, count in zip(labels, self.counts) if count > 0)
+        return f"n={self.count} mean={self.total / self.count:.1f}ms max={self.max:.1f}ms [{spread}]"
+
+class SharedLatencyHistogram(LatencyHistogram):
+    """
+    LatencyHistogram in shared memory, created before the workers are forked so that the samples of every worker
+    end up in the one report
+    """
+    def __init__(self):
+        # The bucket counts followed by the sample count, total and max
+        self._values = mp.Array("d", len(self.buckets) + 4)
+
+    @property
+    def counts(self) -> list:
+        return [int(value) for value in self._values[:len(self.buckets) + 1]]
+
+    @property
+    def count(self) -> int:
+        return int(self._values[-3])
+
+    @property
+    def total(self) -> float:
+        return self._values[-2]
+
+    @property
+    def max(self) -> float:
+        return self._values[-1]
+
+    def record(self, ms:float):
+        index = self._bucket(ms)
+        with self._values.get_lock():
+            self._values[index] += 1
+            self._values[-3] += 1
+            self._values[-2] += ms
+            self._values[-1] = max(self._values[-1], ms)
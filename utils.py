@@ -1,4 +1,12 @@
 import logging
+import logging.handlers
+import multiprocessing as mp
+import os
+from collections import deque
+
+from config import log_async, log_ring_buffer_size, log_ring_buffer_file
+
+LOG_FORMAT = "[%(asctime)s - %(name)s - %(levelname)s]->%(message)s (%(filename)s:%(lineno)d)"
 
 class CustomFormatter(logging.Formatter):
     grey = "\x1b[38;20m"
@@ -7,7 +15,7 @@ class CustomFormatter(logging.Formatter):
     bold_red = "\x1b[31;1m"
     reset = "\x1b[0m"
     blue = "\x1b[36m"
-    format = "[%(asctime)s - %(name)s - %(levelname)s]->%(message)s (%(filename)s:%(lineno)d)"
+    format = LOG_FORMAT
 
     FORMATS = {
         logging.DEBUG: blue + format + reset,
@@ -17,10 +25,14 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self):
+        super().__init__()
+        # One formatter per level, built once instead of for every record
+        self._formatters = { level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items() }
+        self._default_formatter = logging.Formatter()
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self._formatters.get(record.levelno, self._default_formatter).format(record)
 
 local_custom_formatter = CustomFormatter()
 local_StreamHandler = logging.StreamHandler()
@@ -41,4 +53,155 @@ def SetupColouredLogging():
     loggers = loggers + [logging.getLogger(name) for name in logging.root.manager.loggerDict]
     for logger in loggers:
         if not logger.hasHandlers():
-            logger.addHandler(ch)
\ No newline at end of file
+            logger.addHandler(ch)
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last capacity records in memory, formatted and written to path only when flushed,
+    so DEBUG detail around a failure is available without paying for terminal output
+    """
+    def __init__(self, capacity:int, path:str):
+        super().__init__(logging.DEBUG)
+        self._records = deque(maxlen=capacity)
+        self._path = path
+
+    def emit(self, record):
+        self._records.append(record)
+
+    def flush(self):
+        with self.lock:
+            records = list(self._records)
+        with open(self._path, "w") as f:
+            for record in records:
+                f.write(self.format(record) + "\n")
+
+
+def _run_log_writer(log_queue, level:int, ring_buffer_size:int, ring_buffer_file:str):
+    # The writer itself logs nothing, records only come in through the queue
+    logging.getLogger().handlers = []
+    local_StreamHandler.setLevel(level)
+    handlers = [local_StreamHandler]
+    if ring_buffer_size > 0:
+        ring_buffer = RingBufferHandler(ring_buffer_size, ring_buffer_file)
+        ring_buffer.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers.append(ring_buffer)
+
+    # Same dispatch as a QueueListener with respect_handler_level, in the writer's main thread, until the None
+    # sentinel put by LogPipeline.stop
+    while True:
+        try:
+            record = log_queue.get()
+        except (EOFError, OSError):
+            break
+        if record is None:
+            break
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+    for handler in handlers:
+        handler.flush()
+
+
+"""
+> Moves log output off the worker processes: every process logs into a multiprocessing queue through a
+> QueueHandler and a single writer process formats and writes the records
+> A logging call in a hot loop only enqueues the record, the terminal write happens in the writer
+> The writer can also keep the latest records in a RingBufferHandler, dumped to log_ring_buffer_file on stop
+> Started before the workers are forked so that they all inherit the queue handler
+"""
+class LogPipeline:
+    def __init__(self, level:int, ring_buffer_size:int = log_ring_buffer_size, ring_buffer_file:str = log_ring_buffer_file):
+        self._level = level
+        self._queue = mp.Queue()
+        self.process = mp.Process(target=_run_log_writer, daemon=True,
+                                   args=(self._queue, level, ring_buffer_size, ring_buffer_file))
+        self._owner_pid = None
+
+    def start(self):
+        self.process.start()
+        self._owner_pid = os.getpid()
+        root = logging.getLogger()
+        root.handlers = [logging.handlers.QueueHandler(self._queue)]
+        # Records below the level are dropped in the calling process, before any formatting
+        root.setLevel(self._level)
+
+    def stop(self):
+        if os.getpid() != self._owner_pid or not self.process.is_alive():
+            return
+        # The sentinel goes through the same feeder thread as the records, so the writer handles every record
+        # logged by this process before it
+        self._queue.put(None)
+        self.process.join(10)
+        if self.process.is_alive():
+            # Do not block the exit on records the writer will never read
+            self._queue.cancel_join_thread()
+            self.process.kill()
+
+
+def setup_logging(level:int = logging.DEBUG):
+    """
+    Configures the root logger of a week program, returns the LogPipeline to stop on exit or None
+    """
+    if not log_async:
+        logging.basicConfig(level=level, handlers=[local_StreamHandler])
+        return None
+    pipeline = LogPipeline(level)
+    pipeline.start()
+    return pipeline
+
+
+if __name__ == "__main__":
+    import time
+
+    iterations = 20000
+    devnull = open(os.devnull, "w")
+
+    class UncachedFormatter(CustomFormatter):
+        def format(self, record):
+            return logging.Formatter(self.FORMATS.get(record.levelno)).format(record)
+
+    class SlowTerminal:
+        """
+        Terminal taking 200us per write, like an SSH session or a serial console
+        """
+        def write(self, text):
+            time.sleep(0.0002)
+
+        def flush(self):
+            pass
+
+    def bench(name:str, log, iterations:int = iterations):
+        start = time.perf_counter()
+        for i in range(iterations):
+            log(i)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<40} {elapsed / iterations * 1e6:6.2f}us per call")
+
+    root = logging.getLogger()
+    command = "FW10"
+
+    for formatter_name, formatter in (("formatter per record", UncachedFormatter()), ("cached formatters", CustomFormatter())):
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(formatter)
+        root.handlers = [handler]
+        root.setLevel(logging.DEBUG)
+        bench(f"sync stream, {formatter_name}", lambda i: logging.debug("[bench]Command: %s %d", command, i))
+
+    root.setLevel(logging.INFO)
+    bench("DEBUG disabled, f-string", lambda i: logging.debug(f"[bench]Command: {command} {i}"))
+    bench("DEBUG disabled, %-style", lambda i: logging.debug("[bench]Command: %s %d", command, i))
+
+    # Caller cost when the terminal is slow, the writer process inherits local_StreamHandler
+    local_StreamHandler.setStream(SlowTerminal())
+    root.handlers = [local_StreamHandler]
+    root.setLevel(logging.DEBUG)
+    bench("slow terminal, sync", lambda i: logging.debug("[bench]Command: %s %d", command, i), 2000)
+
+    for stream_name, stream in (("devnull", devnull), ("slow terminal", SlowTerminal())):
+        local_StreamHandler.setStream(stream)
+        pipeline = LogPipeline(logging.DEBUG, ring_buffer_size=0)
+        pipeline.start()
+        bench(f"{stream_name}, queue to writer process", lambda i: logging.debug("[bench]Command: %s %d", command, i), 2000)
+        start = time.perf_counter()
+        pipeline.stop()
+        print(f"{'':<40} writer done {(time.perf_counter() - start) * 1000:.0f}ms after the last call")
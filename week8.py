@@ -2,17 +2,22 @@ StartAndroid    = True
 StartSTM        = True
 StartCamera     = True
 CheckSvr        = True
+SingleProcess   = False
+NonBlockingSnap = False
+PipelineSTM     = False
 
-import ast
-import json
+from concurrent.futures import ThreadPoolExecutor, wait, TimeoutError as FutureTimeoutError
 import logging
-import os
 from multiprocessing import Process, Manager
 import requests
 import queue
+import threading
 import time
 
-from config import stm_command_prefixes, server_url, server_port
+from config import stm_command_prefixes, server_url, server_port, \
+    snap_prediction_workers, snap_prediction_timeout, stm_pipeline_window, stm_ack_timeout, planner_server_wait, \
+    planner_local_wait, path_queue_transport, command_queue_transport, android_msgs_transport, robot_location_transport, \
+    supervisor_stall_timeout, supervisor_heartbeat_interval
 from helper import RobotStatus, Direction, TranslateCommand
 if StartAndroid:
     from Modules.AndroidModule import AndroidModule
@@ -21,50 +26,83 @@ from Modules.AndroidMessages import AndroidMessage, InfoMessage, RobotLocMessage
 if StartCamera:
     from Modules.CameraModule import CameraModule
 
-from Modules.StmModule import StmModule
+from Modules.StmModule import StmModule, CommandWindow, CommandTimer
 from Modules.APIServer import APIServer
-from utils import local_StreamHandler
+from Modules.AndroidOutbox import AndroidSender
+from Modules.Transport import make_queue, make_pose, close_pose
+from Modules.ThreadRuntime import ThreadRuntime
+from Modules.Supervisor import Supervisor
+from Modules.PathCache import PathCache
+from Modules.CommandOptimizer import CommandOptimizer
+from Modules.Kinematics import check_path
+from Modules.PathPlanner import PathPlanner
+from Modules.Tracer import Tracer, DEQUEUED, SENT, ACKED, ANDROID_QUEUED, ANDROID_SENT, CAPTURED, PREDICTED
+from utils import setup_logging
 
 class RpiModule:
     def __init__(self):
-        logging.basicConfig(level=logging.DEBUG, handlers=[local_StreamHandler])
+        self.log_pipeline = setup_logging(logging.DEBUG)
 
         if StartCamera:
             self.camera = CameraModule()
         if StartAndroid:
-            self.android = AndroidModule()
+            # The android workers stay up across a drop and take over the socket of the next connection
+            self.android = AndroidModule(workers=() if SingleProcess else ("handle_android_messages", "send_android_messages"))
         self.stm = StmModule()
         self.server = APIServer()
+        self.path_cache = PathCache()
+        self.command_optimizer = CommandOptimizer()
+        self.path_planner = PathPlanner()
+        self.tracer = Tracer()
+        # Set by the android worker once a path is queued, command_queue.empty() can still be True right after the
+        # puts as the queue feeder thread writes them to the pipe later
+        self.path_queued = False
+
+        if SingleProcess:
+            # All workers share this object in one process, plain in-process primitives are enough
+            self._manager = None
+            sync = threading
+        else:
+            self._manager = Manager()
+            sync = self._manager
 
-        self._manager = Manager()
+        self.path_queue = make_queue("local" if SingleProcess else path_queue_transport, self._manager)
+        self.android_msgs = make_queue("local" if SingleProcess else android_msgs_transport, self._manager)
+        self.android_dropped_event = sync.Event()
+        self.android_sender = AndroidSender(self.android_msgs, sync.Event(), self.android_send_failed, self.android_batch_sent)
+        self.android_connected = sync.Event()
+        self.command_queue = make_queue("local" if SingleProcess else command_queue_transport, self._manager)
 
-        self.path_queue = self._manager.Queue()
-        self.android_msgs = self._manager.Queue()
-        self.android_dropped_event = self._manager.Event()
-        self.command_queue = self._manager.Queue()
+        self.movement_lock = sync.Lock()
 
-        self.movement_lock = self._manager.Lock()
+        self.start_movement = sync.Event()
+        self.manual_ctrl = sync.Event()
+        self.empty = sync.Event()
+        self.full = sync.Event()
+        # Slots for the STM commands in flight when commands are pipelined
+        self.stm_window = CommandWindow(sync, stm_pipeline_window)
 
-        self.start_movement = self._manager.Event()
-        self.manual_ctrl = self._manager.Event()
-        self.empty = self._manager.Event()
-        self.full = self._manager.Event()
+        self.obstacles = [] if SingleProcess else self._manager.list()
+        self.robot_location = make_pose("local" if SingleProcess else robot_location_transport, self._manager)
 
-        self.obstacles = self._manager.list()
-        self.robot_location = self._manager.dict()
+        self.command_timer = CommandTimer(stm_pipeline_window)
+        self.runtime = None
 
         self.handle_android_msgs_process = None
         self.send_android_msgs_process = None
         self.handle_stm_msgs_process = None
         self.handle_commands_process = None
-
-        self.robot_location["x"] = 1
-        self.robot_location["y"] = 1
-        self.robot_location["d"] = 0
+        # Restarts the workers that exit or stop beating, created before they are forked
+        self.supervisor = Supervisor(("handle_android_messages", "send_android_messages", "handle_stm_messages",
+                                      "handle_commands"))
 
     def initialize(self):
+        if StartCamera:
+            # Start the camera service before the workers are forked so they can all reach it
+            self.camera.start()
         if StartAndroid:
             self.android.connect()
+            self.android_connected.set()
         if StartSTM:
             if not self.stm.connect():
                 logging.warning("[RpiModule.initialize]STM serial connection failed!")
@@ -72,93 +110,129 @@ class RpiModule:
         if CheckSvr:
             self.check_server()
 
+        if SingleProcess:
+            self.spawn_worker_threads()
+            logging.info("[RpiModule.initialize]Worker threads created")
+            return True
+
         if StartAndroid:
             self.spawn_android_processes()
+            self.supervisor.add("handle_android_messages", self.handle_android_msgs_process, self.spawn_android_handler)
+            self.supervisor.add("send_android_messages", self.send_android_msgs_process, self.spawn_android_sender)
         if StartSTM:
-            self.handle_stm_msgs_process = Process(target=self.handle_stm_messages)
-            self.handle_commands_process = Process(target=self.handle_commands)
-            self.handle_stm_msgs_process.start()
-            self.handle_commands_process.start()
+            # handle_commands blocks on the command queue between paths, only the STM reader is expected to beat
+            # at least every serial timeout
+            self.supervisor.add("handle_stm_messages", self.spawn_stm_handler(), self.spawn_stm_handler,
+                                supervisor_stall_timeout)
+            self.supervisor.add("handle_commands", self.spawn_command_handler(), self.spawn_command_handler)
 
         logging.info("[RpiModule.initialize]Processes started")
         return True
 
     def EventLoop(self):
         try:
-            if not StartAndroid:
-                while True:
-                    self.check_processes_if_running()
+            if SingleProcess:
+                self.runtime.run()
+            elif not StartAndroid:
+                self.supervisor.run()
             else:
+                self.supervisor.start()
                 self.handle_android_drop_event()
         except KeyboardInterrupt:
             logging.info("[RpiModule.EventLoop]KeyboardInterrupt")
             self.terminate()
 
     def terminate(self):
+        self.report_command_latency()
+        if StartCamera:
+            self.camera.stop()
+        if SingleProcess:
+            # Worker threads are daemons and exit with the program
+            if StartAndroid:
+                self.android_sender.stop()
+                self.android.disconnect()
+            if StartSTM:
+                self.stm.disconnect()
+            logging.info("[RpiModule.terminate]Program terminated")
+            self.stop_logging()
+            return
+
+        self.supervisor.stop()
         if StartAndroid:
+            self.stop_android_sender()
             self.android.disconnect()
             self.handle_android_msgs_process.kill()
-            self.send_android_msgs_process.kill()
             self.handle_android_msgs_process.join()
-            self.send_android_msgs_process.join()
         if StartSTM:
             self.stm.disconnect()
             self.handle_stm_msgs_process.join()
             self.handle_commands_process.join()
 
+        close_pose(self.robot_location)
+
         logging.info("[RpiModule.terminate]Processes joined")
         logging.info("[RpiModule.terminate]Program terminated")
+        self.stop_logging()
+
+    def stop_logging(self):
+        """
+        Lets the log writer process finish the queued records, last step of terminate
+        """
+        if self.log_pipeline is not None:
+            self.log_pipeline.stop()
 
     def handle_android_messages(self):
+        # Pick up paths cached by a previous instance of this worker
+        self.path_cache.load()
+        # /algo and the on-device planner race for every uncached layout, each on its own executor so that a hung
+        # /algo call cannot hold up the fallback plan of the next layout
+        self.server_planner_pool = ThreadPoolExecutor(max_workers=2)
+        self.local_planner_pool = ThreadPoolExecutor(max_workers=1)
         while True:
+            self.supervisor.heartbeat("handle_android_messages")
             msg = None
             try:
                 msg_str = self.android.receive()
                 if msg_str is not None:
-                    msg:AndroidMessage = json.loads(msg_str, object_hook=AndroidMessage.from_json)
+                    msg:AndroidMessage = AndroidMessage.decode(msg_str)
             except OSError:
                 logging.warning("[RpiModule.handle_android_messages]Android connection dropped")
-                self.android_dropped_event.set()
-            except json.decoder.JSONDecodeError:
-                logging.warning("[RpiModule.handle_android_messages]Invalid json msg")
+                self.wait_for_android("handle_android_messages")
+            except ValueError as e:
+                logging.warning(f"[RpiModule.handle_android_messages]Invalid json msg: {e}")
 
             if msg is None:
                 continue
-            logging.debug(f"[RpiModule.handle_android_messages]msg.value: {msg.value}")
+            logging.debug("[RpiModule.handle_android_messages]msg.value: %s", msg.value)
 
             # add obstacles and calculate shortest path
             if msg.category == BluetoothHeader.ITEM_LOCATION.value:
                 # reset obstacles
                 self.obstacles[:] = [] #has to clear it this way as its shared object
 
-                obstacles = ast.literal_eval(msg.value)  
-                logging.debug(f'[RpiModule.handle_android_messages]data_list = {obstacles}')
-                logging.debug(f'[RpiModule.handle_android_messages]data_list type = {type(obstacles)}')
-
-                for ob in obstacles:
-                    self.obstacles.append({
-                        "x": ob['x'],
-                        "y": ob['y'],
-                        "d": int(ob['d']),
-                        "id": ob['id'],
-                    })
+                # Already validated into obstacle dicts by AndroidMessage.decode
+                obstacles = msg.payload
+                logging.debug('[RpiModule.handle_android_messages]data_list = %s', obstacles)
+
+                self.obstacles.extend(obstacles)
                 
                 self.find_shortest_path(retrying=False, bull=False)
 
             elif msg.category == BluetoothHeader.ROBOT_LOCATION.value:
-                data_dict = json.loads(msg.value)
-                logging.debug(f'[RpiModule.handle_android_messages]msg.value = {msg.value}')
+                data_dict = msg.payload
+                logging.debug('[RpiModule.handle_android_messages]msg.value = %s', msg.value)
 
                 self.robot_location["x"] = data_dict['x']
                 self.robot_location["y"] = data_dict['y']
                 self.robot_location["d"] = data_dict['d']
 
-                logging.debug(f"[RpiModule.handle_android_messages]New Robot Location - x: {self.robot_location['x']}, y: {self.robot_location['y']}, d: {self.robot_location['d']}")
+                logging.debug("[RpiModule.handle_android_messages]New Robot Location - x: %s, y: %s, d: %s", self.robot_location['x'], self.robot_location['y'], self.robot_location['d'])
 
             elif msg.category == BluetoothHeader.START_MOVEMENT.value:
-                if self.command_queue.empty():
+                if not self.path_queued:
                     self.android_msgs.put(InfoMessage("No obstacles set"))
                     continue
+                self.path_queued = False
 
                 # reset gyroscope
                 # self.stm.send("RS00")
@@ -182,7 +256,7 @@ class RpiModule:
                 command:str = msg.value
                 self.command_queue.put(command)
                 self.translate_robot(command)
-                self.path_queue.put(self.robot_location)
+                self.path_queue.put(self.robot_location.copy())
 
                 self.start_movement.set()
                 self.manual_ctrl.set()
@@ -190,21 +264,44 @@ class RpiModule:
                 self.movement_lock.release()
                       
     def send_android_messages(self):
-        while True:
-            try:
-                if self.android_msgs.empty():
-                    continue
-                msg:AndroidMessage = self.android_msgs.get()
-                logging.debug(f"[RpiModule.send_android_messages]msg:{msg}")
-                self.android.send(msg)
-            except queue.Empty:
-                continue
-            except OSError:
-                self.android_dropped_event.set()
-                logging.warning("[RpiModule.send_android_messages]Android connection dropped")
+        # Blocks on android_msgs without a stall timeout, the beat only marks the recovery of a restarted sender
+        self.supervisor.heartbeat("send_android_messages")
+        self.android_sender.run(self.android)
+
+    def android_send_failed(self) -> bool:
+        """
+        Holds the sender until the link is back, later messages wait in android_msgs meanwhile
+        """
+        self.wait_for_android("send_android_messages")
+        return True
+
+    def android_batch_sent(self, batch:list):
+        for msg in batch:
+            self.tracer.record(msg.trace_id, ANDROID_SENT)
+
+    def wait_for_android(self, worker:str):
+        """
+        Reports a dropped android link and blocks the worker until handle_android_drop_event has accepted the
+        next connection
+        """
+        if not SingleProcess and self.android.adopt(worker, block=False):
+            # The drop was already handled, this worker was still on the old socket
+            return
+        self.android_connected.clear()
+        self.android.report_drop()
+        self.android_dropped_event.set()
+        if SingleProcess:
+            # The workers share one AndroidModule, reconnect_android replaces its socket in place
+            self.android_connected.wait()
+        else:
+            self.android.adopt(worker)
+
+    def stop_android_sender(self):
+        self.android_sender.stop(self.send_android_msgs_process)
 
     def handle_stm_messages(self):
         while True:
+            self.supervisor.heartbeat("handle_stm_messages")
             msg:str = self.stm.receive()
 
             if msg is None:
@@ -214,44 +311,67 @@ class RpiModule:
                 continue
 
             try:
-                # Movement Lock is needed to prevent further commands sent to stm
-                logging.debug("[RpiModule.handle_stm_messages]Waiting for empty")
-                self.empty.wait()
+                if not PipelineSTM:
+                    # Movement Lock is needed to prevent further commands sent to stm
+                    logging.debug("[RpiModule.handle_stm_messages]Waiting for empty")
+                    # Beats while waiting on the command handler, a wait longer than the stall timeout must not
+                    # get this worker killed
+                    while not self.empty.wait(supervisor_heartbeat_interval):
+                        self.supervisor.heartbeat("handle_stm_messages")
                 logging.debug("[RpiModule.handle_stm_messages]Waiting for movement_lock")
-                self.movement_lock.acquire()
-                logging.debug("[RpiModule.handle_stm_messages]Waiting for path_queue")
+                while not self.movement_lock.acquire(timeout=supervisor_heartbeat_interval):
+                    self.supervisor.heartbeat("handle_stm_messages")
                 try:
-                    cur_location = self.path_queue.get_nowait()
-                    self.robot_location["x"] = cur_location["x"]
-                    self.robot_location["y"] = cur_location["y"]
-
-                    # Sanity check
-                    if cur_location['d'] >= 360:
-                        cur_location['d'] = cur_location['d'] % 360
-                    while cur_location['d'] < 0:
-                        cur_location['d'] += 360
-                    self.robot_location["d"] = cur_location["d"]
-
-                    self.UpdateAndroidRobotLocation()
-                except Exception:
-                    logging.warning("Path queue is empty!")
-                # Allow further actions to be sent to stm
-                self.empty.clear()
-                self.full.set()
-                self.movement_lock.release()
+                    logging.debug("[RpiModule.handle_stm_messages]Waiting for path_queue")
+                    try:
+                        cur_location = self.path_queue.get_nowait()
+                        self.robot_location["x"] = cur_location["x"]
+                        self.robot_location["y"] = cur_location["y"]
+
+                        # Sanity check
+                        if cur_location['d'] >= 360:
+                            cur_location['d'] = cur_location['d'] % 360
+                        while cur_location['d'] < 0:
+                            cur_location['d'] += 360
+                        self.robot_location["d"] = cur_location["d"]
+
+                        trace_id = cur_location.get("trace_id")
+                        self.tracer.record(trace_id, ACKED)
+                        self.UpdateAndroidRobotLocation(trace_id)
+                    except Exception:
+                        logging.warning("Path queue is empty!")
+                    # Allow further actions to be sent to stm
+                    if PipelineSTM:
+                        self.stm_window.release()
+                    else:
+                        self.empty.clear()
+                        self.full.set()
+                finally:
+                    # Released on any error too, the command handler would otherwise wait on it forever
+                    self.movement_lock.release()
+                self.command_timer.acked()
             except queue.Empty:
                 continue
             except Exception:
                 continue
     
-    def UpdateAndroidRobotLocation(self):
-        self.android_msgs.put(RobotLocMessage(self.robot_location))
+    def UpdateAndroidRobotLocation(self, trace_id:int = None):
+        # Recorded first, the sender may write the message before put returns
+        self.tracer.record(trace_id, ANDROID_QUEUED)
+        self.android_msgs.put(RobotLocMessage(self.robot_location, trace_id))
 
     def handle_commands(self):
+        # Image predictions still running in this worker, a list per obstacle id as an obstacle can be snapped again
+        self.prediction_pool = ThreadPoolExecutor(max_workers=snap_prediction_workers)
+        self.pending_predictions = {}
+
         while True:
+            self.supervisor.heartbeat("handle_commands")
             try:
                 command:str = self.command_queue.get()
-                logging.debug(f"[RpiModule.handle_commands]Command: {command}")
+                logging.debug("[RpiModule.handle_commands]Command: %s", command)
+                trace_id = getattr(command, "trace_id", None)
+                self.tracer.record(trace_id, DEQUEUED, command)
             except queue.Empty:
                 continue
             except EOFError:
@@ -262,59 +382,127 @@ class RpiModule:
             self.start_movement.wait()
 
             # Movement Lock is needed to move and take pictures
-            logging.debug("[RpiModule.handle_commands]Waiting for full")
-            self.full.wait()
+            if PipelineSTM:
+                # A move only needs a free slot in the window, SNAP and FIN need the robot to have stopped
+                # A full window frees up with the ACK of its oldest command, an empty window needs no waiting
+                logging.debug("[RpiModule.handle_commands]Waiting for stm_window")
+                ack_wait = self.command_timer.ack_wait(newest=not command.startswith(stm_command_prefixes))
+                if ack_wait is None:
+                    ack_wait = stm_ack_timeout
+                if command.startswith(stm_command_prefixes):
+                    ready = self.stm_window.acquire(ack_wait)
+                else:
+                    ready = self.stm_window.drain(ack_wait)
+                if not ready:
+                    self.stop_unresponsive_stm(command)
+                    continue
+            else:
+                logging.debug("[RpiModule.handle_commands]Waiting for full")
+                self.full.wait()
             logging.debug("[RpiModule.handle_commands]Waiting for movement_lock")
             self.movement_lock.acquire()
 
             if command.startswith(stm_command_prefixes):
+                self.command_timer.sent(command)
                 self.stm.send(command)
-                self.full.clear()
-                self.empty.set()
+                self.tracer.record(trace_id, SENT, command)
+                if not PipelineSTM:
+                    self.full.clear()
+                    self.empty.set()
                 self.movement_lock.release()
 
             elif command.startswith("SNAP"):
                 if command.find("_") == -1:
                     img_name = command[4:]
+                    obstacle_id = img_name
                 else:
                     img_name = command[4:command.find("_")] + "_" + command[command.find('_')+1:]
+                    obstacle_id = command[4:command.find("_")]
                 
                 logging.info(f"[RpiModule.predict_image]Image Name: {img_name}")
                 self.android_msgs.put(StatusMessage(RobotStatus.DETECTING_IMAGE))
                 logging.info(f"[RpiModule.predict_image]After send status")
                 img_name = f"{time.time()}_{img_name}"
-                save_path = self.camera.capture(img_name)
+                image = self.camera.capture(img_name)
+                self.tracer.record(trace_id, CAPTURED, command)
                 self.android_msgs.put(InfoMessage("Captured image, sending to server"))
                 logging.info(f"[RpiModule.predict_image]After capture")
-                img_data = self.server.predict_image(save_path)
-                self.android_msgs.put(InfoMessage("Received image result"))
-                logging.info(f"[RpiModule.predict_image]Image data: {img_data}")
 
-                if img_data is not None:
-                    self.android_msgs.put(AndroidMessage(BluetoothHeader.IMAGE_RESULT.value, str({
-                        "target_id": int(img_data['image_id']),
-                        "obstacle_id": int(img_data['obstacle_id'])
-                    })))
+                if NonBlockingSnap:
+                    # Release the robot as soon as the frame is taken, recognition overlaps the next move
+                    self.empty.set()
+                    self.movement_lock.release()
+                    future = self.prediction_pool.submit(self.predict_image, image, trace_id)
+                    future.add_done_callback(self.log_prediction_error)
+                    self.pending_predictions.setdefault(obstacle_id, []).append(future)
+                else:
+                    self.predict_image(image, trace_id)
 
-                # self.full.clear()
-                self.empty.set()
-                self.movement_lock.release()
+                    # self.full.clear()
+                    self.empty.set()
+                    self.movement_lock.release()
 
             elif command == "FIN":
                 self.start_movement.clear()
                 # self.empty.clear()
                 # self.movement_lock.release()
                 # self.full.clear()
-                self.server.stitch_images()
                 self.android_msgs.put(InfoMessage("Commands queue finished."))
                 self.android_msgs.put(StatusMessage(RobotStatus.FINISH))
 
+                # Finish is signalled first, stitching waits for the predictions in the background
+                pending, self.pending_predictions = self.pending_predictions, {}
+                threading.Thread(target=self.stitch_images, args=(pending,), daemon=True).start()
+                self.report_command_latency()
+
             else:
                 logging.warning(f"[RpiModule.handle_commands]Unknown command: {command}")
             if self.manual_ctrl.is_set():
                 self.manual_ctrl.clear()
                 self.start_movement.clear()
 
+    def predict_image(self, image, trace_id:int = None):
+        """
+        Sends a captured image to the server and forwards the result to android
+        """
+        img_data = self.server.predict_image(image)
+        self.tracer.record(trace_id, PREDICTED, "SNAP")
+        self.android_msgs.put(InfoMessage("Received image result"))
+        logging.info(f"[RpiModule.predict_image]Image data: {img_data}")
+
+        if img_data is not None:
+            self.tracer.record(trace_id, ANDROID_QUEUED, "SNAP")
+            self.android_msgs.put(AndroidMessage(BluetoothHeader.IMAGE_RESULT.value, str({
+                "target_id": int(img_data['image_id']),
+                "obstacle_id": int(img_data['obstacle_id'])
+            }), trace_id=trace_id))
+        return img_data
+
+    def log_prediction_error(self, future):
+        if future.exception() is not None:
+            logging.warning(f"[RpiModule.predict_image]Background prediction failed: {future.exception()}")
+
+    def wait_for_predictions(self, predictions:dict):
+        """
+        Waits for the background image predictions, the server stitches only the images it has predicted
+        """
+        pending = [future for futures in predictions.values() for future in futures if not future.done()]
+        if len(pending) > 0:
+            logging.info(f"[RpiModule.wait_for_predictions]Waiting for {len(pending)} predictions")
+            _, not_done = wait(pending, timeout=snap_prediction_timeout)
+            if len(not_done) > 0:
+                logging.warning(f"[RpiModule.wait_for_predictions]{len(not_done)} predictions still running")
+
+    def stitch_images(self, predictions:dict):
+        """
+        Stitches the predicted images off the finish path and reports the outcome to android
+        """
+        self.wait_for_predictions(predictions)
+        if self.server.stitch_images():
+            self.android_msgs.put(InfoMessage("Images stitched"))
+        else:
+            self.android_msgs.put(InfoMessage("Image stitching failed"))
+
     def check_server(self):
         """
         Helper Function to ensure that server is running
@@ -343,8 +531,7 @@ class RpiModule:
         Helper Function to ensure that camera is working
         """
         try:
-            save_path = self.camera.capture("test")
-            os.remove(save_path)
+            self.camera.capture("test", persist=False)
             logging.info("[RpiModule.check_camera]Camera is running")
             return True
         
@@ -366,21 +553,78 @@ class RpiModule:
             "retrying": retrying,
             "bull": bull
         }
-        path_data = self.server.query_path(data)
+        cache_key = self.path_cache.key(data["obstacles"], robot_pos_x, robot_pos_y, robot_dir, retrying, bull)
+        path_data = self.path_cache.get(cache_key)
+        if path_data is not None:
+            logging.info(f"[RpiModule.find_shortest_path]Path served from cache ({self.path_cache.hits} hits, {self.path_cache.misses} misses)")
+        else:
+            path_data = self.query_path(data, cache_key)
 
         if path_data is None:
             self.android_msgs.put(InfoMessage(f"There was an error when querying path"))
 
         else:
+            commands, path, cancelled = self.command_optimizer.optimize(path_data['commands'], path_data['path'])
+            logging.info(f"[RpiModule.find_shortest_path]Optimized plan: {self.command_optimizer.report(path_data['commands'], commands, cancelled)}")
+            try:
+                mismatches = check_path(commands, path)
+                if len(mismatches) > 0:
+                    logging.warning(f"[RpiModule.find_shortest_path]Server path differs from the predicted trajectory at poses {mismatches}")
+            except (ValueError, KeyError) as e:
+                logging.warning(f"[RpiModule.find_shortest_path]Could not check server path: {e}")
+
             # ignore first element as it is the starting position of the robot
-            for location in path_data['path'][1:]:
-                self.path_queue.put(location)
-            
-            for command in path_data['commands']:
+            poses = iter(path[1:])
+            for command in commands:
+                command = self.tracer.trace(command)
+                if command.startswith(stm_command_prefixes):
+                    # The pose is reached when this command is ACKed
+                    location = next(poses, None)
+                    if location is not None:
+                        if self.tracer.enabled:
+                            location = dict(location, trace_id=command.trace_id)
+                        self.path_queue.put(location)
                 self.command_queue.put(command)
+            for location in poses:
+                self.path_queue.put(location)
+            self.path_queued = True
 
             self.android_msgs.put(InfoMessage("Retrieved shortest path from server. Robot is ready to move"))
 
+    def query_path(self, data:dict, cache_key:str):
+        """
+        Races /algo against the on-device planner, the server plan is preferred if it answers within planner_server_wait
+        """
+        server_plan = self.server_planner_pool.submit(self.server.query_path, data)
+        local_plan = self.local_planner_pool.submit(self.path_planner.plan, data["obstacles"],
+                                                    data["robot_pos_x"], data["robot_pos_y"], data["robot_dir"])
+        try:
+            path_data = server_plan.result(timeout=planner_server_wait)
+        except FutureTimeoutError:
+            logging.warning(f"[RpiModule.query_path]No path from server within {planner_server_wait}s")
+            path_data = None
+
+        if path_data is not None:
+            # Only server plans are cached, the on-device plan is a fallback
+            self.path_cache.put(cache_key, path_data)
+            return path_data
+
+        try:
+            path_data = local_plan.result(timeout=planner_local_wait)
+        except FutureTimeoutError:
+            logging.warning(f"[RpiModule.query_path]No on-device path within {planner_local_wait}s")
+            return None
+        except Exception as e:
+            # A planner error must not take the android worker down, the run goes on as without a path
+            logging.warning(f"[RpiModule.query_path]On-device planner failed: {e}")
+            return None
+        if path_data is not None:
+            logging.info("[RpiModule.query_path]Using the on-device plan")
+            self.android_msgs.put(InfoMessage("Server unavailable, using on-device path"))
+            if len(path_data["skipped"]) > 0:
+                self.android_msgs.put(InfoMessage(f"On-device path skips obstacles {path_data['skipped']}"))
+        return path_data
+
     def translate_robot(self, command:str):
         """
         Translate the robot using the command given and updates its predicted location
@@ -393,69 +637,114 @@ class RpiModule:
         self.robot_location['y'] += dy
         self.robot_location['d'] = direction
 
-    def clear_queues(self):
+    def clear_queues(self, queues:tuple = None):
         """
-        Helper Function to clear the queues
+        Helper Function to clear the queues, all of them by default
         """
-        while not self.path_queue.empty():
-            self.path_queue.get()
-        
-        while not self.command_queue.empty():
-            self.command_queue.get()
-
-        while not self.android_msgs.empty():
-            self.android_msgs.get()
+        self.path_queued = False
+        for q in queues or (self.path_queue, self.command_queue, self.android_msgs):
+            # Drained until get_nowait finds nothing instead of trusting empty(), a native "queue" transport can
+            # still receive items put just before by another process
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
 
     def spawn_android_processes(self):
-        self.handle_android_msgs_process = Process(target=self.handle_android_messages)
-        self.send_android_msgs_process = Process(target=self.send_android_messages)
+        self.spawn_android_handler()
+        self.spawn_android_sender()
+        self.android_msgs.put(InfoMessage('Ready to start'))
+        self.UpdateAndroidRobotLocation()
 
+    def spawn_android_handler(self) -> Process:
+        self.handle_android_msgs_process = Process(target=self.handle_android_messages)
         self.handle_android_msgs_process.start()
+        return self.handle_android_msgs_process
+
+    def spawn_android_sender(self) -> Process:
+        self.send_android_msgs_process = Process(target=self.send_android_messages)
         self.send_android_msgs_process.start()
-        self.android_msgs.put(InfoMessage('Ready to start'))
+        return self.send_android_msgs_process
+
+    def spawn_stm_handler(self) -> Process:
+        self.handle_stm_msgs_process = Process(target=self.handle_stm_messages)
+        self.handle_stm_msgs_process.start()
+        return self.handle_stm_msgs_process
+
+    def spawn_command_handler(self) -> Process:
+        self.handle_commands_process = Process(target=self.handle_commands)
+        self.handle_commands_process.start()
+        return self.handle_commands_process
+
+    def spawn_worker_threads(self):
+        """
+        Registers the workers as threads of the single process runtime instead of spawning processes
+        """
+        self.runtime = ThreadRuntime()
+        if StartAndroid:
+            self.runtime.add_worker("handle_android_messages", self.handle_android_messages)
+            self.runtime.add_worker("send_android_messages", self.send_android_messages)
+            self.runtime.add_worker("reconnect_android", self.reconnect_android)
+            self.android_msgs.put(InfoMessage('Ready to start'))
         self.UpdateAndroidRobotLocation()
+        if StartSTM:
+            self.runtime.add_worker("handle_stm_messages", self.handle_stm_messages)
+            self.runtime.add_worker("handle_commands", self.handle_commands)
 
-    def handle_android_drop_event(self):
+    def reconnect_android(self):
+        """
+        Re-establishes a dropped android link in place, used by the single process runtime where the workers
+        share one AndroidModule and do not need to be respawned
+        """
         while True:
-            res = self.android_dropped_event.wait(1)
-            if not res:
-                self.check_processes_if_running()
+            self.android_dropped_event.wait()
+            self.android_dropped_event.clear()
+            if not self.android.dropped():
+                # Reported by a worker that was still on a socket already replaced
+                self.android_connected.set()
                 continue
+            logging.debug('[RpiModule.reconnect_android]Reconnecting android')
+            self.android.reconnect()
+            self.android_connected.set()
+            self.android_msgs.put(InfoMessage('Ready to start'))
 
-            logging.debug('[RpiModule.handle_android_drop_event]Killing android process')
-            self.handle_android_msgs_process.kill()
-            self.send_android_msgs_process.kill()
+    def stop_unresponsive_stm(self, command:str):
+        """
+        Stops the run when the STM stops ACKing in pipelined mode, sending more would overfill its command buffer
+        """
+        logging.error(f"[RpiModule.stop_unresponsive_stm]STM is not ACKing, dropped {command} and the rest of the path")
+        self.start_movement.clear()
+        self.clear_queues((self.command_queue, self.path_queue))
+        self.stm_window.reset()
+        self.command_timer.reset()
+        self.android_msgs.put(StatusMessage(RobotStatus.UNRESPONSIVE))
+
+    def report_command_latency(self):
+        mode = "single process threads" if SingleProcess else "multiprocess"
+        if PipelineSTM:
+            mode += f", window of {stm_pipeline_window}"
+        logging.info(f"[RpiModule.report_command_latency]{mode} mode command latency: {self.command_timer.latency.report()}")
+        logging.info(f"[RpiModule.report_command_latency]Server latency:\n{self.server.latency_report()}")
 
-            self.handle_android_msgs_process.join()
-            self.send_android_msgs_process.join()
-            logging.debug('[RpiModule.handle_android_drop_event]Android processes killed')
+    def handle_android_drop_event(self):
+        while True:
+            self.android_dropped_event.wait()
+            self.android_dropped_event.clear()
+            if not self.android.dropped():
+                # Reported by a worker that was still on a socket already replaced
+                self.android_connected.set()
+                continue
 
-            self.android.disconnect()
-            self.android.connect()
+            # The android workers keep running and take over the new socket, only the connection is replaced
+            dropped = time.monotonic()
+            self.android.reconnect()
+            self.android_connected.set()
+            self.android_msgs.put(InfoMessage('Ready to start'))
+            self.UpdateAndroidRobotLocation()
+            logging.info(f"[RpiModule.handle_android_drop_event]Reconnected after {(time.monotonic() - dropped) * 1000:.0f}ms")
 
-            self.spawn_android_processes()
-            self.android_dropped_event.clear()
 
-    def check_processes_if_running(self):
-        if StartSTM:
-            if not self.handle_commands_process.is_alive():
-                logging.debug('[RpiModule.check_processes_if_running]handle_commands_process might have crashed, restarting')
-                self.handle_commands_process.join()
-                self.handle_commands_process = Process(target=self.handle_commands)
-                self.handle_commands_process.start()
-        
-            if not self.handle_stm_msgs_process.is_alive():
-                logging.debug('[RpiModule.check_processes_if_running]handle_stm_msgs_process might have crashed, restarting')
-                self.handle_stm_msgs_process.join()
-                self.handle_stm_msgs_process = Process(target=self.handle_stm_messages)
-                self.handle_stm_msgs_process.start()
-        if StartAndroid:
-            if not self.handle_android_msgs_process.is_alive():
-                logging.debug('[RpiModule.check_processes_if_running]handle_android_msgs_process might have crashed, restarting')
-                self.handle_android_msgs_process.join()
-                self.handle_android_msgs_process = Process(target=self.handle_android_messages)
-                self.handle_android_msgs_process.start()
-        
 if __name__ == "__main__":
     rpi = RpiModule()
     if rpi.initialize():
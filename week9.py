@@ -2,105 +2,136 @@ StartAndroid    = True
 StartSTM        = True
 StartCamera     = True
 CheckSvr        = True
+SingleProcess   = False
 
-import json
 import logging
-import os
 from multiprocessing import Process, Manager
 import requests
 import queue
+import threading
 import time
 
-from config import stm_command_prefixes, server_url, server_port
+from config import stm_command_prefixes, server_url, server_port, \
+    path_queue_transport, command_queue_transport, android_msgs_transport, robot_location_transport, \
+    supervisor_stall_timeout
 from helper import RobotStatus, Direction
 if StartAndroid:
     from Modules.AndroidModule import AndroidModule
 from Modules.AndroidMessages import AndroidMessage, InfoMessage, RobotLocMessage, \
-    ImageMessage, BluetoothHeader
+    ImageMessage, BluetoothHeader, StatusMessage
 if StartCamera:
     from Modules.CameraModule import CameraModule
 
-from Modules.StmModule import StmModule
+from Modules.StmModule import StmModule, CommandTimer
 from Modules.APIServer import APIServer
-from utils import local_StreamHandler
+from Modules.AndroidOutbox import AndroidSender
+from Modules.Transport import make_queue, make_pose, close_pose
+from Modules.ThreadRuntime import ThreadRuntime
+from Modules.Supervisor import Supervisor
+from utils import setup_logging
 
 class RpiModule:
     def __init__(self):
-        logging.basicConfig(level=logging.DEBUG, handlers=[local_StreamHandler])
+        self.log_pipeline = setup_logging(logging.DEBUG)
 
         if StartCamera:
             self.camera = CameraModule()
         if StartAndroid:
-            self.android = AndroidModule()
+            # The android workers stay up across a drop and take over the socket of the next connection
+            self.android = AndroidModule(workers=() if SingleProcess else ("handle_android_messages", "send_android_messages"))
         self.stm = StmModule()
         self.server = APIServer()
 
-        self._manager = Manager()
+        if SingleProcess:
+            # All workers share this object in one process, plain in-process primitives are enough
+            self._manager = None
+            sync = threading
+        else:
+            self._manager = Manager()
+            sync = self._manager
 
-        self.path_queue = self._manager.Queue()
-        self.android_msgs = self._manager.Queue()
-        self.android_dropped_event = self._manager.Event()
-        self.command_queue = self._manager.Queue()
+        self.path_queue = make_queue("local" if SingleProcess else path_queue_transport, self._manager)
+        self.android_msgs = make_queue("local" if SingleProcess else android_msgs_transport, self._manager)
+        self.android_dropped_event = sync.Event()
+        self.android_sender = AndroidSender(self.android_msgs, sync.Event(), self.android_send_failed)
+        self.android_connected = sync.Event()
+        self.command_queue = make_queue("local" if SingleProcess else command_queue_transport, self._manager)
 
-        self.movement_lock = self._manager.Lock()
+        self.movement_lock = sync.Lock()
 
-        self.start_movement = self._manager.Event()
+        self.start_movement = sync.Event()
 
-        self.obstacles = self._manager.list()
-        self.robot_location = self._manager.dict()
+        self.obstacles = [] if SingleProcess else self._manager.list()
+        self.robot_location = make_pose("local" if SingleProcess else robot_location_transport, self._manager)
+
+        self.command_timer = CommandTimer(1)
+        self.runtime = None
 
         self.handle_android_msgs_process = None
         self.send_android_msgs_process = None
         self.handle_stm_msgs_process = None
         self.handle_commands_process = None
+        # Restarts the workers that exit or stop beating, created before they are forked
+        self.supervisor = Supervisor(("handle_android_messages", "handle_stm_messages", "handle_commands"))
 
-        self.robot_location["x"] = 1
-        self.robot_location["y"] = 1
-        self.robot_location["d"] = 0
-
-        self.ack_count = 0
-        self.near_flag = self._manager.Event()
-        self.second_direction = None
+        # Progress through the course, shared so that a restarted handle_stm_messages carries on from it
+        self.mission_state = dict(ack_count=0, second_direction=None) if SingleProcess else \
+            self._manager.dict(ack_count=0, second_direction=None)
+        self.near_flag = sync.Event()
 
 
     def initialize(self):
+        if StartCamera:
+            # Start the camera service before the workers are forked so they can all reach it
+            self.camera.start()
         if StartAndroid:
             self.android.connect()
+            self.android_connected.set()
         if StartSTM:
             if not self.stm.connect():
                 logging.warning("[RpiModule.initialize]STM serial connection failed!")
                 return False
         if CheckSvr:
             self.check_server()
+
         #if StartCamera:
             #self.check_camera()
 
+        if SingleProcess:
+            self.spawn_worker_threads()
+            logging.info("[RpiModule.initialize]Worker threads created")
+            return True
+
         if StartAndroid:
             self.spawn_android_processes()
+            self.supervisor.add("handle_android_messages", self.handle_android_msgs_process, self.spawn_android_handler)
         if StartSTM:
-            self.handle_stm_msgs_process = Process(target=self.handle_stm_messages)
-            self.handle_commands_process = Process(target=self.handle_commands)
-            self.handle_stm_msgs_process.start()
-            self.handle_commands_process.start()
+            # handle_commands blocks on the command queue between paths, only the STM reader is expected to beat
+            # at least every serial timeout
+            self.supervisor.add("handle_stm_messages", self.spawn_stm_handler(), self.spawn_stm_handler,
+                                supervisor_stall_timeout)
+            self.supervisor.add("handle_commands", self.spawn_command_handler(), self.spawn_command_handler)
 
         logging.info("[RpiModule.initialize]Processes started")
         return True
 
     def handle_android_messages(self):
         while True:
+            self.supervisor.heartbeat("handle_android_messages")
+            msg = None
             try:
                 msg_str = self.android.receive()
                 if msg_str is not None:
-                    msg:AndroidMessage = json.loads(msg_str, object_hook=AndroidMessage.from_json)
+                    msg:AndroidMessage = AndroidMessage.decode(msg_str)
             except OSError:
                 logging.warning("[RpiModule.handle_android_messages]Android connection dropped")
-                self.android_dropped_event.set()
-            except json.decoder.JSONDecodeError:
-                logging.warning("[RpiModule.handle_android_messages]Invalid json msg")
+                self.wait_for_android("handle_android_messages")
+            except ValueError as e:
+                logging.warning(f"[RpiModule.handle_android_messages]Invalid json msg: {e}")
 
             if msg is None:
                 continue
-            logging.debug(f"[RpiModule.handle_android_messages]msg.value: {msg.value}")
+            logging.debug("[RpiModule.handle_android_messages]msg.value: %s", msg.value)
 
             if msg.category == BluetoothHeader.START_MOVEMENT.value:
                 if not self.check_server():
@@ -116,8 +147,8 @@ class RpiModule:
 
                 # Try to identify direction before moving
                 img_name = f"{time.time()}_first_far"
-                save_path = self.camera.capture(img_name)
-                img_data = self.server.predict_image(save_path)
+                image = self.camera.capture(img_name)
+                img_data = self.server.predict_image(image)
 
                 # To move until obstacle is reached
                 self.command_queue.put("DT30") # ack_count = 2
@@ -133,10 +164,12 @@ class RpiModule:
                 else:
                     self.near_flag.set() # need to take again when closer to image
 
+                self.start_movement.set()
                 self.android_msgs.put(InfoMessage("Processed Start Command"))
 
     def handle_stm_messages(self):
         while True:
+            self.supervisor.heartbeat("handle_stm_messages")
             msg:str = self.stm.receive()
 
             if msg is None:
@@ -145,19 +178,22 @@ class RpiModule:
             if not "ACK" in msg or len(msg) <= 0:
                 continue
             
-            self.ack_count += 1
-            logging.debug(f"[RpiModule.handle_stm_messages]ACK count: {self.ack_count}")
+            ack_count = self.mission_state["ack_count"] + 1
+            self.mission_state["ack_count"] = ack_count
+            logging.debug("[RpiModule.handle_stm_messages]ACK count: %s", ack_count)
 
             try:
                 self.movement_lock.release()
             except Exception:
                 logging.warning("[RpiModule.handle_stm_messages]Tried to release a released lock!")
 
-            if self.ack_count == 2: # Robot reached first obstacle
+            self.command_timer.acked()
+
+            if ack_count == 2: # Robot reached first obstacle
                 if self.near_flag.is_set(): # need to take image again
                     img_name = f"{time.time()}_first_near"
-                    save_path = self.camera.capture(img_name)
-                    img_data = self.server.predict_image(save_path)
+                    image = self.camera.capture(img_name)
+                    img_data = self.server.predict_image(image)
 
                     if img_data["image_label"] == "Left":
                         self.command_queue.put("FL00") # ack_count = 3
@@ -171,10 +207,10 @@ class RpiModule:
 
                     self.near_flag.clear() # resets the near_flag
 
-            if self.ack_count == 5:  # Robot crossed first obstacle
+            if ack_count == 5:  # Robot crossed first obstacle
                 img_name = f"{time.time()}_second_far"
-                save_path = self.camera.capture(img_name)
-                img_data = self.server.predict_image(save_path)
+                image = self.camera.capture(img_name)
+                img_data = self.server.predict_image(image)
 
                 # To move until obstacle is reached
                 self.command_queue.put("DT10") # ack_count = 6
@@ -184,21 +220,21 @@ class RpiModule:
                     self.command_queue.put("FW30") # ack_count = 8
                     self.command_queue.put("FR00") # ack_count = 9
                     self.command_queue.put("FW10") # ack_count = 10
-                    self.second_direction = img_data["image_label"]
+                    self.mission_state["second_direction"] = img_data["image_label"]
                 elif img_data["image_label"] == "Right":
                     self.command_queue.put("FR00") # ack_count = 7
                     self.command_queue.put("FW30") # ack_count = 8
                     self.command_queue.put("FL00") # ack_count = 9
                     self.command_queue.put("FW10") # ack_count = 10
-                    self.second_direction = img_data["image_label"]
+                    self.mission_state["second_direction"] = img_data["image_label"]
                 else:
                     self.near_flag.set() # need to take again when closer to image
 
-            elif self.ack_count == 6: # Robot reached second obstacle
+            elif ack_count == 6: # Robot reached second obstacle
                 if self.near_flag.is_set(): # need to take image again
                     img_name = f"{time.time()}_second_near"
-                    save_path = self.camera.capture(img_name)
-                    img_data = self.server.predict_image(save_path)
+                    image = self.camera.capture(img_name)
+                    img_data = self.server.predict_image(image)
 
                     if img_data["image_label"] == "Left":
                         self.command_queue.put("FL00") # ack_count = 7
@@ -212,12 +248,12 @@ class RpiModule:
                         self.command_queue.put("FL00") # ack_count = 9
                         self.command_queue.put("FW10") # ack_count = 10
 
-                    self.second_direction = img_data["image_label"]
+                    self.mission_state["second_direction"] = img_data["image_label"]
 
                     self.near_flag.clear() # resets the near_flag
             
-            elif self.ack_count == 10: # Robot crossed second obstacle
-                if self.second_direction == "Left":
+            elif ack_count == 10: # Robot crossed second obstacle
+                if self.mission_state["second_direction"] == "Left":
                     self.command_queue.put("FR00")
                     self.command_queue.put("FW60")
                     self.command_queue.put("FR00")
@@ -243,9 +279,10 @@ class RpiModule:
 
     def handle_commands(self):
         while True:
+            self.supervisor.heartbeat("handle_commands")
             try:
                 command:str = self.command_queue.get()
-                logging.debug(f"[RpiModule.handle_commands]Command: {command}")
+                logging.debug("[RpiModule.handle_commands]Command: %s", command)
             except queue.Empty:
                 continue
             except EOFError:
@@ -261,13 +298,15 @@ class RpiModule:
 
             if command.startswith(stm_command_prefixes):
                 #logging.info("[RpiModule.handle_commands]Inside send")
+                self.command_timer.sent(command)
                 self.stm.send(command)
 
             elif command == "FIN":
                 self.start_movement.clear()
                 self.movement_lock.release()
                 self.android_msgs.put(InfoMessage("Commands queue finished."))
-                self.android_msgs.put(InfoMessage(RobotStatus.FINISH))
+                self.android_msgs.put(StatusMessage(RobotStatus.FINISH))
+                self.report_command_latency()
 
             else:
                 logging.warning(f"[RpiModule.handle_commands]Unknown command: {command}")
@@ -276,44 +315,86 @@ class RpiModule:
             self.movement_lock.release()
 
     def send_android_messages(self):
-        while True:
-            try:
-                if self.android_msgs.empty():
-                    continue
-                msg:AndroidMessage = self.android_msgs.get()
-                logging.debug(f"[RpiModule.send_android_messages]msg:{msg}")
-                self.android.send(msg)
-            except queue.Empty:
-                continue
-            except OSError:
-                self.android_dropped_event.set()
-                logging.warning("[RpiModule.send_android_messages]Android connection dropped")
+        self.android_sender.run(self.android)
+
+    def android_send_failed(self) -> bool:
+        """
+        Holds the sender until the link is back, later messages wait in android_msgs meanwhile
+        """
+        self.wait_for_android("send_android_messages")
+        return True
+
+    def wait_for_android(self, worker:str):
+        """
+        Reports a dropped android link and blocks the worker until handle_android_drop_event has accepted the
+        next connection
+        """
+        if not SingleProcess and self.android.adopt(worker, block=False):
+            # The drop was already handled, this worker was still on the old socket
+            return
+        self.android_connected.clear()
+        self.android.report_drop()
+        self.android_dropped_event.set()
+        if SingleProcess:
+            # The workers share one AndroidModule, reconnect_android replaces its socket in place
+            self.android_connected.wait()
+        else:
+            self.android.adopt(worker)
+
+    def stop_android_sender(self):
+        self.android_sender.stop(self.send_android_msgs_process)
 
     def EventLoop(self):
         try:
-            if not StartAndroid:
-                while True:
-                    self.check_processes_if_running()
+            if SingleProcess:
+                self.runtime.run()
+            elif not StartAndroid:
+                self.supervisor.run()
             else:
+                self.supervisor.start()
                 self.handle_android_drop_event()
         except KeyboardInterrupt:
             logging.info("[RpiModule.EventLoop]KeyboardInterrupt")
             self.terminate()
 
     def terminate(self):
+        self.report_command_latency()
+        if StartCamera:
+            self.camera.stop()
+        if SingleProcess:
+            # Worker threads are daemons and exit with the program
+            if StartAndroid:
+                self.android_sender.stop()
+                self.android.disconnect()
+            if StartSTM:
+                self.stm.disconnect()
+            logging.info("[RpiModule.terminate]Program terminated")
+            self.stop_logging()
+            return
+
+        self.supervisor.stop()
         if StartAndroid:
+            self.stop_android_sender()
             self.android.disconnect()
             self.handle_android_msgs_process.kill()
-            self.send_android_msgs_process.kill()
             self.handle_android_msgs_process.join()
-            self.send_android_msgs_process.join()
         if StartSTM:
             self.stm.disconnect()
             self.handle_stm_msgs_process.join()
             self.handle_commands_process.join()
 
+        close_pose(self.robot_location)
+
         logging.info("[RpiModule.terminate]Processes joined")
         logging.info("[RpiModule.terminate]Program terminated")
+        self.stop_logging()
+
+    def stop_logging(self):
+        """
+        Lets the log writer process finish the queued records, last step of terminate
+        """
+        if self.log_pipeline is not None:
+            self.log_pipeline.stop()
 
     def check_server(self):
         """
@@ -343,8 +424,7 @@ class RpiModule:
         Helper Function to ensure that camera is working
         """
         try:
-            save_path = self.camera.capture("test")
-            os.remove(save_path)
+            self.camera.capture("test", persist=False)
             logging.info("[RpiModule.check_camera]Camera is running")
             return True
         
@@ -356,64 +436,87 @@ class RpiModule:
         """
         Helper Function to clear the queues
         """
-        while not self.path_queue.empty():
-            self.path_queue.get()
-        
-        while not self.command_queue.empty():
-            self.command_queue.get()
-
-        while not self.android_msgs.empty():
-            self.android_msgs.get()
+        for q in (self.path_queue, self.command_queue, self.android_msgs):
+            # Drained until get_nowait finds nothing instead of trusting empty(), a native "queue" transport can
+            # still receive items put just before by another process
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
 
     def spawn_android_processes(self):
-        self.handle_android_msgs_process = Process(target=self.handle_android_messages)
+        self.spawn_android_handler()
         self.send_android_msgs_process = Process(target=self.send_android_messages)
-
-        self.handle_android_msgs_process.start()
         self.send_android_msgs_process.start()
         self.android_msgs.put(InfoMessage('Ready to start'))
 
-    def handle_android_drop_event(self):
+    def spawn_android_handler(self) -> Process:
+        self.handle_android_msgs_process = Process(target=self.handle_android_messages)
+        self.handle_android_msgs_process.start()
+        return self.handle_android_msgs_process
+
+    def spawn_stm_handler(self) -> Process:
+        self.handle_stm_msgs_process = Process(target=self.handle_stm_messages)
+        self.handle_stm_msgs_process.start()
+        return self.handle_stm_msgs_process
+
+    def spawn_command_handler(self) -> Process:
+        self.handle_commands_process = Process(target=self.handle_commands)
+        self.handle_commands_process.start()
+        return self.handle_commands_process
+
+    def spawn_worker_threads(self):
+        """
+        Registers the workers as threads of the single process runtime instead of spawning processes
+        """
+        self.runtime = ThreadRuntime()
+        if StartAndroid:
+            self.runtime.add_worker("handle_android_messages", self.handle_android_messages)
+            self.runtime.add_worker("send_android_messages", self.send_android_messages)
+            self.runtime.add_worker("reconnect_android", self.reconnect_android)
+            self.android_msgs.put(InfoMessage('Ready to start'))
+        if StartSTM:
+            self.runtime.add_worker("handle_stm_messages", self.handle_stm_messages)
+            self.runtime.add_worker("handle_commands", self.handle_commands)
+
+    def reconnect_android(self):
+        """
+        Re-establishes a dropped android link in place, used by the single process runtime where the workers
+        share one AndroidModule and do not need to be respawned
+        """
         while True:
-            res = self.android_dropped_event.wait(1)
-            if not res:
-                self.check_processes_if_running()
-                continue
             self.android_dropped_event.wait()
-            
-            logging.debug('[RpiModule.handle_android_drop_event]Killing android process')
-            self.handle_android_msgs_process.kill()
-            self.send_android_msgs_process.kill()
-
-            self.handle_android_msgs_process.join()
-            self.send_android_msgs_process.join()
-            logging.debug('[RpiModule.handle_android_drop_event]Android processes killed')
+            self.android_dropped_event.clear()
+            if not self.android.dropped():
+                # Reported by a worker that was still on a socket already replaced
+                self.android_connected.set()
+                continue
+            logging.debug('[RpiModule.reconnect_android]Reconnecting android')
+            self.android.reconnect()
+            self.android_connected.set()
+            self.android_msgs.put(InfoMessage('Ready to start'))
 
-            self.android.disconnect()
-            self.android.connect()
+    def report_command_latency(self):
+        mode = "single process threads" if SingleProcess else "multiprocess"
+        logging.info(f"[RpiModule.report_command_latency]{mode} mode command latency: {self.command_timer.latency.report()}")
+        logging.info(f"[RpiModule.report_command_latency]Server latency:\n{self.server.latency_report()}")
 
-            self.spawn_android_processes()
+    def handle_android_drop_event(self):
+        while True:
+            self.android_dropped_event.wait()
             self.android_dropped_event.clear()
-    
-    def check_processes_if_running(self):
-        if StartSTM:
-            if not self.handle_commands_process.is_alive():
-                logging.debug('[RpiModule.check_processes_if_running]handle_commands_process might have crashed, restarting')
-                self.handle_commands_process.join()
-                self.handle_commands_process = Process(target=self.handle_commands)
-                self.handle_commands_process.start()
-        
-            if not self.handle_stm_msgs_process.is_alive():
-                logging.debug('[RpiModule.check_processes_if_running]handle_stm_msgs_process might have crashed, restarting')
-                self.handle_stm_msgs_process.join()
-                self.handle_stm_msgs_process = Process(target=self.handle_stm_messages)
-                self.handle_stm_msgs_process.start()
-        if StartAndroid:
-            if not self.handle_android_msgs_process.is_alive():
-                logging.debug('[RpiModule.check_processes_if_running]handle_android_msgs_process might have crashed, restarting')
-                self.handle_android_msgs_process.join()
-                self.handle_android_msgs_process = Process(target=self.handle_android_messages)
-                self.handle_android_msgs_process.start()
+            if not self.android.dropped():
+                # Reported by a worker that was still on a socket already replaced
+                self.android_connected.set()
+                continue
+
+            # The android workers keep running and take over the new socket, only the connection is replaced
+            dropped = time.monotonic()
+            self.android.reconnect()
+            self.android_connected.set()
+            self.android_msgs.put(InfoMessage('Ready to start'))
+            logging.info(f"[RpiModule.handle_android_drop_event]Reconnected after {(time.monotonic() - dropped) * 1000:.0f}ms")
 
 
 if __name__ == "__main__":
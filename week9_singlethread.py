@@ -3,16 +3,16 @@ StartSTM        = True
 StartCamera     = True
 CheckSvr        = True
 
-import json
 import logging
-import os
 from multiprocessing import Process, Manager
 import requests
 import queue
+import threading
 import time
 
-from config import stm_command_prefixes, server_url, server_port, OBSTACLE_WIDTH, IS_OUTSIDE
-from helper import RobotStatus, Direction, current_milli_time
+from config import stm_command_prefixes, server_url, server_port, OBSTACLE_WIDTH, IS_OUTSIDE, \
+    path_queue_transport, command_queue_transport, android_msgs_transport, robot_location_transport
+from helper import RobotStatus, Direction
 if StartAndroid:
     from Modules.AndroidModule import AndroidModule
 from Modules.AndroidMessages import AndroidMessage, InfoMessage, RobotLocMessage, \
@@ -20,43 +20,42 @@ from Modules.AndroidMessages import AndroidMessage, InfoMessage, RobotLocMessage
 if StartCamera:
     from Modules.CameraModule import CameraModule
 
-from Modules.StmModule import StmModule
+from Modules.StmModule import StmModule, StmReader
 from Modules.APIServer import APIServer
-from utils import local_StreamHandler
+from Modules.AndroidOutbox import AndroidSender
+from Modules.Transport import make_queue, make_pose, close_pose
+from utils import setup_logging
 
 class RpiModule:
     def __init__(self):
-        logging.basicConfig(level=logging.DEBUG, handlers=[local_StreamHandler])
+        self.log_pipeline = setup_logging(logging.DEBUG)
 
         if StartCamera:
             self.camera = CameraModule()
         if StartAndroid:
-            self.android = AndroidModule()
+            self.android = AndroidModule(workers=("handle_android_messages", "send_android_messages"))
         self.stm = StmModule()
         self.server = APIServer()
 
         self._manager = Manager()
 
-        self.path_queue = self._manager.Queue()
-        self.android_msgs = self._manager.Queue()
+        self.path_queue = make_queue(path_queue_transport, self._manager)
+        self.android_msgs = make_queue(android_msgs_transport, self._manager)
         self.android_dropped_event = self._manager.Event()
-        self.command_queue = self._manager.Queue()
+        self.android_sender = AndroidSender(self.android_msgs, self._manager.Event(), self.android_send_failed)
+        self.command_queue = make_queue(command_queue_transport, self._manager)
 
         self.movement_lock = self._manager.Lock()
 
         self.start_movement = self._manager.Event()
 
         self.obstacles = self._manager.list()
-        self.robot_location = self._manager.dict()
+        self.robot_location = make_pose(robot_location_transport, self._manager)
 
         self.handle_android_msgs_process = None
         self.send_android_msgs_process = None
         self.handle_commands_process = None
 
-        self.robot_location["x"] = 1
-        self.robot_location["y"] = 1
-        self.robot_location["d"] = 0
-
         self.ack_count = 0
         self.near_flag = self._manager.Event()
         self.second_direction = None
@@ -65,6 +64,9 @@ class RpiModule:
 
 
     def initialize(self):
+        if StartCamera:
+            # Start the camera service before the workers are forked so they can all reach it
+            self.camera.start()
         if StartAndroid:
             self.android.connect()
             
@@ -86,19 +88,20 @@ class RpiModule:
 
     def handle_android_messages(self):
         while True:
+            msg = None
             try:
                 msg_str = self.android.receive()
                 if msg_str is not None:
-                    msg:AndroidMessage = json.loads(msg_str, object_hook=AndroidMessage.from_json)
+                    msg:AndroidMessage = AndroidMessage.decode(msg_str)
             except OSError:
                 logging.warning("[RpiModule.handle_android_messages]Android connection dropped")
-                self.android_dropped_event.set()
-            except json.decoder.JSONDecodeError:
-                logging.warning("[RpiModule.handle_android_messages]Invalid json msg")
+                self.wait_for_android("handle_android_messages")
+            except ValueError as e:
+                logging.warning(f"[RpiModule.handle_android_messages]Invalid json msg: {e}")
 
             if msg is None:
                 continue
-            logging.debug(f"[RpiModule.handle_android_messages]msg.value: {msg.value}")
+            logging.debug("[RpiModule.handle_android_messages]msg.value: %s", msg.value)
 
             if msg.category == BluetoothHeader.START_MOVEMENT.value:
                 if not self.check_server():
@@ -114,19 +117,10 @@ class RpiModule:
                 self.start_movement.set()
                 self.android_msgs.put(InfoMessage("Processed Start Command"))
 
-    def wait_for_ack(self, timeout = 2):#by default stmModule timeout @ 2s
-        logging.debug('[RpiModule.wait_for_ack]Waiting for ACK')
-        init_time = current_milli_time()
-        while current_milli_time() < (init_time + timeout):
-            msg:str = self.stm.receive()
-            if msg is None:
-                continue
-            elif not "ACK" in msg or len(msg) <= 0:
-                continue
-            return True
-        return False
-    
     def stm_message_handler(self):
+        # The reader thread belongs to this worker process, it completes the ACK waiters of the commands sent here
+        self.stm_reader = StmReader(self.stm)
+        self.stm_reader.start()
         while True:
             logging.debug("[RpiModule.stm_message_handler]Waiting for start_movement")
             self.start_movement.wait()
@@ -137,7 +131,7 @@ class RpiModule:
         while True:
             try:
                 command:str = self.command_queue.get()
-                logging.debug(f"[RpiModule.stm_handle_command_list]Command: {command}")
+                logging.debug("[RpiModule.stm_handle_command_list]Command: %s", command)
             except queue.Empty:
                 return False
             except EOFError:
@@ -145,8 +139,8 @@ class RpiModule:
             
             #logging.log('[RpiModule.stm_handle_command_list]Processing {command}')
             if command.startswith(stm_command_prefixes):
-                self.stm.send(command)
-                self.wait_for_ack(60000) #wait for 10s max
+                logging.debug('[RpiModule.stm_handle_command_list]Waiting for ACK')
+                self.stm_reader.wait(self.stm_reader.send(command))
 
             elif 'SNAP' in command:
                 index = command.index('_')
@@ -155,8 +149,8 @@ class RpiModule:
 
                 if type == 1:
                     img_name = f"{time.time()}_first_far"
-                    save_path = self.camera.capture(img_name)
-                    img_data = self.server.predict_image(save_path, strict=(is_near==1))
+                    image = self.camera.capture(img_name)
+                    img_data = self.server.predict_image(image, strict=(is_near==1))
 
                     def QueueGoRight():
                         if IS_OUTSIDE:
@@ -195,8 +189,8 @@ class RpiModule:
 
                 elif type == 2:
                     img_name = f"{time.time()}_second_far"
-                    save_path = self.camera.capture(img_name)
-                    img_data = self.server.predict_image(save_path, strict=(is_near==1))
+                    image = self.camera.capture(img_name)
+                    img_data = self.server.predict_image(image, strict=(is_near==1))
 
                     def QueueGoRight():
                         if IS_OUTSIDE:
@@ -238,34 +232,48 @@ class RpiModule:
             elif 'CALIBRATE' in command:                
                 # Calibrate robot before parking
                 img_name = f"{time.time()}_calibrate"
-                save_path = self.camera.capture(img_name)
-                command = self.server.calibrate_robot(save_path)
+                image = self.camera.capture(img_name)
+                command = self.server.calibrate_robot(image)
                 if command:
                     self.command_queue.put(command)
                 self.command_queue.put("DT15")
                 self.command_queue.put("FIN")
 
             elif command == "FIN":
-                self.server.stitch_images()
                 self.start_movement.clear()
                 self.android_msgs.put(InfoMessage("Commands queue finished."))
                 self.android_msgs.put(StatusMessage(RobotStatus.FINISH))
+                # Finish is signalled first, a slow server only delays the stitching report
+                threading.Thread(target=self.stitch_images, daemon=True).start()
+                logging.info(f"[RpiModule.stm_handle_command_list]Server latency:\n{self.server.latency_report()}")
+                logging.info(f"[RpiModule.stm_handle_command_list]ACK dispatch latency: {self.stm_reader.dispatch_latency.report()}")
             else:
                 logging.warning(f"[RpiModule.stm_handle_command_list]Unknown command: {command}")
 
     def send_android_messages(self):
-        while True:
-            try:
-                if self.android_msgs.empty():
-                    continue
-                msg:AndroidMessage = self.android_msgs.get()
-                logging.debug(f"[RpiModule.send_android_messages]msg:{msg}")
-                self.android.send(msg)
-            except queue.Empty:
-                continue
-            except OSError:
-                self.android_dropped_event.set()
-                logging.warning("[RpiModule.send_android_messages]Android connection dropped")
+        self.android_sender.run(self.android)
+
+    def android_send_failed(self) -> bool:
+        """
+        Holds the sender until the link is back, later messages wait in android_msgs meanwhile
+        """
+        self.wait_for_android("send_android_messages")
+        return True
+
+    def wait_for_android(self, worker:str):
+        """
+        Reports a dropped android link and blocks the worker until handle_android_drop_event has accepted the
+        next connection
+        """
+        if self.android.adopt(worker, block=False):
+            # The drop was already handled, this worker was still on the old socket
+            return
+        self.android.report_drop()
+        self.android_dropped_event.set()
+        self.android.adopt(worker)
+
+    def stop_android_sender(self):
+        self.android_sender.stop(self.send_android_msgs_process)
 
     def EventLoop(self):
         try:
@@ -279,18 +287,38 @@ class RpiModule:
             self.terminate()
 
     def terminate(self):
+        if StartCamera:
+            self.camera.stop()
         if StartAndroid:
+            self.stop_android_sender()
             self.android.disconnect()
             self.handle_android_msgs_process.kill()
-            self.send_android_msgs_process.kill()
             self.handle_android_msgs_process.join()
-            self.send_android_msgs_process.join()
         if StartSTM:
             self.stm.disconnect()
             self.handle_commands_process.join()
 
+        close_pose(self.robot_location)
+
         logging.info("[RpiModule.terminate]Processes joined")
         logging.info("[RpiModule.terminate]Program terminated")
+        self.stop_logging()
+
+    def stop_logging(self):
+        """
+        Lets the log writer process finish the queued records, last step of terminate
+        """
+        if self.log_pipeline is not None:
+            self.log_pipeline.stop()
+
+    def stitch_images(self):
+        """
+        Stitches the captured images off the finish path and reports the outcome to android
+        """
+        if self.server.stitch_images():
+            self.android_msgs.put(InfoMessage("Images stitched"))
+        else:
+            self.android_msgs.put(InfoMessage("Image stitching failed"))
 
     def check_server(self):
         """
@@ -320,8 +348,7 @@ class RpiModule:
         Helper Function to ensure that camera is working
         """
         try:
-            save_path = self.camera.capture("test")
-            os.remove(save_path)
+            self.camera.capture("test", persist=False)
             logging.info("[RpiModule.check_camera]Camera is running")
             return True
         
@@ -333,14 +360,14 @@ class RpiModule:
         """
         Helper Function to clear the queues
         """
-        while not self.path_queue.empty():
-            self.path_queue.get()
-        
-        while not self.command_queue.empty():
-            self.command_queue.get()
-
-        while not self.android_msgs.empty():
-            self.android_msgs.get()
+        for q in (self.path_queue, self.command_queue, self.android_msgs):
+            # Drained until get_nowait finds nothing instead of trusting empty(), a native "queue" transport can
+            # still receive items put just before by another process
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
 
     def spawn_android_processes(self):
         self.handle_android_msgs_process = Process(target=self.handle_android_messages)
@@ -356,21 +383,16 @@ class RpiModule:
             if not res:
                 self.check_processes_if_running()
                 continue
-            self.android_dropped_event.wait()
-            
-            logging.debug('[RpiModule.handle_android_drop_event]Killing android process')
-            self.handle_android_msgs_process.kill()
-            self.send_android_msgs_process.kill()
-
-            self.handle_android_msgs_process.join()
-            self.send_android_msgs_process.join()
-            logging.debug('[RpiModule.handle_android_drop_event]Android processes killed')
-
-            self.android.disconnect()
-            self.android.connect()
-
-            self.spawn_android_processes()
             self.android_dropped_event.clear()
+            if not self.android.dropped():
+                # Reported by a worker that was still on a socket already replaced
+                continue
+
+            # The android processes keep running and take over the new socket, only the connection is replaced
+            dropped = time.monotonic()
+            self.android.reconnect()
+            self.android_msgs.put(InfoMessage('Ready to start'))
+            logging.info(f"[RpiModule.handle_android_drop_event]Reconnected after {(time.monotonic() - dropped) * 1000:.0f}ms")
     
     def check_processes_if_running(self):
         if StartSTM: